@@ -0,0 +1,97 @@
+// js/streamEvents.js
+
+// Чтение SSE-потока /generate-stream в формате stream_format: 'events'.
+// Кадр может прийти разрезанным между чтениями, поэтому незавершенный хвост копится в буфере,
+// а каждый байт потока разбирается один раз.
+// onEvent(type, data, id) вызывается для каждого события: thinking, content, tool_call, tool_result,
+// stats, queued, cancelled, error, end.
+export async function readEventStream(body, onEvent) {
+    const reader = body.getReader();
+    const decoder = new TextDecoder("utf-8");
+    let buffer = "";
+    while (true) {
+        const { value, done } = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        let start = 0;
+        let end;
+        while ((end = buffer.indexOf("\n\n", start)) >= 0) {
+            dispatchFrame(buffer.slice(start, end), onEvent);
+            start = end + 2;
+        }
+        buffer = buffer.slice(start);
+        if (done) break;
+    }
+    if (buffer.trim()) dispatchFrame(buffer, onEvent);
+}
+
+function dispatchFrame(frame, onEvent) {
+    let type = "message";
+    let data = "";
+    let id = null;
+    for (const line of frame.split("\n")) {
+        if (line.startsWith("event: ")) type = line.substring(7);
+        else if (line.startsWith("data: ")) data += line.substring(6);
+        else if (line.startsWith("id: ")) id = line.substring(4);
+    }
+    if (!data) return;
+    let parsed;
+    try {
+        parsed = JSON.parse(data);
+    } catch (e) {
+        console.error('[StreamEvents] Bad frame:', frame, e);
+        return;
+    }
+    onEvent(type, parsed, id);
+}
+
+const RESUME_ATTEMPTS = 8;
+const RESUME_MAX_DELAY_MS = 5000;
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+// Читает ответ /generate-stream до события end. Если соединение оборвалось раньше (например,
+// моргнул Wi-Fi), переподключается к тому же запуску с Last-Event-ID: сервер досылает пропущенные
+// события и продолжает живой поток, генерация при этом не начинается заново.
+export async function followEventStream(resp, onEvent, signal) {
+    const streamId = resp.headers.get("X-Stream-Id");
+    let lastEventId = null;
+    let ended = false;
+    let failures = 0;
+    const handle = (type, data, id) => {
+        if (id !== null) lastEventId = id;
+        if (type === 'end') ended = true;
+        failures = 0;
+        onEvent(type, data);
+    };
+    while (true) {
+        if (resp) {
+            try {
+                await readEventStream(resp.body, handle);
+            } catch (e) {
+                if (signal && signal.aborted) throw e;
+                console.warn('[StreamEvents] Stream interrupted:', e);
+            }
+        }
+        if (ended || !streamId || (signal && signal.aborted)) return;
+        if (++failures > RESUME_ATTEMPTS) throw new Error("Соединение с сервером потеряно");
+        await sleep(Math.min(250 * 2 ** failures, RESUME_MAX_DELAY_MS));
+        resp = null;
+        try {
+            const next = await fetch(`/generate-stream/${streamId}`, {
+                headers: { "Last-Event-ID": lastEventId || "0" },
+                signal
+            });
+            if (!next.ok) {
+                // Запуск уже забыт сервером или нужные события вытеснены из буфера - продолжить нельзя
+                const errorData = await next.json().catch(() => ({}));
+                throw Object.assign(new Error(errorData.error || next.statusText), { fatal: true });
+            }
+            resp = next;
+        } catch (e) {
+            if (e.fatal || (signal && signal.aborted)) throw e;
+            console.warn('[StreamEvents] Reconnect failed:', e);
+        }
+    }
+}
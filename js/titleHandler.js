@@ -1,6 +1,18 @@
 // js/titleHandler.js
 
-export async function fetchGeneratedTitle(chatHistory, modelNameForTitle) {
+const TITLE_POLL_INTERVAL_MS = 1000;
+const TITLE_POLL_TIMEOUT_MS = 120000;
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+// Сервер сразу возвращает локальный (извлеченный из текста) заголовок, а LLM-заголовок,
+// если upgrade включен, генерирует в фоне: POST отвечает 202 с задачей, готовый заголовок
+// сервер сам записывает в чат, а здесь мы лишь дожидаемся результата задачи.
+// onTitle(title, source) вызывается для каждого полученного заголовка ('local', затем 'llm');
+// если чат переименован пользователем, сервер возвращает его заголовок с source 'user' и задачу не создает.
+export async function fetchGeneratedTitle(chatHistory, modelNameForTitle, chatId, onTitle, upgrade = true) {
     console.log('[TitleHandler] Requesting title generation. Model:', modelNameForTitle, 'History length:', chatHistory.length);
     try {
         const titleResponse = await fetch('/generate-title', {
@@ -8,24 +20,38 @@ export async function fetchGeneratedTitle(chatHistory, modelNameForTitle) {
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
                 history: chatHistory,
-                model: modelNameForTitle 
+                model: modelNameForTitle,
+                chat_id: chatId,
+                upgrade: upgrade
             })
         });
 
-        if (titleResponse.ok) {
-            const titleData = await titleResponse.json();
-            if (titleData.title) {
-                console.log('[TitleHandler] Received title:', titleData.title);
-                return titleData.title;
-            } else {
-                console.error('[TitleHandler] Title generation successful but no title in response:', titleData);
-                return null;
-            }
-        } else {
+        if (!titleResponse.ok) {
             const errorData = await titleResponse.text();
             console.error('[TitleHandler] Title generation request failed:', titleResponse.status, errorData);
             return null;
         }
+        const titleData = await titleResponse.json();
+        if (titleData.title && onTitle) {
+            onTitle(titleData.title, titleData.title_source);
+        }
+        let job = titleData.job;
+        const deadline = Date.now() + TITLE_POLL_TIMEOUT_MS;
+        while (job && ['queued', 'running'].includes(job.status) && Date.now() < deadline) {
+            await sleep(TITLE_POLL_INTERVAL_MS);
+            const jobResponse = await fetch(`/title-jobs/${job.id}`);
+            if (!jobResponse.ok) {
+                console.error('[TitleHandler] Title job lookup failed:', jobResponse.status);
+                break;
+            }
+            job = await jobResponse.json();
+            if (job.status === 'done' && job.title && onTitle) {
+                onTitle(job.title, 'llm');
+            }
+        }
+        const finalTitle = (job && job.status === 'done' && job.title) ? job.title : titleData.title;
+        console.log('[TitleHandler] Received title:', finalTitle);
+        return finalTitle || null;
     } catch (error) {
         console.error('[TitleHandler] Error during title generation request:', error);
         return null;
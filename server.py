@@ -8,13 +8,38 @@ import re
 import signal
 import time
 import threading
+import asyncio
+import codecs
+import io
+import sys
+import urllib.parse
+import sqlite3
+import hashlib
+import base64
+import math
+import socket
+import uuid
+import itertools
+import fnmatch
+import queue
+import select
+import struct
+import errno
+import ctypes
+import ctypes.util
+import atexit
+import shutil
+import string
 import psutil
-from threading import Lock
+from threading import Lock, Condition
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 from flask_cors import CORS
 import logging
 
 app = Flask(__name__, static_folder='.', static_url_path='')
-CORS(app, resources={r"/*": {"origins": "*"}})
+CORS_EXPOSE_HEADERS = ["X-Stream-Id"]  # те же заголовки отдает AsyncStreamingServer для своих маршрутов
+CORS(app, resources={r"/*": {"origins": "*"}}, expose_headers=CORS_EXPOSE_HEADERS)
 
  
 CHATS_DIR = "chats"
@@ -62,92 +87,1296 @@ file_handler.setLevel(logging.INFO)
 app.logger.setLevel(logging.INFO) # Ensure the app logger itself processes INFO level messages
 app.logger.addHandler(file_handler)
 
+
+class OllamaStream:
+    """Потоковый ответ Ollama, удерживающий слот пула до закрытия"""
+
+    def __init__(self, client, response):
+        self.client = client
+        self.response = response
+        self._closed = False
+
+    @property
+    def status(self):
+        return self.response.status_code
+
+    def read_body(self):
+        """Тело ответа целиком (для ответов с ошибкой); iter_lines() после этого отдает его же"""
+        return self.response.content
+
+    def iter_lines(self):
+        try:
+            for line in self.response.iter_lines():
+                if line:
+                    yield line
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.response.close()
+        finally:
+            self.client._release()
+
+    def abort(self):
+        """Обрывает соединение из другого потока: блокирующее чтение в iter_lines() сразу завершится
+        ошибкой, а Ollama увидит разрыв и остановит генерацию"""
+        raw = self.response.raw
+        sock = getattr(getattr(raw, '_connection', None), 'sock', None)
+        if sock is None:
+            fp = getattr(getattr(raw, '_fp', None), 'fp', None)
+            sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class OllamaClient:
+    """Общий HTTP-клиент Ollama: пул keep-alive соединений, таймауты и повторы"""
+
+    # (connect, read) таймауты по типу запроса; для стрима read - пауза между чанками
+    DEFAULT_TIMEOUTS = {
+        'chat': (5, 120),
+        'chat_stream': (5, 120),
+        'title': (5, 60),
+        'tags': (5, 10),
+        'show': (5, 10),
+    }
+
+    def __init__(self, base_url, pool_size=16, max_retries=2, retry_backoff=0.5,
+                 pool_timeout=30, timeouts=None):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.pool_timeout = pool_timeout
+        self.timeouts = dict(self.DEFAULT_TIMEOUTS)
+        for endpoint, value in (timeouts or {}).items():
+            self.timeouts[endpoint] = tuple(value) if isinstance(value, (list, tuple)) else value
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._adapter = adapter
+
+        # Семафор ограничивает число одновременно занятых соединений размером пула
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._stats_lock = Lock()
+        self._counters = {
+            'requests': 0,
+            'active': 0,
+            'waiting': 0,
+            'retries': 0,
+            'errors': 0,
+            'pool_timeouts': 0,
+        }
+
+    def _count(self, key, delta=1):
+        with self._stats_lock:
+            self._counters[key] += delta
+
+    def _acquire(self):
+        self._count('waiting')
+        try:
+            acquired = self._slots.acquire(timeout=self.pool_timeout)
+        finally:
+            self._count('waiting', -1)
+        if not acquired:
+            self._count('pool_timeouts')
+            raise requests.exceptions.ConnectionError(
+                f"Ollama connection pool exhausted ({self.pool_size} connections busy for {self.pool_timeout}s)")
+        self._count('active')
+
+    def _release(self):
+        self._count('active', -1)
+        self._slots.release()
+
+    def post(self, path, payload, endpoint='chat', stream=False):
+        """POST к Ollama с повтором при ошибках соединения. При stream=True возвращает OllamaStream."""
+        url = f"{self.base_url}{path}"
+        timeout = self.timeouts.get(endpoint, self.DEFAULT_TIMEOUTS['chat'])
+        self._acquire()
+        released = False
+        try:
+            attempt = 0
+            while True:
+                self._count('requests')
+                try:
+                    resp = self.session.post(url, json=payload, stream=stream, timeout=timeout)
+                    break
+                except requests.exceptions.ConnectionError as e:
+                    if attempt >= self.max_retries:
+                        self._count('errors')
+                        raise
+                    delay = self.retry_backoff * (2 ** attempt)
+                    attempt += 1
+                    self._count('retries')
+                    app.logger.warning(f"OllamaClient: connection error on {path} ({e}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                    time.sleep(delay)
+                except requests.exceptions.RequestException:
+                    self._count('errors')
+                    raise
+            if stream:
+                released = True
+                return OllamaStream(self, resp)
+            return resp
+        finally:
+            if not released:
+                self._release()
+
+    def chat(self, payload, endpoint='chat'):
+        return self.post('/api/chat', payload, endpoint=endpoint)
+
+    def chat_stream(self, payload, endpoint='chat_stream'):
+        return self.post('/api/chat', payload, endpoint=endpoint, stream=True)
+
+    def show(self, model):
+        """Сведения о модели (/api/show): параметры Modelfile, model_info"""
+        resp = self.post('/api/show', {"model": model, "name": model}, endpoint='show')
+        resp.raise_for_status()
+        return resp.json()
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self._counters)
+        data['pool_size'] = self.pool_size
+        pools = []
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                'host': f"{pool.host}:{pool.port}",
+                'connections_opened': pool.num_connections,
+                'requests_sent': pool.num_requests,
+                'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+            })
+        data['pools'] = pools
+        return data
+
+
+ollama_client = OllamaClient(
+    OLLAMA_API,
+    pool_size=int(settings.get("ollama_pool_size", 16)),
+    max_retries=int(settings.get("ollama_max_retries", 2)),
+    retry_backoff=float(settings.get("ollama_retry_backoff", 0.5)),
+    pool_timeout=float(settings.get("ollama_pool_timeout", 30)),
+    timeouts=settings.get("ollama_timeouts"),
+)
+
+
+class SchedulerQueueFull(Exception):
+    """Очередь модели переполнена: запрос отклоняется (HTTP 429) с позицией и оценкой ожидания"""
+
+    def __init__(self, model, priority, position, eta):
+        super().__init__(f"Очередь модели {model} переполнена ({priority}): позиция {position}, ожидание ~{eta} с")
+        self.model = model
+        self.priority = priority
+        self.position = position
+        self.eta = eta
+
+    def to_dict(self):
+        return {"error": str(self), "model": self.model, "priority": self.priority,
+                "queue_position": self.position, "eta": self.eta}
+
+
+def queue_full_response(e):
+    response = jsonify(e.to_dict())
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, int(e.eta + 0.5)))
+    return response
+
+
+class SchedulerTicket:
+    """Место в очереди модели. Слот выдается вызовом callback-ов, поэтому ждать можно и из потока
+    (wait), и из asyncio (wait_async)"""
+
+    def __init__(self, scheduler, model, priority, seq):
+        self.scheduler = scheduler
+        self.model = model
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = time.time()
+        self.granted_at = None
+        self.released = False
+        self._event = threading.Event()
+        self._callbacks = []
+        self._future = None
+
+    @property
+    def granted(self):
+        return self._event.is_set()
+
+    def _grant(self):
+        # Вызывается под блокировкой планировщика
+        self.granted_at = time.time()
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def wait(self, timeout=None):
+        """Ждет слот; False, если время вышло"""
+        return self._event.wait(timeout)
+
+    async def wait_async(self, timeout=None):
+        if self.granted:
+            return True
+        if self._future is None:
+            loop = asyncio.get_running_loop()
+            future = self._future = loop.create_future()
+
+            def wake():
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+            self.scheduler._on_grant(self, wake)
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._future), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    def position(self):
+        return self.scheduler.position(self)
+
+    def release(self):
+        """Возвращает слот (или снимает ожидание с очереди); повторный вызов ничего не делает"""
+        self.scheduler._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class OllamaScheduler:
+    """Планировщик запросов к Ollama: ограничение одновременных генераций на модель, приоритет
+    интерактивных запросов над фоновыми (заголовки) и ограниченные очереди с отказом 429"""
+
+    PRIORITIES = {'interactive': 0, 'background': 1}
+
+    def __init__(self, concurrency=2, model_concurrency=None, max_queue=None, service_time=10.0):
+        self.concurrency = concurrency
+        self.model_concurrency = dict(model_concurrency or {})
+        self.max_queue = {'interactive': 32, 'background': 8}
+        self.max_queue.update(max_queue or {})
+        self.initial_service_time = service_time
+        self._models = {}
+        self._lock = Lock()
+        self._seq = 0
+
+    def _state(self, model):
+        state = self._models.get(model)
+        if state is None:
+            state = self._models[model] = {
+                'active': 0,
+                'waiting': [],
+                'service_time': self.initial_service_time,
+                'admitted': 0,
+                'rejected': 0,
+                'completed': 0,
+                'abandoned': 0,
+                'max_queue_depth': 0,
+            }
+        return state
+
+    def limit_for(self, model):
+        return int(self.model_concurrency.get(model, self.concurrency))
+
+    def _eta(self, model, state, ahead):
+        limit = max(1, self.limit_for(model))
+        return round(state['service_time'] * (ahead // limit + (1 if state['active'] >= limit else 0)), 1)
+
+    def submit(self, model, priority='interactive'):
+        """Ставит запрос в очередь модели. Слот выдается сразу, если модель свободна и никто не ждет
+        с тем же или более высоким приоритетом; иначе тикет ждет. SchedulerQueueFull - очередь полна."""
+        rank = self.PRIORITIES[priority]
+        with self._lock:
+            state = self._state(model)
+            self._seq += 1
+            ticket = SchedulerTicket(self, model, priority, self._seq)
+            ahead = sum(1 for t in state['waiting'] if self.PRIORITIES[t.priority] <= rank)
+            if state['active'] < self.limit_for(model) and ahead == 0:
+                state['active'] += 1
+                state['admitted'] += 1
+                ticket._grant()
+                return ticket
+            queued = sum(1 for t in state['waiting'] if t.priority == priority)
+            if queued >= self.max_queue.get(priority, 0):
+                state['rejected'] += 1
+                raise SchedulerQueueFull(model, priority, ahead + 1, self._eta(model, state, ahead))
+            state['waiting'].append(ticket)
+            state['waiting'].sort(key=lambda t: (self.PRIORITIES[t.priority], t.seq))
+            state['max_queue_depth'] = max(state['max_queue_depth'], len(state['waiting']))
+            return ticket
+
+    def position(self, ticket):
+        """(позиция в очереди с 1, оценка ожидания в секундах); (0, 0) для выданного слота"""
+        with self._lock:
+            state = self._state(ticket.model)
+            if ticket not in state['waiting']:
+                return 0, 0
+            ahead = state['waiting'].index(ticket)
+            return ahead + 1, self._eta(ticket.model, state, ahead)
+
+    def _on_grant(self, ticket, callback):
+        with self._lock:
+            if ticket.granted:
+                run_now = True
+            else:
+                ticket._callbacks.append(callback)
+                run_now = False
+        if run_now:
+            callback()
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            state = self._state(ticket.model)
+            if not ticket.granted:
+                state['waiting'].remove(ticket)
+                state['abandoned'] += 1
+                return
+            state['active'] -= 1
+            state['completed'] += 1
+            # Скользящее среднее времени генерации - основа оценки ожидания
+            state['service_time'] = 0.8 * state['service_time'] + 0.2 * (time.time() - ticket.granted_at)
+            limit = self.limit_for(ticket.model)
+            while state['waiting'] and state['active'] < limit:
+                waiter = state['waiting'].pop(0)
+                state['active'] += 1
+                state['admitted'] += 1
+                waiter._grant()
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for model, state in self._models.items():
+                queued = {name: 0 for name in self.PRIORITIES}
+                for ticket in state['waiting']:
+                    queued[ticket.priority] += 1
+                data = {k: v for k, v in state.items() if k != 'waiting'}
+                data['service_time'] = round(state['service_time'], 2)
+                data['concurrency'] = self.limit_for(model)
+                data['queued'] = queued
+                models[model] = data
+        return {"concurrency": self.concurrency, "max_queue": dict(self.max_queue), "models": models}
+
+
+ollama_scheduler = OllamaScheduler(
+    concurrency=int(settings.get("scheduler_concurrency", 2)),
+    model_concurrency=settings.get("scheduler_model_concurrency"),
+    max_queue=settings.get("scheduler_max_queue"),
+)
+SCHEDULER_WAIT_TIMEOUT = float(settings.get("scheduler_wait_timeout", 300))
+
+
+def scheduled_chat(payload, priority='interactive', endpoint='chat'):
+    """Непотоковый /api/chat через планировщик: ждет слот модели и держит его до получения ответа"""
+    with ollama_scheduler.submit(payload['model'], priority) as ticket:
+        if not ticket.wait(SCHEDULER_WAIT_TIMEOUT):
+            position, eta = ticket.position()
+            raise SchedulerQueueFull(payload['model'], priority, position, eta)
+        return ollama_client.chat(payload, endpoint=endpoint)
+
+class ChatStore:
+    """Хранилище чатов в SQLite: метаданные чата и каждое сообщение отдельной строкой"""
+
+    SCHEMA_VERSION = 2
+    INDEX_SORT_COLUMNS = ('updated_at', 'created_at', 'title', 'message_count', 'size_bytes', 'id')
+    TITLE_FIELDS = ('chatnamess', 'titleGenerated', 'titleSource')
+    AUTO_TITLE_SOURCES = ('local', 'llm')  # заголовки, которые сервер пишет сам; 'user' - переименование
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self.deferred = None  # WriteBehind для put_chat_deferred(), см. enable_write_behind()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False  # база создается при первом обращении, а не при импорте модуля
+
+    def enable_write_behind(self, delay):
+        """PUT чата целиком откладывается: в памяти - последняя версия, в базу - пачкой раз в delay секунд"""
+        self.deferred = WriteBehind(self._put_batch, delay=delay, name='chat-writes')
+
+    def _settle(self, chat_id=None):
+        """Перед чтением или изменением чата другим путем его отложенный PUT (без chat_id - все) записывается"""
+        if self.deferred is not None:
+            self.deferred.flush(None if chat_id is None else [chat_id])
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            if not self._schema_ready:
+                with self._schema_lock:
+                    if not self._schema_ready:
+                        self._init_schema()
+                        self._schema_ready = True
+        return conn
+
+    def _transaction(self):
+        return _SqliteTransaction(self._conn())
+
+    def _init_schema(self):
+        with self._transaction() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                conn.execute("""CREATE TABLE IF NOT EXISTS chats (
+                    id TEXT PRIMARY KEY,
+                    meta TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL)""")
+                conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                    chat_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, idx)) WITHOUT ROWID""")
+            if version < 2:
+                # Индекс чатов для боковой панели: метаданные хранятся колонками, а не парсятся из JSON
+                conn.execute('ALTER TABLE messages ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+                conn.execute('UPDATE messages SET size = length(CAST(data AS BLOB))')
+                for column in ("title TEXT NOT NULL DEFAULT ''", "model TEXT NOT NULL DEFAULT ''",
+                               "preview TEXT NOT NULL DEFAULT ''", 'title_generated INTEGER NOT NULL DEFAULT 0',
+                               'message_count INTEGER NOT NULL DEFAULT 0', 'size_bytes INTEGER NOT NULL DEFAULT 0'):
+                    conn.execute(f'ALTER TABLE chats ADD COLUMN {column}')
+                for column in self.INDEX_SORT_COLUMNS:
+                    if column != 'id':
+                        conn.execute(f'CREATE INDEX IF NOT EXISTS chats_by_{column} ON chats ({column}, id)')
+                conn.execute('CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+                conn.execute("INSERT OR IGNORE INTO store_info (key, value) VALUES ('index_version', 0)")
+                for (chat_id,) in conn.execute('SELECT id FROM chats').fetchall():
+                    self._refresh_index(conn, chat_id)
+            conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+    def _refresh_index(self, conn, chat_id, meta=None, preview=True):
+        """Пересчитывает индексные колонки чата (без разбора истории, кроме поиска первого сообщения пользователя)"""
+        if meta is None:
+            meta = json.loads(conn.execute('SELECT meta FROM chats WHERE id = ?', (chat_id,)).fetchone()[0])
+        count, size = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages WHERE chat_id = ?', (chat_id,)).fetchone()
+        models = meta.get('modelhs') or []
+        model = models[-1] if isinstance(models, list) and models else meta.get('model') or ''
+        meta_text = self._dump(meta)
+        conn.execute(
+            'UPDATE chats SET title = ?, model = ?, title_generated = ?, message_count = ?, size_bytes = ? WHERE id = ?',
+            (str(meta.get('chatnamess') or ''), str(model), 1 if meta.get('titleGenerated') else 0,
+             count, size + len(meta_text.encode('utf-8')), chat_id))
+        if preview:
+            text = ''
+            for (data,) in conn.execute('SELECT data FROM messages WHERE chat_id = ? ORDER BY idx', (chat_id,)):
+                message = json.loads(data)
+                if str(message.get('role', '')).lower() == 'user':
+                    text = (message.get('display') or message.get('content') or '').strip()[:200]
+                    break
+            conn.execute('UPDATE chats SET preview = ? WHERE id = ?', (text, chat_id))
+        self._bump_version(conn)
+
+    @staticmethod
+    def _bump_version(conn):
+        conn.execute("UPDATE store_info SET value = value + 1 WHERE key = 'index_version'")
+
+    def index_version(self):
+        """Версия индекса для ETag: версия базы и счетчик отложенных PUT. Отложенные записи не сбрасываются -
+        иначе опрос боковой панели сводил бы на нет склейку записей WriteBehind."""
+        stored = self._conn().execute("SELECT value FROM store_info WHERE key = 'index_version'").fetchone()[0]
+        return f"{stored}.{self.deferred.version if self.deferred is not None else 0}"
+
+    def list_index(self, sort='updated_at', order='desc', limit=50, cursor=None):
+        """Страница индекса чатов с keyset-пагинацией; возвращает (записи, следующий курсор, всего)"""
+        if sort not in self.INDEX_SORT_COLUMNS:
+            raise ValueError(f"Unsupported sort column: {sort}")
+        descending = order != 'asc'
+        direction = 'DESC' if descending else 'ASC'
+        where, params = '', []
+        if cursor:
+            value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            if sort == 'id':
+                where, params = f"WHERE id {'<' if descending else '>'} ?", [last_id]
+            else:
+                where, params = f"WHERE ({sort}, id) {'<' if descending else '>'} (?, ?)", [value, last_id]
+        conn = self._conn()
+        query = ('SELECT id, title, model, preview, title_generated, message_count, size_bytes, created_at, updated_at '
+                 f'FROM chats {where} ORDER BY {sort} {direction}, id {direction} LIMIT ?')
+        rows = conn.execute(query, params + [limit + 1]).fetchall()
+        # Записываются только отложенные PUT чатов этой страницы; остальные (и новые чаты) появятся
+        # в индексе после своей записи - версия индекса при этом сменится
+        if self.deferred is not None and self.deferred.flush([row[0] for row in rows[:limit]]):
+            rows = conn.execute(query, params + [limit + 1]).fetchall()
+        entries = [{
+            'id': row[0],
+            'title': row[1],
+            'model': row[2],
+            'preview': row[3],
+            'titleGenerated': bool(row[4]),
+            'message_count': row[5],
+            'size_bytes': row[6],
+            'created_at': row[7],
+            'updated_at': row[8],
+        } for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = entries[-1]
+            next_cursor = base64.urlsafe_b64encode(json.dumps([last[sort], last['id']]).encode()).decode('ascii')
+        total = conn.execute('SELECT COUNT(*) FROM chats').fetchone()[0]
+        return entries, next_cursor, total
+
+    @staticmethod
+    def _dump(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+    @staticmethod
+    def _digest(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _split(chat_id, chat):
+        meta = {k: v for k, v in chat.items() if k != 'history'}
+        meta['id'] = chat_id
+        history = chat.get('history') or []
+        return meta, history
+
+    def list_ids(self):
+        self._settle()
+        rows = self._conn().execute('SELECT id FROM chats ORDER BY created_at, id').fetchall()
+        return [row[0] for row in rows]
+
+    def exists(self, chat_id):
+        self._settle(chat_id)
+        return self._conn().execute('SELECT 1 FROM chats WHERE id = ?', (chat_id,)).fetchone() is not None
+
+    def get_meta(self, chat_id):
+        """Поля чата без истории (сообщения не читаются) или None, если чата нет"""
+        self._settle(chat_id)
+        row = self._conn().execute('SELECT meta FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_chat(self, chat_id):
+        self._settle(chat_id)
+        conn = self._conn()
+        row = conn.execute('SELECT meta FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        if row is None:
+            return None
+        chat = json.loads(row[0])
+        rows = conn.execute('SELECT data FROM messages WHERE chat_id = ? ORDER BY idx', (chat_id,)).fetchall()
+        chat['history'] = [json.loads(r[0]) for r in rows]
+        return chat
+
+    def get_chat_window(self, chat_id, tail=None, after=None, before=None, limit=None, max_bytes=None):
+        """Чат с частью истории: последние N сообщений, сообщения после/до индекса или окно по размеру в байтах.
+        Читаются только нужные строки, полная история не разбирается."""
+        self._settle(chat_id)
+        conn = self._conn()
+        row = conn.execute('SELECT meta, message_count FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        if row is None:
+            return None
+        chat = json.loads(row[0])
+        total = row[1]
+
+        conditions, params = ['chat_id = ?'], [chat_id]
+        if after is not None:
+            conditions.append('idx > ?')
+            params.append(after)
+        if before is not None:
+            conditions.append('idx < ?')
+            params.append(before)
+        where = ' AND '.join(conditions)
+        # Окно растет от начала только при явном after без before; иначе - от конца (хвост)
+        from_start = after is not None and before is None and tail is None
+        direction = 'ASC' if from_start else 'DESC'
+        count = tail if tail is not None else limit
+
+        sql = f'SELECT idx, size FROM messages WHERE {where} ORDER BY idx {direction}'
+        sql_params = list(params)
+        if count is not None:
+            sql += ' LIMIT ?'
+            sql_params.append(count)
+        indexes = []
+        used = 0
+        for idx, size in conn.execute(sql, sql_params):
+            if max_bytes is not None and indexes and used + size > max_bytes:
+                break
+            indexes.append(idx)
+            used += size
+
+        history = []
+        if indexes:
+            lo, hi = min(indexes), max(indexes)
+            rows = conn.execute('SELECT data FROM messages WHERE chat_id = ? AND idx BETWEEN ? AND ? ORDER BY idx',
+                                (chat_id, lo, hi)).fetchall()
+            history = [json.loads(r[0]) for r in rows]
+            chat['history_offset'] = lo
+        else:
+            chat['history_offset'] = min(after + 1, total) if after is not None else total
+        chat['history'] = history
+        chat['history_total'] = total
+        return chat
+
+    def put_chat(self, chat_id, chat, created_at=None):
+        """Сохраняет чат целиком, переписывая только изменившиеся сообщения"""
+        self._settle(chat_id)
+        with self._transaction() as conn:
+            return self._put(conn, chat_id, chat, created_at)
+
+    def put_chat_deferred(self, chat_id, chat):
+        """PUT /chats/<id>: запись откладывается и склеивается с последующими PUT того же чата"""
+        if self.deferred is None:
+            return self.put_chat(chat_id, chat)
+        self.deferred.submit(chat_id, chat)
+
+    def pending_chat(self, chat_id):
+        """Еще не записанная версия чата из put_chat_deferred() или None"""
+        if self.deferred is None:
+            return None
+        found, chat = self.deferred.get(chat_id)
+        if not found:
+            return None
+        row = self._conn().execute('SELECT meta FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        return self._keep_title(json.loads(row[0]) if row else None, dict(chat, id=chat_id))
+
+    def _put_batch(self, items):
+        with self._transaction() as conn:
+            for chat_id, chat in items:
+                self._put(conn, chat_id, chat)
+
+    @classmethod
+    def _keep_title(cls, stored, meta):
+        """Заголовок, записанный сервером, не откатывается PUT с устаревшей копией клиента:
+        поля заголовка из PUT применяются, только если это переименование (titleSource 'user')"""
+        if stored and stored.get('titleSource') and meta.get('titleSource') != 'user':
+            for key in cls.TITLE_FIELDS:
+                if key in stored:
+                    meta[key] = stored[key]
+                else:
+                    meta.pop(key, None)
+        return meta
+
+    def _put(self, conn, chat_id, chat, created_at=None):
+        meta, history = self._split(chat_id, chat)
+        row = conn.execute('SELECT meta FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        meta = self._keep_title(json.loads(row[0]) if row else None, meta)
+        now = time.time()
+        conn.execute(
+            'INSERT INTO chats (id, meta, created_at, updated_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET meta = excluded.meta, updated_at = excluded.updated_at',
+            (chat_id, self._dump(meta), created_at or now, now))
+        stored = dict(conn.execute('SELECT idx, digest FROM messages WHERE chat_id = ?', (chat_id,)).fetchall())
+        changed = []
+        for idx, message in enumerate(history):
+            text = self._dump(message)
+            digest = self._digest(text)
+            if stored.get(idx) != digest:
+                changed.append((chat_id, idx, text, digest, len(text.encode('utf-8'))))
+        if changed:
+            conn.executemany(
+                'INSERT OR REPLACE INTO messages (chat_id, idx, data, digest, size) VALUES (?, ?, ?, ?, ?)', changed)
+        if len(stored) > len(history):
+            conn.execute('DELETE FROM messages WHERE chat_id = ? AND idx >= ?', (chat_id, len(history)))
+        self._refresh_index(conn, chat_id, meta)
+        return len(changed)
+
+    def append_messages(self, chat_id, messages):
+        """Дописывает сообщения в конец истории; возвращает новое число сообщений или None, если чата нет"""
+        self._settle(chat_id)
+        with self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM chats WHERE id = ?', (chat_id,)).fetchone() is None:
+                return None
+            count = conn.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+            rows = []
+            for offset, message in enumerate(messages):
+                text = self._dump(message)
+                rows.append((chat_id, count + offset, text, self._digest(text), len(text.encode('utf-8'))))
+            conn.executemany('INSERT INTO messages (chat_id, idx, data, digest, size) VALUES (?, ?, ?, ?, ?)', rows)
+            conn.execute('UPDATE chats SET updated_at = ? WHERE id = ?', (time.time(), chat_id))
+            self._refresh_index(conn, chat_id, preview=count == 0)
+        return count + len(rows)
+
+    def set_message(self, chat_id, index, message):
+        """Записывает сообщение в позицию index (None - в конец) и удаляет все сообщения после нее:
+        новый ход, правка сообщения или перегенерация. Возвращает новое число сообщений или None, если чата нет."""
+        self._settle(chat_id)
+        with self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM chats WHERE id = ?', (chat_id,)).fetchone() is None:
+                return None
+            count = conn.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+            if index is None:
+                index = count
+            if index < 0 or index > count:
+                raise ValueError(f"Message index {index} is out of range (chat has {count} messages)")
+            text = self._dump(message)
+            conn.execute('INSERT OR REPLACE INTO messages (chat_id, idx, data, digest, size) VALUES (?, ?, ?, ?, ?)',
+                         (chat_id, index, text, self._digest(text), len(text.encode('utf-8'))))
+            conn.execute('DELETE FROM messages WHERE chat_id = ? AND idx > ?', (chat_id, index))
+            conn.execute('UPDATE chats SET updated_at = ? WHERE id = ?', (time.time(), chat_id))
+            self._refresh_index(conn, chat_id, preview=index == 0 or count == 0)
+        return index + 1
+
+    def patch_message(self, chat_id, index, fields):
+        """Обновляет поля одного сообщения (None удаляет поле). Отрицательный индекс - с конца."""
+        self._settle(chat_id)
+        with self._transaction() as conn:
+            if index < 0:
+                count = conn.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+                index += count
+            row = conn.execute('SELECT data FROM messages WHERE chat_id = ? AND idx = ?', (chat_id, index)).fetchone()
+            if row is None:
+                return None
+            message = json.loads(row[0])
+            for key, value in fields.items():
+                if value is None:
+                    message.pop(key, None)
+                else:
+                    message[key] = value
+            text = self._dump(message)
+            conn.execute('UPDATE messages SET data = ?, digest = ?, size = ? WHERE chat_id = ? AND idx = ?',
+                         (text, self._digest(text), len(text.encode('utf-8')), chat_id, index))
+            conn.execute('UPDATE chats SET updated_at = ? WHERE id = ?', (time.time(), chat_id))
+            self._refresh_index(conn, chat_id)
+        return message
+
+    def write_messages(self, items):
+        """Записывает сообщения [(chat_id, index, message)] одной транзакцией (чекпойнты ответов).
+        Сообщения удаленных чатов и индексы за концом истории пропускаются. Возвращает число записанных."""
+        for chat_id in {item[0] for item in items}:
+            self._settle(chat_id)
+        written = 0
+        with self._transaction() as conn:
+            for chat_id, index, message in items:
+                if conn.execute('SELECT 1 FROM chats WHERE id = ?', (chat_id,)).fetchone() is None:
+                    continue
+                count = conn.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ?', (chat_id,)).fetchone()[0]
+                if index > count:
+                    continue
+                text = self._dump(message)
+                conn.execute('INSERT OR REPLACE INTO messages (chat_id, idx, data, digest, size) VALUES (?, ?, ?, ?, ?)',
+                             (chat_id, index, text, self._digest(text), len(text.encode('utf-8'))))
+                conn.execute('UPDATE chats SET updated_at = ? WHERE id = ?', (time.time(), chat_id))
+                self._refresh_index(conn, chat_id, preview=count == 0)
+                written += 1
+        return written
+
+    def update_meta(self, chat_id, fields):
+        """Обновляет поля чата (кроме истории). None удаляет поле."""
+        self._settle(chat_id)
+        with self._transaction() as conn:
+            row = conn.execute('SELECT meta FROM chats WHERE id = ?', (chat_id,)).fetchone()
+            if row is None:
+                return None
+            meta = json.loads(row[0])
+            for key, value in fields.items():
+                if key in ('id', 'history'):
+                    continue
+                if value is None:
+                    meta.pop(key, None)
+                else:
+                    meta[key] = value
+            conn.execute('UPDATE chats SET meta = ?, updated_at = ? WHERE id = ?', (self._dump(meta), time.time(), chat_id))
+            self._refresh_index(conn, chat_id, meta, preview=False)
+        return meta
+
+    def set_auto_title(self, chat_id, title, source):
+        """Записывает заголовок, созданный сервером ('local' или 'llm'), если пользователь не переименовал
+        чат; локальный заголовок не заменяет LLM-заголовок. Возвращает True, если заголовок записан."""
+        self._settle(chat_id)
+        with self._transaction() as conn:
+            row = conn.execute('SELECT meta FROM chats WHERE id = ?', (chat_id,)).fetchone()
+            if row is None:
+                return False
+            meta = json.loads(row[0])
+            current = meta.get('titleSource')
+            if current is not None and current not in self.AUTO_TITLE_SOURCES:
+                return False
+            if source == 'local' and current == 'llm':
+                return False
+            meta.update({"chatnamess": title, "titleGenerated": True, "titleSource": source})
+            conn.execute('UPDATE chats SET meta = ?, updated_at = ? WHERE id = ?', (self._dump(meta), time.time(), chat_id))
+            self._refresh_index(conn, chat_id, meta, preview=False)
+        return True
+
+    def delete_chat(self, chat_id):
+        self._settle(chat_id)
+        with self._transaction() as conn:
+            deleted = conn.execute('DELETE FROM chats WHERE id = ?', (chat_id,)).rowcount
+            conn.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            self._bump_version(conn)
+        return deleted > 0
+
+    def migrate_json_files(self, json_dir):
+        """Переносит старые chats/<id>.json в базу (при запуске сервера, см. __main__). Файлы не трогаются:
+        перенесенные запоминаются в store_info и не переносятся повторно, даже если чат потом удален."""
+        migrated = 0
+        for name in sorted(os.listdir(json_dir)):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(json_dir, name)
+            chat_id = name[:-len('.json')]
+            key = f'migrated:{name}'
+            try:
+                self._settle(chat_id)
+                with self._transaction() as conn:
+                    if conn.execute('SELECT 1 FROM store_info WHERE key = ?', (key,)).fetchone() is not None:
+                        continue
+                    if conn.execute('SELECT 1 FROM chats WHERE id = ?', (chat_id,)).fetchone() is None:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            chat = json.load(f)
+                        self._put(conn, chat_id, chat, created_at=os.path.getmtime(path))
+                    conn.execute('INSERT INTO store_info (key, value) VALUES (?, ?)', (key, int(time.time())))
+                migrated += 1
+            except Exception as e:
+                app.logger.error(f"ChatStore: failed to migrate {path}: {e}")
+        if migrated:
+            app.logger.info(f"ChatStore: migrated {migrated} chat file(s) from {json_dir}")
+        return migrated
+
+
+class _SqliteTransaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK для соединения в autocommit-режиме"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
+
+
+class WriteBehind:
+    """Отложенная запись: по каждому ключу в памяти хранится только последняя версия, фоновый поток
+    через delay секунд после первой записи отдает все накопленное одним вызовом write_batch
+    (одна транзакция SQLite на пачку). flush() пишет немедленно; при выходе процесса вызывается сам."""
+
+    def __init__(self, write_batch, delay=0.5, name='write-behind'):
+        self.write_batch = write_batch
+        self.delay = delay
+        self.name = name
+        self._pending = OrderedDict()
+        self._inflight = set()  # ключи пачки, которая пишется прямо сейчас
+        self._lock = Lock()
+        self._flush_lock = Lock()  # пачки пишутся строго по очереди: старая версия не перезапишет новую
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._counters = {'submitted': 0, 'coalesced': 0, 'batches': 0, 'written': 0, 'errors': 0}
+        self.version = 0  # растет с каждым submit(): по нему видно, что накопленное изменилось
+        atexit.register(self.flush)
+
+    def submit(self, key, value):
+        with self._lock:
+            self.version += 1
+            self._counters['submitted'] += 1
+            if key in self._pending:
+                self._counters['coalesced'] += 1
+            self._pending[key] = value
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def get(self, key):
+        """Еще не записанная версия -> (True, значение), иначе (False, None)"""
+        with self._lock:
+            if key in self._pending:
+                return True, self._pending[key]
+        return False, None
+
+    def flush(self, keys=None):
+        """Записывает накопленное (только keys, если заданы) и возвращает число записанных значений.
+        Возвращается после того, как эти ключи записаны, даже если их пишет фоновый поток."""
+        if keys is not None:
+            with self._lock:
+                if not any(key in self._pending or key in self._inflight for key in keys):
+                    return 0
+        with self._flush_lock:
+            with self._lock:
+                if keys is None:
+                    batch, self._pending = self._pending, OrderedDict()
+                else:
+                    batch = OrderedDict((key, self._pending.pop(key)) for key in keys if key in self._pending)
+                self._inflight = set(batch)
+            if not batch:
+                return 0
+            try:
+                self.write_batch(list(batch.items()))
+            except Exception as e:
+                # Пачка возвращается в очередь (если ключ не обновили заново) и повторится со следующей
+                with self._lock:
+                    self._counters['errors'] += 1
+                    for key, value in batch.items():
+                        self._pending.setdefault(key, value)
+                self._wakeup.set()
+                app.logger.error(f"{self.name}: write failed, will retry: {e}", exc_info=True)
+                return 0
+            finally:
+                with self._lock:
+                    self._inflight = set()
+            with self._lock:
+                self._counters['batches'] += 1
+                self._counters['written'] += len(batch)
+            return len(batch)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            time.sleep(self.delay)  # окно, в котором соседние записи складываются в одну пачку
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+            data['pending'] = len(self._pending)
+        data['delay'] = self.delay
+        return data
+
+
+CHAT_DB_FILE = os.path.join(CHATS_DIR, 'chats.db')
+chat_store = ChatStore(CHAT_DB_FILE)
+chat_store.enable_write_behind(float(settings.get("write_behind_delay", 0.5)))
+
+# Чекпойнты ответов, которые стримятся в session-режиме: ключ (chat_id, индекс ответа)
+reply_checkpoints = WriteBehind(
+    lambda items: chat_store.write_messages([(chat_id, index, message) for (chat_id, index), message in items]),
+    delay=float(settings.get("write_behind_delay", 0.5)), name='reply-checkpoints')
+REPLY_CHECKPOINT_TOKENS = int(settings.get("reply_checkpoint_tokens", 64))
+REPLY_CHECKPOINT_INTERVAL = float(settings.get("reply_checkpoint_interval", 2.0))
+
 @app.route('/')
 def index():
     return send_from_directory('.', 'index3.html')
 
 @app.route('/chats', methods=['GET'])
 def list_chats():
+    """Список чатов. Без параметров - только ID (как раньше); с view=index - страница индекса с метаданными.
+    Ответ помечается ETag по версии индекса, повторный запрос с If-None-Match получает 304."""
     try:
-        chats = [f.replace(".json", "") for f in os.listdir(CHATS_DIR) if f.endswith(".json")]
-        return jsonify(chats)
+        args = request.args
+        query_digest = hashlib.sha1(request.query_string).hexdigest()[:12]
+        tag = f"chats-{chat_store.index_version()}-{query_digest}"
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+        elif args.get('view') == 'index' or any(k in args for k in ('sort', 'order', 'limit', 'cursor')):
+            try:
+                limit = max(1, min(int(args.get('limit', 50)), 500))
+                entries, next_cursor, total = chat_store.list_index(
+                    sort=args.get('sort', 'updated_at'), order=args.get('order', 'desc'),
+                    limit=limit, cursor=args.get('cursor'))
+            except (ValueError, TypeError) as e:
+                return jsonify({"error": str(e)}), 400
+            response = jsonify({"chats": entries, "next_cursor": next_cursor, "total": total})
+        else:
+            response = jsonify(chat_store.list_ids())
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/chats/<chat_id>', methods=['GET', 'PUT'])
+@app.route('/chats/<chat_id>', methods=['GET', 'PUT', 'PATCH'])
 def chat_handler(chat_id):
      
-     
-    chat_file = os.path.join(CHATS_DIR, f"{chat_id}.json")
     if request.method == 'GET':
         try:
-            if os.path.exists(chat_file):
-                with open(chat_file, 'r', encoding='utf-8') as f:
-                    chat_data = json.load(f)
+            window_args = ('tail', 'after', 'before', 'limit', 'max_bytes')
+            if any(k in request.args for k in window_args):
+                try:
+                    window = {k: int(request.args[k]) for k in window_args if k in request.args}
+                except ValueError:
+                    return jsonify({"error": "Window parameters must be integers"}), 400
+                if any(v < 0 for k, v in window.items() if k != 'after'):
+                    return jsonify({"error": "Window parameters must not be negative"}), 400
+                chat_data = chat_store.get_chat_window(chat_id, **window)
+            else:
+                # Последний PUT, еще не дошедший до базы, отдается из памяти
+                chat_data = chat_store.pending_chat(chat_id) or chat_store.get_chat(chat_id)
+            if chat_data is not None:
                 return jsonify(chat_data)
             else:
                 return jsonify({"error": "Chat not found"}), 404
         except Exception as e:
             return jsonify({"error": str(e)}), 500
+    elif request.method == 'PATCH':
+        try:
+            fields = dict(request.json or {})
+            if 'chatnamess' in fields and 'titleSource' not in fields:
+                # Переименование: такой заголовок не заменяется автоматически созданным
+                fields.update(titleGenerated=True, titleSource='user')
+            meta = chat_store.update_meta(chat_id, fields)
+            if meta is None:
+                return jsonify({"error": "Chat not found"}), 404
+            return jsonify({"status": "success"})
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
     else:
         try:
             data = request.json
-            with open(chat_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            if not isinstance(data, dict):
+                return jsonify({"error": "Expected chat object"}), 400
+            chat_store.put_chat_deferred(chat_id, data)
             return jsonify({"status": "success"})
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
+@app.route('/chats/<chat_id>/messages', methods=['POST'])
+def append_chat_messages(chat_id):
+    """Добавление сообщений в конец истории без перезаписи всего чата"""
+    try:
+        data = request.json or {}
+        messages = data['messages'] if 'messages' in data else [data.get('message')]
+        if not messages or any(not isinstance(m, dict) for m in messages):
+            return jsonify({"error": "Expected 'message' object or 'messages' list"}), 400
+        count = chat_store.append_messages(chat_id, messages)
+        if count is None:
+            return jsonify({"error": "Chat not found"}), 404
+        return jsonify({"status": "success", "count": count})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/chats/<chat_id>/messages/<index>', methods=['PATCH'])
+def patch_chat_message(chat_id, index):
+    """Изменение полей одного сообщения (индекс может быть отрицательным, -1 - последнее)"""
+    try:
+        try:
+            index = int(index)
+        except ValueError:
+            return jsonify({"error": "Message index must be an integer"}), 400
+        message = chat_store.patch_message(chat_id, index, request.json or {})
+        if message is None:
+            return jsonify({"error": "Message not found"}), 404
+        return jsonify({"status": "success", "message": message})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/delete-chat/<chat_id>', methods=['DELETE'])
 def delete_chat(chat_id):
      
-    chat_file = os.path.join(CHATS_DIR, f"{chat_id}.json")
-    if os.path.exists(chat_file):
-        try:
-            os.remove(chat_file)
+    try:
+        if chat_store.delete_chat(chat_id):
             return jsonify({"status": "success"})
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
-    else:
-        return jsonify({"error": "Chat not found"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"error": "Chat not found"}), 404
 
-@app.route('/generate', methods=['POST'])
-def generate():
-     
-    try:
-        data = request.json
-        if "modelhs" in data:
-            model = data["modelhs"][-1] if data["modelhs"] else current_model
-        else:
-            model = data.get('model', current_model)
-        if "history" in data:
-            messages = data["history"]
-        else:
-            messages = data.get('messages', [])
-        payload = {
-            "model": model,
-            "messages": messages,
-            "stream": False
+class ResponseCache:
+    """Кэш ответов непотокового /generate по содержимому запроса: LRU в памяти с TTL и ограничением
+    объема, при желании - второй уровень на диске. Ответы с temperature > 0 не кэшируются,
+    если клиент явно не попросил (cache: "force")."""
+
+    # Поля payload, не влияющие на ответ модели
+    IGNORED_FIELDS = ('stream', 'keep_alive')
+
+    def __init__(self, ttl=3600, max_entries=512, max_bytes=64 * 1024 * 1024,
+                 disk_dir=None, disk_max_bytes=512 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # ключ -> (истекает, тело JSON в байтах)
+        self._bytes = 0
+        self._disk_bytes = None  # считается лениво при первой записи
+        self._lock = Lock()
+        self._counters = {
+            'hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'bypassed': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expired': 0,
+            'disk_evictions': 0,
         }
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
 
-        options = {}
-        model_temp = settings.get("model_temperature")
-        if model_temp is not None:
+    def key_for(self, payload):
+        data = {k: v for k, v in payload.items() if k not in self.IGNORED_FIELDS}
+        canonical = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def should_cache(self, payload, mode=None):
+        """mode: None - по умолчанию, "force" - кэшировать даже при temperature > 0, False - не кэшировать"""
+        if mode is False or mode == 'off':
+            return False
+        if mode == 'force':
+            return True
+        options = payload.get('options')
+        temperature = options.get('temperature') if isinstance(options, dict) else None
+        try:
+            return temperature is not None and float(temperature) <= 0
+        except (TypeError, ValueError):
+            return False  # некорректную температуру проверит Ollama, кэш для такого запроса не нужен
+
+    def bypass(self):
+        with self._lock:
+            self._counters['bypassed'] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return entry[1]
+                self._drop(key)
+                self._counters['expired'] += 1
+        body = self._disk_get(key, now) if self.disk_dir else None
+        with self._lock:
+            if body is None:
+                self._counters['misses'] += 1
+                return None
+            self._counters['disk_hits'] += 1
+            self._put_memory(key, now + self.ttl, body)
+        return body
+
+    def put(self, key, body):
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._counters['stores'] += 1
+            self._put_memory(key, expires, body)
+        if self.disk_dir:
+            self._disk_put(key, expires, body)
+
+    def _put_memory(self, key, expires, body):
+        if len(body) > self.max_bytes:
+            return
+        self._drop(key)
+        self._entries[key] = (expires, body)
+        self._bytes += len(body)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self._counters['evictions'] += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def _disk_get(self, key, now):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires = float(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires <= now:
             try:
-                options["temperature"] = float(model_temp)
-            except ValueError:
-                app.logger.warning(f"Invalid temperature value in settings: {model_temp}. Using Ollama's default.")
-        
-        if options:
-            payload["options"] = options
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return body
 
-        resp = requests.post(f"{OLLAMA_API}/api/chat", json=payload, timeout=120)
-        return jsonify(resp.json())
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    def _disk_put(self, key, expires, body):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(f"{expires}\n".encode('ascii'))
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            app.logger.warning(f"ResponseCache: failed to write {path}: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            else:
+                self._disk_bytes += len(body)
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self._prune_disk()
 
-@app.route('/generate-stream', methods=['POST'])
-def generate_stream():
+    def _disk_files(self):
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def _prune_disk(self):
+        """Удаляет самые старые файлы, пока дисковый уровень не станет меньше 90% лимита"""
+        files = sorted(self._disk_files(), key=lambda item: item[2])
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for path, size, _ in files:
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self._disk_bytes = total
+            self._counters['disk_evictions'] += removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.disk_dir:
+            for path, _, _ in list(self._disk_files()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            with self._lock:
+                self._disk_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+            data['entries'] = len(self._entries)
+            data['bytes'] = self._bytes
+            data['disk'] = self.disk_dir
+            data['disk_bytes'] = self._disk_bytes
+            data['ttl'] = self.ttl
+        return data
+
+
+response_cache = ResponseCache(
+    ttl=float(settings.get("response_cache_ttl", 3600)),
+    max_entries=int(settings.get("response_cache_max_entries", 512)),
+    max_bytes=int(settings.get("response_cache_max_bytes", 64 * 1024 * 1024)),
+    disk_dir=os.path.join('cache', 'responses') if settings.get("response_cache_disk") else None,
+    disk_max_bytes=int(settings.get("response_cache_disk_max_bytes", 512 * 1024 * 1024)),
+)
+
+@app.route('/response-cache', methods=['DELETE'])
+def clear_response_cache():
+    response_cache.clear()
+    return jsonify({"status": "success"})
+
+@app.route('/generate', methods=['POST'])
+def generate():
      
     try:
         data = request.json
@@ -155,87 +1384,14 @@ def generate_stream():
             model = data["modelhs"][-1] if data["modelhs"] else current_model
         else:
             model = data.get('model', current_model)
-        
-        # Получаем сообщение пользователя
-        user_message = data.get('message', '')
-        tools_enabled = data.get('tools_enabled', False)
-        
         if "history" in data:
             messages = data["history"]
         else:
             messages = data.get('messages', [])
-        
-        # Если есть новое сообщение пользователя, добавляем его
-        if user_message:
-            messages.append({"role": "user", "content": user_message})
-        
-        # Если включены инструменты, добавляем их в системное сообщение (серверная логика, если клиент не прислал свой)
-        if tools_enabled and not any(msg['role'] == 'system' for msg in messages):
-            system_message_content = """Ты AI-ассистент с полным доступом к компьютеру пользователя.
-Это доступные инструменты. Используй их только при необходимости и только по одному за раз.
-Формат вызова: [TOOL_CALL] имя_инструмента({"параметр1": "значение1", "параметр2": "значение2"})
-Всегда используй двойные кавычки для ключей и строковых значений в JSON.
-Для путей в Windows используй двойной обратный слеш: "C:\\Users\\User\\file.txt".
-
-Доступные инструменты:
-📁 ФАЙЛОВАЯ СИСТЕМА:
-- list_drives: Просмотр всех дисков.
-  Параметры: нет.
-  Пример: [TOOL_CALL] list_drives({})
-- create_file: Создание/перезапись файла с содержимым.
-  Параметры: {"filename": "полный_путь_к_файлу", "content": "содержимое"}
-  Пример: [TOOL_CALL] create_file({"filename": "C:\\temp\\new.txt", "content": "Hello!"})
-- read_file: Чтение текстового файла.
-  Параметры: {"filename": "полный_путь_к_файлу"}
-  Пример: [TOOL_CALL] read_file({"filename": "C:\\boot.ini"})
-- edit_file: Редактирование существующего файла (старое содержимое заменяется новым).
-  Параметры: {"filename": "полный_путь_к_файлу", "content": "новое_содержимое"}
-- create_directory: Создание новой папки.
-  Параметры: {"dirname": "полный_путь_к_папке"}
-  Пример: [TOOL_CALL] create_directory({"dirname": "C:\\NewFolder"})
-- list_files: Просмотр содержимого папки.
-  Параметры: {"path": "путь_к_папке"} (если path не указан, используется текущий или корневой каталог)
-  Пример: [TOOL_CALL] list_files({"path": "D:\\Downloads"})
-- delete_file: Удаление файла или папки (включая содержимое папки).
-  Параметры: {"filename": "полный_путь_к_файлу_или_папке"}
-- file_operations: Расширенные файловые операции.
-  Параметры: {"operation": "copy"|"move"|"search"|"permissions", "source": "путь_источник", "destination": "путь_назначение" (для copy/move), "pattern": "шаблон" (для search)}
-  Пример (поиск): [TOOL_CALL] file_operations({"operation": "search", "source": "C:\\Users", "pattern": "*.docx"})
-
-💻 СИСТЕМНОЕ УПРАВЛЕНИЕ:
-- execute_command: Выполнение команды в терминале (cmd/bash).
-  Параметры: {"command": "команда_с_аргументами"}
-  Пример: [TOOL_CALL] execute_command({"command": "ipconfig /all"})
-- run_application: Запуск приложения.
-  Параметры: {"app_name": "имя.exe"} (для программ из PATH) ИЛИ {"app_path": "полный_путь_к\\имя.exe"}. Можно добавить {"arguments": "аргументы"}.
-  Пример (имя): [TOOL_CALL] run_application({"app_name": "notepad.exe"})
-  Пример (путь): [TOOL_CALL] run_application({"app_path": "C:\\Program Files\\MyApp\\app.exe", "arguments": "--nogui"})
-- get_system_info: Общая информация о системе (ОС, CPU, GPU, память, диски).
-  Параметры: нет.
-  Пример: [TOOL_CALL] get_system_info({})
-- manage_processes: Управление процессами.
-  Параметры: {"action": "list"|"kill"|"info", "process_name": "имя_процесса" (для kill/info), "process_id": id_процесса (для kill/info), "force": true/false (для kill, необязательно)}
-  Пример (список): [TOOL_CALL] manage_processes({"action": "list"})
-  Пример (завершить): [TOOL_CALL] manage_processes({"action": "kill", "process_name": "notepad.exe"})
-  Пример (завершить принудительно по PID): [TOOL_CALL] manage_processes({"action": "kill", "process_id": 1234, "force": true})
-- network_info: Информация о сетевых интерфейсах и соединениях.
-  Параметры: нет.
-- manage_services: Управление службами (Windows/Linux).
-  Параметры: {"action": "list"|"start"|"stop"|"restart"|"status", "service_name": "имя_службы"}
-  Пример: [TOOL_CALL] manage_services({"action": "status", "service_name": " наиболееwuauserv"})
-- find_executable: Поиск исполняемого файла в системных путях.
-  Параметры: {"executable_name": "имя_файла.exe"}
-  Пример: [TOOL_CALL] find_executable({"executable_name": "python.exe"})
-
-Отвечай на языке пользователя."""
-            system_message = {"role": "system", "content": system_message_content}
-            messages.insert(0, system_message)
-        
         payload = {
             "model": model,
             "messages": messages,
-            "stream": True,
-            "keep_alive": "30m"
+            "stream": False
         }
 
         options = {}
@@ -245,673 +1401,3522 @@ def generate_stream():
                 options["temperature"] = float(model_temp)
             except ValueError:
                 app.logger.warning(f"Invalid temperature value in settings: {model_temp}. Using Ollama's default.")
+        if isinstance(data.get('options'), dict):
+            options.update(data['options'])
         
         if options:
             payload["options"] = options
+        apply_context_budget(payload)
 
-        resp = requests.post(f"{OLLAMA_API}/api/chat", json=payload, stream=True, timeout=120)
-        def generate():
-            for line in resp.iter_lines():
-                if line:
-                    yield f"data: {line.decode('utf-8')}\n\n"
-        return Response(generate(), mimetype='text/event-stream')
+        cache_mode = data.get('cache')
+        if not response_cache.should_cache(payload, cache_mode):
+            response_cache.bypass()
+            resp = scheduled_chat(payload)
+            response = jsonify(resp.json())
+            response.headers['X-Cache'] = 'BYPASS'
+            return response
+
+        key = response_cache.key_for(payload)
+        body = response_cache.get(key)
+        cache_status = 'HIT'
+        if body is None:
+            resp = scheduled_chat(payload)
+            if resp.status_code != 200:
+                return jsonify(resp.json()), resp.status_code
+            body = json.dumps(resp.json(), ensure_ascii=False).encode('utf-8')
+            response_cache.put(key, body)
+            cache_status = 'MISS'
+        response = Response(body, mimetype='application/json')
+        response.headers['X-Cache'] = cache_status
+        return response
+    except SchedulerQueueFull as e:
+        return queue_full_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/generate-title', methods=['POST'])
-def generate_title():
-    try:
-        data = request.json
-        history = data.get('history', []) 
-        model_name = data.get('model', current_model)
+class ToolCallParser:
+    """Инкрементальный поиск вызовов [TOOL_CALL] имя({...}) в потоке токенов"""
 
-        if not history:
-            return jsonify({'error': 'История чата пуста для генерации заголовка'}), 400
+    MARKER = '[TOOL_CALL]'
+    HEAD_RE = re.compile(r'\[TOOL_CALL\]\s*(\w+)\s*\(')
+    PARTIAL_HEAD_RE = re.compile(r'\s*(?:\w+\s*)?')
+    FALLBACK_RE = re.compile(r'\[TOOL_CALL\]\s*(\w+)\s*\(([^)]*)\)')
 
-        relevant_history_messages = [m for m in history if m.get('role') == 'user' or m.get('role') == 'assistant'][-10:]
-        
-        dialog_context_parts = []
-        for m in relevant_history_messages:
-            role = m.get('role', 'unknown').capitalize()
-            content = m.get('content', '')
-            content_preview = (content[:150] + '...') if len(content) > 150 else content
-            dialog_context_parts.append(f"{role}: {content_preview}")
-        dialog_context_for_title = "\n---\n".join(dialog_context_parts)
-        
-        app.logger.warning(f"generate_title: Dialog context for title: {dialog_context_for_title}")
+    def __init__(self):
+        self.text = ''
+        self.pos = 0  # до этой позиции текст уже разобран
+        self._braces = None  # (начало, позиция, глубина, в строке, экранирование) недописанных аргументов
 
-        title_prompt_text = f'''Проанализируй следующий диалог:
----
-{dialog_context_for_title}
----
-Твоя задача: придумать ОЧЕНЬ краткий заголовок (от 3 до 7 слов) для этого диалога.
-Заголовок должен быть на том же языке, на котором велся диалог.
-Пожалуйста, помести заголовок ВНУТРИ тегов <title> и </title>.
-Пример: <title>Пример заголовка здесь</title>
-Не добавляй никаких своих мыслей, объяснений или комментариев вне тегов <title>. Твой ответ должен содержать ТОЛЬКО теги <title> и заголовок внутри них.
-'''
-        
-        messages_for_title = [
-            {"role": "user", "content": title_prompt_text.strip()}
-        ]
-        app.logger.warning(f"generate_title: Final prompt for title (single message to LLM): {messages_for_title[0]['content']}")
+    def feed(self, delta):
+        """Добавляет кусок текста и возвращает список завершенных вызовов"""
+        self.text += delta
+        calls = []
+        while True:
+            call = self._scan()
+            if call is None:
+                return calls
+            calls.append(call)
 
-        payload = {
-            "model": model_name,
-            "messages": messages_for_title,
-            "stream": False,
-            "options": {"temperature": 0.4} # Slightly lower temp for more deterministic titles
+    def flush(self):
+        """Конец потока: разбирает незавершенные вызовы так же, как parseToolCalls в клиенте"""
+        calls = []
+        for match in self.FALLBACK_RE.finditer(self.text, self.pos):
+            arguments, error = self.parse_arguments(match.group(2))
+            calls.append(self._call(match.group(1), arguments, match.start(), match.end(), error))
+        self.pos = len(self.text)
+        return calls
+
+    def _call(self, name, arguments, start, end, error=None):
+        return {
+            'name': name,
+            'arguments': arguments,
+            'start': start,
+            'end': end,
+            'raw': self.text[start:end],
+            'parse_error': error,
         }
-        app.logger.warning(f"generate_title: Sending payload to Ollama: {json.dumps(payload, ensure_ascii=False, indent=2)}")
 
-        resp = requests.post(f"{OLLAMA_API}/api/chat", json=payload, timeout=60)
-        resp.raise_for_status() 
-        response_data = resp.json()
-        app.logger.warning(f"generate_title: Received response from Ollama: {response_data}")
+    def _scan(self):
+        text = self.text
+        while True:
+            start = text.find(self.MARKER, self.pos)
+            if start < 0:
+                # Маркер может быть разрезан между чанками - оставляем хвост для следующего поиска
+                self.pos = max(self.pos, len(text) - len(self.MARKER) + 1)
+                return None
+            self.pos = start
+            head = self.HEAD_RE.match(text, start)
+            if head is None:
+                if self.PARTIAL_HEAD_RE.fullmatch(text, start + len(self.MARKER)):
+                    return None  # имя инструмента еще не дописано
+                self.pos = start + len(self.MARKER)
+                continue
+            matched = self._match_arguments(head.end())
+            if matched is None:
+                return None  # аргументы еще не дописаны
+            arguments, end, error = matched
+            self.pos = end
+            return self._call(head.group(1), arguments, start, end, error)
 
-        raw_content = response_data.get('message', {}).get('content', '').strip()
-        app.logger.warning(f"generate_title: Raw content from model: '{raw_content}'")
+    def _match_arguments(self, i):
+        text = self.text
+        n = len(text)
+        while i < n and text[i].isspace():
+            i += 1
+        if i >= n:
+            return None
+        if text[i] == ')':
+            return {}, i + 1, None
+        if text[i] == '{':
+            close = self._match_braces(i)
+            if close is None:
+                return None
+            j = close + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j >= n:
+                return None
+            if text[j] == ')':
+                arguments, error = self.parse_arguments(text[i:close + 1])
+                return arguments, j + 1, error
+        paren = text.find(')', i)
+        if paren < 0:
+            return None
+        arguments, error = self.parse_arguments(text[i:paren])
+        return arguments, paren + 1, error
 
-        generated_title = ""
-        
-        content_cleaned_from_thoughts = re.sub(r'<think[^>]*>[\s\S]*?<\/think>', '', raw_content, flags=re.IGNORECASE | re.DOTALL).strip()
-        content_cleaned_from_thoughts = re.sub(r'<thought[^>]*>[\s\S]*?<\/thought>', '', content_cleaned_from_thoughts, flags=re.IGNORECASE | re.DOTALL).strip()
-        app.logger.warning(f"generate_title: Content after ALL think/thought tags removal: '{content_cleaned_from_thoughts}'")
+    def _match_braces(self, i):
+        # Длинные аргументы (содержимое create_file) приходят многими чанками - продолжаем с места,
+        # где остановились в прошлый раз, а не сканируем их заново
+        if self._braces is not None and self._braces[0] == i:
+            _, resume, depth, in_string, escaped = self._braces
+        else:
+            resume, depth, in_string, escaped = i, 0, False, False
+        for k in range(resume, len(self.text)):
+            c = self.text[k]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == '\\':
+                    escaped = True
+                elif c == '"':
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    self._braces = None
+                    return k
+        self._braces = (i, len(self.text), depth, in_string, escaped)
+        return None
 
-        title_match = re.search(r'<title>(.*?)</title>', content_cleaned_from_thoughts, re.IGNORECASE | re.DOTALL)
-        
-        if title_match and title_match.group(1).strip():
-            generated_title = title_match.group(1).strip()
-            app.logger.warning(f"generate_title: Title extracted from <title> tags (after pre-cleaning thoughts): '{generated_title}'")
+    @staticmethod
+    def parse_arguments(params):
+        """Разбор параметров с теми же поблажками, что и parseToolCalls (одиночные \\ в путях Windows)"""
+        params = params.strip()
+        if not params:
+            return {}, None
+        if params.startswith('{') and params.endswith('}'):
+            candidates = [params, params.replace('\\', '\\\\')]
         else:
-            app.logger.warning(f"generate_title: <title> tags not found or empty in thought-cleaned content. Using this cleaned content for fallback: '{content_cleaned_from_thoughts}'")
-            temp_title = content_cleaned_from_thoughts
-            
-            common_llm_prefixes_patterns = [
-                r"^\s*okay,\s*here's\s*a\s*(?:short\s*)?title(?:.*?)?:\s*",
-                r"^\s*okay,\s*the\s*user\s*wants\s*a\s*title(?:.*?)?:\s*",
-                r"^\s*sure,\s*here's\s*a\s*title:\s*",
-                r"^\s*here's\s*a\s*(?:short\s*)?title:\s*",
-                r"^\s*here\s*is\s*a\s*(?:short\s*)?title:\s*",
-                r"^\s*(?:short\s*)?title\s*is:\s*",
-                r"^\s*title:\s*",
-                r"^\s*вот\s*(?:короткий\s*)?заголовок:\s*",
-                r"^\s*заголовок:\s*",
-                r"^\s*краткий\s*заголовок:\s*"
-            ]
-            original_title_before_prefix_strip = temp_title 
-            for pattern in common_llm_prefixes_patterns:
-                new_title_candidate = re.sub(pattern, '', temp_title, count=1, flags=re.IGNORECASE).strip()
-                if new_title_candidate != temp_title: 
-                    app.logger.warning(f"generate_title (fallback): Removed prefix matching '{pattern}'. New: '{new_title_candidate}'")
-                    temp_title = new_title_candidate
-                    break 
-            if original_title_before_prefix_strip == temp_title: 
-                 app.logger.warning(f"generate_title (fallback): No common LLM prefixes found or removed. Title remains: '{temp_title}'")
-            
-            lines = [line.strip() for line in temp_title.splitlines() if line.strip()]
-            if lines:
-                generated_title = lines[0]
-            else:
-                generated_title = "" 
-            app.logger.warning(f"generate_title (fallback): Title after taking first line: '{generated_title}'")
-
-        if generated_title:
-            if (generated_title.startswith('"') and generated_title.endswith('"')) or \
-               (generated_title.startswith("'") and generated_title.endswith("'")):
-                if len(generated_title) > 1:
-                   generated_title = generated_title[1:-1]
-            if generated_title.endswith('.'):
-                generated_title = generated_title[:-1]
-        app.logger.warning(f"generate_title: Title after final quote/period removal: '{generated_title}'")
-        
-        if not generated_title:
-            generated_title = "Диалог"
-            app.logger.warning("generate_title: Title is empty after all processing, using default 'Диалог'.")
+            candidates = ['{' + params.replace('\\', '\\\\') + '}']
+        error = None
+        for candidate in candidates:
+            try:
+                value = json.loads(candidate)
+            except ValueError as e:
+                error = str(e)
+                continue
+            if isinstance(value, dict):
+                return value, None
+            error = 'arguments are not a JSON object'
+        return {}, error
 
-        app.logger.warning(f"generate_title: Final processed title for API response: '{generated_title}'")
-        return jsonify({'title': generated_title})
 
-    except requests.exceptions.RequestException as e_req:
-        app.logger.error(f"generate_title: Request to Ollama failed: {e_req}", exc_info=True)
-        return jsonify({'error': f'Ошибка при запросе к Ollama: {str(e_req)}'}), 500
-    except Exception as e:
-        app.logger.error(f"generate_title: Error generating title: {e}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
+class ServerToolLoop:
+    """Серверный цикл инструментов для /generate-stream: вызов из потока выполняется в процессе,
+    результат добавляется в историю, и генерация продолжается в том же SSE-соединении"""
 
-@app.route('/switch-model', methods=['POST'])
-def switch_model():
+    def __init__(self, payload, max_iterations):
+        self.payload = payload
+        self.max_iterations = max_iterations
+        self.iterations = 0
+        self.parser = ToolCallParser()
+
+    @property
+    def active(self):
+        return self.iterations < self.max_iterations
+
+    @property
+    def native(self):
+        """Вызовы приходят структурно в message.tool_calls (payload содержит JSON-схемы tools)"""
+        return bool(self.payload.get('tools'))
+
+    def feed(self, delta):
+        """Очередной фрагмент ответа модели; возвращает первый завершенный вызов или None"""
+        if not self.active or not delta:
+            return None
+        calls = self.parser.feed(delta)
+        return calls[0] if calls else None
+
+    def feed_message(self, message):
+        """message из строки NDJSON: сначала структурные tool_calls, затем текстовый [TOOL_CALL]"""
+        call = self.feed(message.get('content') or '')
+        if call is None and self.active and message.get('tool_calls'):
+            function = message['tool_calls'][0].get('function') or {}
+            arguments = function.get('arguments') or {}
+            error = None
+            if isinstance(arguments, str):
+                arguments, error = ToolCallParser.parse_arguments(arguments)
+            end = len(self.parser.text)
+            call = {"name": function.get('name', ''), "arguments": arguments, "start": end, "end": end,
+                    "raw": json.dumps(function, ensure_ascii=False), "parse_error": error, "native": True}
+        return call
+
+    def use_text_mode(self):
+        """Модель не поддерживает tools: промпт с описанием инструментов вместо JSON-схем"""
+        self.payload.pop('tools', None)
+        messages = self.payload['messages']
+        if messages and messages[0].get('content') == tool_registry.native_prompt():
+            messages[0] = {"role": "system", "content": tool_registry.system_prompt()}
+
+    def finish_round(self):
+        """Поток закончился сам: последний шанс найти вызов с нестандартными параметрами"""
+        if not self.active:
+            return None
+        calls = self.parser.flush()
+        return calls[0] if calls else None
+
+    def apply_result(self, call, data, status):
+        """Добавляет вызов и его результат в историю и возвращает кадр с результатом для клиента"""
+        self.iterations += 1
+        ok = status < 400 and 'error' not in (data or {})
+        result_text = (data or {}).get('result', '') if ok else f"Ошибка: {(data or {}).get('error')}"
+        if not isinstance(result_text, str):
+            result_text = json.dumps(result_text, ensure_ascii=False)
+        result_block = f"[TOOL_RESULT for {call['name']}]:\n{result_text}"
+
+        messages = self.payload['messages']
+        if call.get('native'):
+            messages.append({"role": "assistant", "content": self.parser.text,
+                             "tool_calls": [{"function": {"name": call['name'], "arguments": call['arguments']}}]})
+            messages.append({"role": "tool", "content": result_text, "tool_name": call['name']})
+        else:
+            messages.append({"role": "assistant", "content": self.parser.text[:call['end']]})
+            messages.append({"role": "user", "content": result_block})
+        self.parser = ToolCallParser()
+
+        frame = {
+            "model": self.payload['model'],
+            "message": {"role": "assistant", "content": f"\n{result_block}\n"},
+            "done": False,
+            "tool_result": {
+                "name": call['name'],
+                "arguments": call['arguments'],
+                "status": status,
+                "ok": ok,
+                "iteration": self.iterations,
+            },
+        }
+        return frame
+
+
+class ChatSession:
+    """Ход в session-режиме: история берется из хранилища чатов, ответ ассистента сохраняет сервер"""
+
+    def __init__(self, chat_id, model, strip_tool_calls=False, reply_index=None):
+        self.chat_id = chat_id
+        self.model = model
+        self.strip_tool_calls = strip_tool_calls
+        self.reply_index = reply_index  # позиция ответа в истории; туда же пишутся чекпойнты
+        self.parts = []
+        self.done = False
+        self.saved = False
+        self.unsaved_chunks = 0
+        self.checkpointed = time.monotonic()
+
+    def observe(self, chunk):
+        """Кадр ответа (разобранная строка NDJSON от Ollama или собственный кадр сервера).
+        Каждые REPLY_CHECKPOINT_TOKENS чанков или REPLY_CHECKPOINT_INTERVAL секунд недописанный ответ
+        уходит в отложенную запись: при падении сервера или закрытой вкладке он не пропадет."""
+        content = (chunk.get('message') or {}).get('content')
+        if content:
+            self.parts.append(content)
+            self.unsaved_chunks += 1
+        self.done = bool(chunk.get('done'))
+        if self.unsaved_chunks and self.reply_index is not None and not self.done and (
+                self.unsaved_chunks >= REPLY_CHECKPOINT_TOKENS
+                or time.monotonic() - self.checkpointed >= REPLY_CHECKPOINT_INTERVAL):
+            reply_checkpoints.submit((self.chat_id, self.reply_index), self.message(final=False))
+            self.unsaved_chunks = 0
+            self.checkpointed = time.monotonic()
+
+    def message(self, final):
+        content = ''.join(self.parts)
+        if self.strip_tool_calls:
+            content = ToolCallParser.FALLBACK_RE.sub('', content).strip()
+        message = {"role": "assistant", "content": content, "images": [], "modelUsed": self.model}
+        if not (final and self.done):
+            message["incomplete"] = True
+        return message
+
+    def save(self):
+        if self.saved:
+            return
+        self.saved = True
+        try:
+            if self.reply_index is None:
+                chat_store.append_messages(self.chat_id, [self.message(final=True)])
+                return
+            # Итоговая версия заменяет ждущий чекпойнт и пишется сразу
+            reply_checkpoints.submit((self.chat_id, self.reply_index), self.message(final=True))
+            reply_checkpoints.flush()
+        except Exception as e:
+            app.logger.error(f"ChatSession: failed to save reply for chat {self.chat_id}: {e}", exc_info=True)
+
+
+def request_int(value, name):
+    """Целое число из JSON запроса: int или строка с ним; bool, дроби и прочее - ValueError (ответ 400, а не 500)"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}") from None
+
+
+def open_chat_session(data):
+    """session-режим /generate-stream: клиент присылает только новое сообщение, сервер сохраняет его
+    и подставляет историю чата из хранилища. Возвращает (ChatSession, данные запроса с историей)."""
+    chat_id = data.get('chat_id')
+    if chat_id is None:
+        raise ValueError("session mode requires chat_id")
+    chat_id = str(chat_id)
+    message = data.get('message')
+    if isinstance(message, str):
+        message = {"role": "user", "content": message, "display": message}
+    if not isinstance(message, dict) or not message.get('content'):
+        raise ValueError("session mode requires a non-empty message")
+    message_index = data.get('message_index')
+    if message_index is not None:
+        message_index = request_int(message_index, 'message_index')
+    if "modelhs" in data:
+        model = data["modelhs"][-1] if data["modelhs"] else current_model
+    else:
+        model = data.get('model', current_model)
+
+    if not chat_store.exists(chat_id):
+        chat_store.put_chat(chat_id, {"id": chat_id, "history": [], "modelhs": [model]})
+    if chat_store.set_message(chat_id, message_index, message) == 1:
+        # Первое сообщение сразу дает чату локальный заголовок, не дожидаясь отдельного запроса к модели
+        chat_store.set_auto_title(chat_id, local_titler.title([message]), 'local')
+    history = chat_store.get_chat(chat_id)['history']
+
+    turn = {k: v for k, v in data.items() if k not in ('message', 'history', 'messages', 'modelhs')}
+    turn['model'] = model
+    turn['messages'] = history
+    session = ChatSession(chat_id, model, strip_tool_calls=bool(data.get('server_tools') and data.get('tools_enabled')),
+                          reply_index=len(history))
+    return session, turn
+
+
+MAX_TOOL_ITERATIONS_LIMIT = 20
+
+
+def max_tool_iterations(data):
+    """Число раундов серверного цикла инструментов из запроса (или настроек), в пределах 1..MAX_TOOL_ITERATIONS_LIMIT.
+    Не целое число - ValueError: запрос проверяется до сохранения сообщения и постановки в очередь."""
+    value = data['max_tool_iterations'] if 'max_tool_iterations' in data else settings.get("max_tool_iterations", 5)
+    return min(max(request_int(value, 'max_tool_iterations'), 1), MAX_TOOL_ITERATIONS_LIMIT)
+
+
+def tool_loop_for(data, payload, max_iterations):
+    """Возвращает ServerToolLoop, если клиент включил серверное выполнение инструментов"""
+    if not (data.get('server_tools') and data.get('tools_enabled')):
+        return None
+    return ServerToolLoop(payload, max_iterations)
+
+
+class StreamEventParser:
+    """Инкрементальный разбор ответа модели на типизированные события: рассуждения (<think>, <thought>
+    или поле thinking), текст ответа и статистика. Чанк разбирается за O(длина чанка): тег, разрезанный
+    между чанками, придерживается до следующего чанка."""
+
+    OPEN_RE = re.compile(r'<(think|thought)>', re.IGNORECASE)
+    CLOSE_RES = {
+        'think': re.compile(r'</think>', re.IGNORECASE),
+        'thought': re.compile(r'</thought>', re.IGNORECASE),
+    }
+    TAGS = ('<think>', '<thought>', '</think>', '</thought>')
+    MAX_TAG = max(len(tag) for tag in TAGS)
+    STATS_FIELDS = ('done_reason', 'total_duration', 'load_duration', 'prompt_eval_count',
+                    'prompt_eval_duration', 'eval_count', 'eval_duration')
+
+    def __init__(self):
+        self.block = None  # 'think' / 'thought' внутри блока рассуждений
+        self.pending = ''  # хвост, который может оказаться началом тега
+
+    def feed_message(self, message):
+        """message из строки NDJSON -> список событий [(тип, текст)], тип - 'thinking' или 'content'"""
+        events = []
+        if message.get('thinking'):
+            events.append(('thinking', message['thinking']))
+        for kind, text in self.feed(message.get('content') or ''):
+            if events and events[-1][0] == kind:
+                events[-1] = (kind, events[-1][1] + text)
+            else:
+                events.append((kind, text))
+        return events
+
+    def feed(self, delta):
+        text = self.pending + delta
+        self.pending = ''
+        events = []
+        pos = 0
+        while pos < len(text):
+            if self.block is None:
+                match = self.OPEN_RE.search(text, pos)
+            else:
+                match = self.CLOSE_RES[self.block].search(text, pos)
+            if match is None:
+                keep = self._partial_tag(text, pos)
+                self._emit(events, text[pos:len(text) - keep])
+                self.pending = text[len(text) - keep:]
+                break
+            self._emit(events, text[pos:match.start()])
+            self.block = match.group(1).lower() if self.block is None else None
+            pos = match.end()
+        return events
+
+    def flush(self):
+        """Конец ответа: недописанный тег оказался обычным текстом"""
+        events = []
+        self._emit(events, self.pending)
+        self.pending = ''
+        return events
+
+    def _partial_tag(self, text, pos):
+        start = text.rfind('<', max(pos, len(text) - self.MAX_TAG + 1))
+        if start < 0:
+            return 0
+        tail = text[start:].lower()
+        return len(tail) if any(tag.startswith(tail) for tag in self.TAGS) else 0
+
+    def _emit(self, events, text):
+        if text:
+            events.append(('thinking' if self.block is not None else 'content', text))
+
+    @classmethod
+    def split(cls, text):
+        """Готовый ответ целиком -> (рассуждения, ответ)"""
+        parser = cls()
+        parts = {'thinking': [], 'content': []}
+        for kind, piece in parser.feed(text) + parser.flush():
+            parts[kind].append(piece)
+        return ''.join(parts['thinking']), ''.join(parts['content'])
+
+    @classmethod
+    def stats(cls, chunk):
+        """Итоговая строка Ollama (done=true) -> событие stats"""
+        data = {field: chunk[field] for field in cls.STATS_FIELDS if field in chunk}
+        if chunk.get('eval_count') and chunk.get('eval_duration'):
+            data['tokens_per_second'] = round(chunk['eval_count'] / (chunk['eval_duration'] / 1e9), 2)
+        return data
+
+
+class FrameCoalescer:
+    """Склейка текстовых событий формата compact: пока токены идут чаще окна, они копятся и уходят
+    одним кадром раз в window секунд или по max_bytes. Первый токен раунда, медленный поток (пауза между
+    токенами дольше окна) и любое нетекстовое событие (tool_call, stats, ошибка) отправляются сразу.
+    Если Ollama замолчала (пауза рассуждений, смена модели), накопленное по истечении окна отправляет
+    драйвер запуска: см. deadline(), iter_upstream_lines() и AsyncStreamingServer._schedule_flush()."""
+
+    TEXT_EVENTS = ('thinking', 'content')
+
+    def __init__(self, window=0.02, max_bytes=256):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.kind = None
+        self.parts = []
+        self.size = 0
+        self.since = 0.0  # когда накоплен первый кусок
+        self.last = None  # время предыдущего текстового события
+        self.events = 0
+        self.frames = 0
+
+    def push(self, kind, data):
+        """Событие -> строка кадров, которые нужно отправить сейчас (возможно пустая)"""
+        self.events += 1
+        now = time.monotonic()
+        if kind not in self.TEXT_EVENTS:
+            out = self.flush() + self._frame(kind, data)
+            self.last = None  # следующий раунд начнется с немедленной отправки
+            return out
+        out = self.flush() if self.kind is not None and kind != self.kind else ''
+        slow = self.last is None or now - self.last >= self.window
+        self.last = now
+        if not self.parts:
+            self.since = now
+        self.kind = kind
+        self.parts.append(data['text'])
+        self.size += len(data['text'].encode('utf-8'))
+        if slow or self.size >= self.max_bytes or now - self.since >= self.window:
+            out += self.flush()
+        return out
+
+    def deadline(self):
+        """Через сколько секунд накопленный текст нужно отправить, не дожидаясь Ollama (None - нечего)"""
+        if not self.parts:
+            return None
+        return max(0.0, self.since + self.window - time.monotonic())
+
+    def flush(self):
+        if not self.parts:
+            return ''
+        frame = self._frame(self.kind, {"text": ''.join(self.parts)})
+        self.kind = None
+        self.parts = []
+        self.size = 0
+        return frame
+
+    def _frame(self, kind, data):
+        self.frames += 1
+        return f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class StreamReplay:
+    """Кольцевой буфер событий запуска (форматы events/compact): каждое событие получает SSE id,
+    переподключившийся клиент получает пропущенное после Last-Event-ID и дальше - живой поток.
+    Объем ограничен max_bytes: самые старые события вытесняются."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.events = deque()  # (id, кадр)
+        self.size = 0
+        self.last_id = 0
+        self.closed = False
+        self._cond = Condition()
+        self._waiters = []  # asyncio.Future подписчиков AsyncStreamingServer
+
+    def publish(self, chunk):
+        """Кадры от драйвера запуска (одна строка может содержать несколько событий)"""
+        if not chunk:
+            return
+        with self._cond:
+            for event in chunk.split('\n\n'):
+                if not event:
+                    continue
+                self.last_id += 1
+                frame = f"id: {self.last_id}\n{event}\n\n"
+                self.events.append((self.last_id, frame))
+                self.size += len(frame)
+                while self.size > self.max_bytes and len(self.events) > 1:
+                    self.size -= len(self.events.popleft()[1])
+            self._wake()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._wake()
+
+    def _wake(self):
+        self._cond.notify_all()
+        waiters, self._waiters = self._waiters, []
+        for future in waiters:
+            if not future.done():
+                future.get_loop().call_soon_threadsafe(self._resolve, future)
+
+    @staticmethod
+    def _resolve(future):
+        if not future.done():
+            future.set_result(None)
+
+    def covers(self, after):
+        """Можно ли продолжить с события after без пропусков"""
+        with self._cond:
+            oldest = self.events[0][0] if self.events else self.last_id + 1
+            return oldest - 1 <= after <= self.last_id
+
+    def _since(self, after):
+        if self.events and self.events[0][0] > after + 1:
+            # Читатель отстал: нужные ему события уже вытеснены. Молча пропустить часть ответа нельзя -
+            # его поток завершается событием error (after=None), а переподключение получит 410
+            error = {"error": "Stream reader fell behind: events were dropped from the buffer",
+                     "last_event_id": after}
+            return f"event: error\ndata: {json.dumps(error)}\n\n", None, self.closed
+        frames = []
+        for event_id, frame in reversed(self.events):
+            if event_id <= after:
+                break
+            frames.append(frame)
+        frames.reverse()
+        return ''.join(frames), max(after, self.last_id), self.closed
+
+    def read(self, after, timeout):
+        """События с id > after: (кадры, id последнего, закрыт ли буфер); ждет новых до timeout секунд.
+        id последнего None - читатель отстал от буфера, кадры - событие error, читать дальше нельзя."""
+        with self._cond:
+            if self.last_id <= after and not self.closed:
+                self._cond.wait(timeout)
+            return self._since(after)
+
+    async def read_async(self, after, timeout):
+        with self._cond:
+            if self.last_id > after or self.closed:
+                return self._since(after)
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._cond:
+            return self._since(after)
+
+
+class StreamRun:
+    """Один запуск /generate-stream: состояние хода (история, серверный цикл инструментов, сессия)
+    и текущее upstream-соединение с Ollama, которое можно оборвать для отмены"""
+
+    FORMATS = ('raw', 'events', 'compact')
+    COALESCE_WINDOW = float(settings.get("stream_coalesce_ms", 20)) / 1000
+    COALESCE_BYTES = int(settings.get("stream_coalesce_bytes", 256))
+    REPLAY_BYTES = int(settings.get("stream_replay_bytes", 1024 * 1024))
+    # Сколько генерация продолжается без подключенных клиентов, ожидая переподключения
+    RESUME_GRACE = float(settings.get("stream_resume_grace", 60))
+
+    def __init__(self, payload, tool_loop=None, session=None, ticket=None, stream_format='raw'):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        # raw - строки Ollama как есть; events - типизированные SSE-события (event: content и т.д.);
+        # compact - те же события, но текст склеивается в кадры по времени и размеру
+        self.typed = stream_format in ('events', 'compact')
+        self.coalescer = FrameCoalescer(self.COALESCE_WINDOW, self.COALESCE_BYTES) if stream_format == 'compact' else None
+        # Типизированные запуски возобновляемы: генерация идет в буфер, клиенты читают его по SSE id
+        self.replay = StreamReplay(self.REPLAY_BYTES) if self.typed else None
+        self._subscribers = set()
+        self._subscriber_ids = itertools.count(1)
+        self._detached_at = None
+        self.finished = None
+        self.parser = StreamEventParser()
+        self.ticket = ticket  # слот планировщика, удерживается до конца хода
+        self.tool_loop = tool_loop
+        self.session = session
+        self.model = payload['model']
+        self.started = time.time()
+        self.chunks = 0
+        self.state = 'running'  # running | done | cancelled | disconnected | error
+        self.cancelled = False
+        self.disconnected = False
+        self.loop = None  # event loop, если поток обслуживает AsyncStreamingServer
+        self.flush_timer = None  # таймер отправки накопленного текста (AsyncStreamingServer)
+        self.upstream = None
+        self._lock = Lock()
+
+    def attach_upstream(self, upstream):
+        with self._lock:
+            self.upstream = upstream
+            cancelled = self.cancelled
+        if cancelled:
+            self._abort_upstream(upstream)
+
+    def _abort_upstream(self, upstream):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(upstream.abort)
+        else:
+            upstream.abort()
+
+    def mark_disconnected(self):
+        """Клиент ушел: генерацию для него продолжать незачем"""
+        self.disconnected = True
+        self.cancel()
+
+    def attach(self):
+        """Новый читатель буфера (исходный ответ или переподключение); возвращает его id для detach"""
+        with self._lock:
+            subscriber = next(self._subscriber_ids)
+            self._subscribers.add(subscriber)
+            self._detached_at = None
+        return subscriber
+
+    def detach(self, subscriber):
+        """Читатель ушел. Если не осталось ни одного, генерация ждет переподключения RESUME_GRACE секунд.
+        Повторный вызов для того же читателя ничего не делает."""
+        with self._lock:
+            if subscriber not in self._subscribers:
+                return
+            self._subscribers.discard(subscriber)
+            if self._subscribers or self.state != 'running':
+                return
+            self._detached_at = time.monotonic()
+        if self.loop is not None:
+            self.loop.call_later(self.RESUME_GRACE, self._grace_expired)
+        else:
+            timer = threading.Timer(self.RESUME_GRACE, self._grace_expired)
+            timer.daemon = True
+            timer.start()
+
+    def _grace_expired(self):
+        with self._lock:
+            detached_at = self._detached_at
+        if detached_at is not None and time.monotonic() - detached_at >= self.RESUME_GRACE - 0.05:
+            self.mark_disconnected()
+
+    def cancel(self):
+        """Отмена из любого потока: upstream обрывается, драйвер завершает поток кадром cancelled"""
+        with self._lock:
+            if self.cancelled or self.state != 'running':
+                return False
+            self.cancelled = True
+            upstream = self.upstream
+        if upstream is not None:
+            self._abort_upstream(upstream)
+        elif self.ticket is not None and not self.ticket.granted:
+            self.ticket.release()  # Еще в очереди - место отдаем сразу
+        return True
+
+    def on_line(self, line):
+        """Строка NDJSON от Ollama -> (SSE-кадры, завершенный вызов инструмента или None).
+        Рассуждения отделяются от ответа здесь же, поэтому инструменты ищутся только в тексте ответа."""
+        self.chunks += 1
+        call = None
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            chunk = None
+        if not isinstance(chunk, dict):
+            return (self.event('error', {"error": line.decode('utf-8', 'replace')}) if self.typed
+                    else f"data: {line.decode('utf-8', 'replace')}\n\n"), None
+        if self.session is not None:
+            self.session.observe(chunk)
+        message = chunk.get('message') or {}
+        events = self.parser.feed_message(message)
+        if chunk.get('done'):
+            events += self.parser.flush()
+        if self.tool_loop is not None:
+            answer = ''.join(text for kind, text in events if kind == 'content')
+            call = self.tool_loop.feed_message({"content": answer, "tool_calls": message.get('tool_calls')})
+        if not self.typed:
+            return f"data: {line.decode('utf-8')}\n\n", call
+        frames = [self.event(kind, {"text": text}) for kind, text in events]
+        if call is not None:
+            frames.append(self.event('tool_call', {key: call[key] for key in ('name', 'arguments', 'parse_error')}))
+        if 'error' in chunk:
+            frames.append(self.event('error', {"error": chunk['error']}))
+        if chunk.get('done'):
+            frames.append(self.event('stats', StreamEventParser.stats(chunk)))
+        return ''.join(frames), call
+
+    def end_round(self):
+        """Поток Ollama закончился сам; возвращает вызов инструмента, если его нужно выполнить"""
+        if self.tool_loop is None:
+            return None
+        return self.tool_loop.finish_round()
+
+    def on_tool_result(self, call, result, status):
+        frame = self.tool_loop.apply_result(call, result, status)
+        if self.session is not None:
+            self.session.observe(frame)
+        self.parser = StreamEventParser()
+        if self.typed:
+            return self.event('tool_result', dict(frame['tool_result'], text=frame['message']['content']))
+        return self.frame(frame)
+
+    def frame(self, data):
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def event(self, kind, data):
+        if self.coalescer is not None:
+            return self.coalescer.push(kind, data)
+        return f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def error_frame(self, error):
+        if self.typed:
+            return self.event('error', {"error": error})
+        return self.frame({"error": error})
+
+    def queued_frame(self):
+        position, eta = self.ticket.position()
+        if self.typed:
+            return self.event('queued', {"position": position, "eta": eta})
+        return self.frame({"model": self.model, "done": False, "stream_id": self.id,
+                           "queued": {"position": position, "eta": eta}})
+
+    def cancelled_frame(self):
+        if self.typed:
+            return self.event('cancelled', {"stream_id": self.id})
+        return self.frame({"model": self.model, "done": True, "cancelled": True, "stream_id": self.id})
+
+    def finish(self, state):
+        """Завершение запуска: сохранение ответа в session-режиме и удаление из реестра"""
+        with self._lock:
+            if self.state == 'running':
+                if self.disconnected or state == 'disconnected':
+                    state = 'disconnected'
+                elif self.cancelled:
+                    state = 'cancelled'
+                self.state = state
+                self.finished = time.monotonic()
+        if self.ticket is not None:
+            self.ticket.release()
+        try:
+            if self.session is not None:
+                self.session.save()
+        finally:
+            stream_registry.unregister(self)
+
+    def describe(self):
+        return {
+            "id": self.id,
+            "model": self.model,
+            "chat_id": self.session.chat_id if self.session is not None else None,
+            "started": self.started,
+            "elapsed": round(time.time() - self.started, 3),
+            "chunks": self.chunks,
+            "tool_iterations": self.tool_loop.iterations if self.tool_loop is not None else 0,
+            "state": self.state,
+            "queued": self.ticket is not None and not self.ticket.granted,
+            "cancelled": self.cancelled,
+            "coalesced": {"events": self.coalescer.events, "frames": self.coalescer.frames}
+                         if self.coalescer is not None else None,
+            "resumable": self.replay is not None,
+            "last_event_id": self.replay.last_id if self.replay is not None else None,
+            "subscribers": len(self._subscribers),
+        }
+
+
+class StreamRegistry:
+    """Реестр идущих генераций /generate-stream: поиск по id для отмены и статистика.
+    Завершенные возобновляемые запуски хранятся еще retain секунд: клиент, потерявший соединение
+    перед самым концом ответа, дочитает его из буфера."""
+
+    def __init__(self, retain=120):
+        self.retain = retain
+        self._runs = {}
+        self._finished = OrderedDict()  # id -> StreamRun в порядке завершения
+        self._lock = Lock()
+        self._counters = {'started': 0, 'done': 0, 'cancelled': 0, 'disconnected': 0, 'error': 0, 'resumed': 0}
+
+    def register(self, run):
+        with self._lock:
+            self._runs[run.id] = run
+            self._counters['started'] += 1
+
+    def unregister(self, run):
+        with self._lock:
+            if self._runs.pop(run.id, None) is not None:
+                self._counters[run.state] = self._counters.get(run.state, 0) + 1
+                if run.replay is not None:
+                    self._finished[run.id] = run
+            self._prune()
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._finished:
+            run = next(iter(self._finished.values()))
+            if now - run.finished < self.retain:
+                break
+            self._finished.popitem(last=False)
+
+    def get(self, stream_id):
+        with self._lock:
+            self._prune()
+            return self._runs.get(stream_id) or self._finished.get(stream_id)
+
+    def count_resume(self):
+        with self._lock:
+            self._counters['resumed'] += 1
+
+    def list(self):
+        with self._lock:
+            runs = list(self._runs.values())
+        return [run.describe() for run in runs]
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+            data['active'] = len(self._runs)
+            data['retained'] = len(self._finished)
+        return data
+
+
+stream_registry = StreamRegistry(retain=float(settings.get("stream_resume_ttl", 120)))
+# Раз в столько секунд без событий читателю уходит SSE-комментарий: так замечается ушедший клиент
+STREAM_KEEPALIVE = float(settings.get("stream_keepalive", 15))
+
+
+def open_run_stream(run):
+    """Открывает раунд стрима. Если модель отвергла tools (старая модель без поддержки функций),
+    запоминает это и повторяет раунд в текстовом режиме [TOOL_CALL]."""
+    upstream = ollama_client.chat_stream(run.payload)
+    if run.tool_loop is not None and run.tool_loop.native and upstream.status == 400:
+        body = upstream.read_body().decode('utf-8', 'replace')
+        if tools_unsupported_error(upstream.status, body):
+            upstream.close()
+            fall_back_to_text_tools(run)
+            upstream = ollama_client.chat_stream(run.payload)
+    return upstream
+
+
+def fall_back_to_text_tools(run):
+    native_tools_unsupported.add(run.model)
+    run.tool_loop.use_text_mode()
+    app.logger.info(f"generate-stream {run.id}: {run.model} does not support tools, using text tool calls")
+
+
+def iter_upstream_lines(run, upstream):
+    """Строки upstream. В формате compact их читает отдельный поток: пока Ollama молчит, генератор
+    по истечении окна коалесцера выдает None - накопленный текст пора отправить."""
+    if run.coalescer is None:
+        yield from upstream.iter_lines()
+        return
+    lines = queue.Queue()
+
+    def read():
+        try:
+            for line in upstream.iter_lines():
+                lines.put(('line', line))
+        except Exception as e:
+            lines.put(('error', e))
+        else:
+            lines.put(('end', None))
+    threading.Thread(target=read, name=f"upstream-{run.id[:8]}", daemon=True).start()
+    while True:
+        try:
+            kind, value = lines.get(timeout=run.coalescer.deadline())
+        except queue.Empty:
+            yield None
+            continue
+        if kind == 'error':
+            raise value
+        if kind == 'end':
+            return
+        yield value
+
+
+def stream_run_frames(run, upstream):
+    """Синхронный драйвер StreamRun для Flask: SSE-кадры ответа, выполнение инструментов между
+    раундами. Отключение клиента (GeneratorExit) сразу закрывает upstream, и Ollama прекращает генерацию.
+    upstream=None - запрос ждет слот планировщика; пока ждет, клиент раз в секунду получает позицию в очереди."""
+    state = 'error'
+    try:
+        if upstream is None:
+            while not run.ticket.wait(1.0):
+                if run.cancelled:
+                    break
+                yield run.queued_frame()
+            if run.cancelled:
+                yield run.cancelled_frame()
+                state = 'cancelled'
+                return
+            upstream = open_run_stream(run)
+        while True:
+            run.attach_upstream(upstream)
+            call = None
+            try:
+                for line in iter_upstream_lines(run, upstream):
+                    frame, call = (run.coalescer.flush(), None) if line is None else run.on_line(line)
+                    if frame:
+                        yield frame
+                    if call is not None:
+                        break  # Вызов получен целиком - дальше модель не нужна до результата
+            except requests.exceptions.RequestException:
+                if not run.cancelled:
+                    raise
+            finally:
+                upstream.close()
+            if run.cancelled:
+                yield run.cancelled_frame()
+                state = 'cancelled'
+                return
+            if call is None:
+                call = run.end_round()
+                if call is None:
+                    state = 'done'
+                    return
+            result, status = call_tool(call['name'], call['arguments'])
+            yield run.on_tool_result(call, result, status)
+            if run.cancelled:
+                yield run.cancelled_frame()
+                state = 'cancelled'
+                return
+            upstream = open_run_stream(run)
+    except GeneratorExit:
+        state = 'disconnected'
+        raise
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"generate-stream {run.id}: upstream error: {e}")
+        yield run.error_frame(str(e))
+    finally:
+        run.finish(state)
+
+
+def start_stream_producer(run, upstream):
+    """Возобновляемый запуск: генерация идет в отдельном потоке и пишет кадры в буфер запуска,
+    не завися от того, подключен ли сейчас клиент"""
+    def produce():
+        try:
+            for frame in stream_run_frames(run, upstream):
+                run.replay.publish(frame)
+        except Exception as e:
+            app.logger.error(f"generate-stream {run.id}: producer error: {e}", exc_info=True)
+            run.replay.publish(run.error_frame(str(e)))
+        finally:
+            run.replay.publish(run.event('end', {"state": run.state}))
+            run.replay.close()
+    threading.Thread(target=produce, name=f"stream-{run.id[:8]}", daemon=True).start()
+
+
+def stream_run_subscriber(run, subscriber, after=0):
+    """SSE-ответ одного читателя: события буфера после after, затем живой поток до конца запуска"""
+    try:
+        while True:
+            frames, after, closed = run.replay.read(after, STREAM_KEEPALIVE)
+            if frames:
+                yield frames
+                if after is None:
+                    return
+            elif closed:
+                return
+            else:
+                yield ": keep-alive\n\n"
+    finally:
+        run.detach(subscriber)
+
+
+def resume_target(stream_id, last_event_id):
+    """Переподключение к запуску -> (запуск, id последнего полученного события, None) или (None, None, (ошибка, статус))"""
+    run = stream_registry.get(stream_id)
+    if run is None:
+        return None, None, ({"error": "Stream not found"}, 404)
+    if run.replay is None:
+        return None, None, ({"error": "Stream is not resumable (stream_format raw)"}, 400)
+    try:
+        after = int(last_event_id or 0)
+    except ValueError:
+        return None, None, ({"error": "Invalid Last-Event-ID"}, 400)
+    if after < 0 or after > run.replay.last_id:
+        # Такого события в этом запуске не было: ошибка клиента, а не вытесненный буфер
+        return None, None, ({"error": "Last-Event-ID is not an event of this stream",
+                             "last_event_id": run.replay.last_id}, 400)
+    if not run.replay.covers(after):
+        return None, None, ({"error": "Events after Last-Event-ID are no longer buffered",
+                             "last_event_id": run.replay.last_id}, 410)
+    stream_registry.count_resume()
+    return run, after, None
+
+
+class ToolParam:
+    """Параметр инструмента: placeholder - как параметр показывается модели в промпте"""
+
+    def __init__(self, name, placeholder, type='string', enum=None, required=False, note=None):
+        self.name = name
+        self.placeholder = placeholder
+        self.type = type
+        self.enum = enum
+        self.required = required
+        self.note = note
+
+    def prompt_value(self):
+        if self.enum:
+            value = '|'.join(json.dumps(v, ensure_ascii=False) for v in self.enum)
+        elif self.type == 'string':
+            value = json.dumps(self.placeholder, ensure_ascii=False)
+        else:
+            value = self.placeholder
+        text = f'"{self.name}": {value}'
+        return f"{text} ({self.note})" if self.note else text
+
+
+class ToolSpec:
+    """Описание инструмента для модели: из него строятся системный промпт и JSON-схема"""
+
+    def __init__(self, name, category, description, params=(), examples=(), params_text=None, aliases=()):
+        self.name = name
+        self.category = category
+        self.description = description
+        self.params = list(params)
+        self.examples = list(examples)  # [(подпись или None, аргументы)]
+        self.params_text = params_text  # ручная формулировка строки "Параметры:", если схемы мало
+        self.aliases = tuple(aliases)
+        self.handler = None  # handler(parameters) -> dict или (dict, HTTP-статус)
+        self.timeout = 30
+        self.concurrency = 'fast'  # пул исполнителя: 'fast' - файловые операции, 'slow' - процессы и системные вызовы
+        self.read_only = False  # bool или read_only(parameters) -> bool: вызов ничего не меняет в системе
+
+    def is_read_only(self, parameters):
+        """Только читающие вызовы пакета выполняются параллельно, остальные - по порядку (см. ToolExecutor)"""
+        if callable(self.read_only):
+            return bool(self.read_only(parameters or {}))
+        return self.read_only
+
+    def json_schema(self):
+        properties = {}
+        for param in self.params:
+            prop = {"type": param.type, "description": f"{param.placeholder} ({param.note})" if param.note else param.placeholder}
+            if param.enum:
+                prop["enum"] = list(param.enum)
+            properties[param.name] = prop
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": [p.name for p in self.params if p.required],
+                },
+            },
+        }
+
+    def prompt_lines(self):
+        lines = [f"- {self.name}: {self.description}"]
+        if self.params_text:
+            lines.append(f"  Параметры: {self.params_text}")
+        elif self.params:
+            lines.append("  Параметры: {" + ", ".join(p.prompt_value() for p in self.params) + "}")
+        else:
+            lines.append("  Параметры: нет.")
+        for label, arguments in self.examples:
+            prefix = f"Пример ({label})" if label else "Пример"
+            lines.append(f"  {prefix}: {ToolCallParser.MARKER} {self.name}({json.dumps(arguments, ensure_ascii=False)})")
+        return lines
+
+
+class ToolRegistry:
+    """Реестр инструментов. Системный промпт генерируется из него один раз и байт-в-байт одинаков
+    для всех клиентов и ходов: Ollama переиспользует KV-кэш общего префикса."""
+
+    PROMPT_HEADER = (
+        "Ты AI-ассистент с полным доступом к компьютеру пользователя.\n"
+        "Это доступные инструменты. Используй их только при необходимости и только по одному за раз.\n"
+        f"Формат вызова: {ToolCallParser.MARKER} имя_инструмента({{\"параметр1\": \"значение1\", \"параметр2\": \"значение2\"}})\n"
+        "Всегда используй двойные кавычки для ключей и строковых значений в JSON.\n"
+        "Для путей в Windows используй двойной обратный слеш: \"C:\\\\Users\\\\User\\\\file.txt\".\n"
+        "\n"
+        "Доступные инструменты:"
+    )
+    PROMPT_FOOTER = "Отвечай на языке пользователя."
+    NATIVE_PROMPT = (
+        "Ты AI-ассистент с полным доступом к компьютеру пользователя.\n"
+        "Инструменты доступны как функции. Используй их только при необходимости и только по одному за раз.\n"
+        "Для путей в Windows используй обратный слеш: C:\\Users\\User\\file.txt.\n"
+        "\n"
+        "Отвечай на языке пользователя."
+    )
+    CATEGORIES = (
+        ('files', "📁 ФАЙЛОВАЯ СИСТЕМА:"),
+        ('system', "💻 СИСТЕМНОЕ УПРАВЛЕНИЕ:"),
+    )
+
+    def __init__(self):
+        self._tools = {}
+        self._aliases = {}
+        self._prompt = None
+        self._schemas = None
+
+    def register(self, spec):
+        self._tools[spec.name] = spec
+        for alias in spec.aliases:
+            self._aliases[alias] = spec.name
+        self._prompt = None
+        self._schemas = None
+        return spec
+
+    def handler(self, name, timeout=30, concurrency='fast', read_only=False):
+        """Декоратор: привязывает функцию-обработчик к уже описанному инструменту"""
+        spec = self._tools[name]
+
+        def bind(func):
+            spec.handler = func
+            spec.timeout = timeout
+            spec.concurrency = concurrency
+            spec.read_only = read_only
+            return func
+        return bind
+
+    def resolve(self, name):
+        """Каноническое имя инструмента (с учетом псевдонимов)"""
+        return self._aliases.get(name, name)
+
+    def get(self, name):
+        return self._tools.get(self.resolve(name))
+
+    def specs(self):
+        return list(self._tools.values())
+
+    def system_prompt(self):
+        if self._prompt is None:
+            blocks = []
+            for category, heading in self.CATEGORIES:
+                lines = [heading]
+                for spec in self._tools.values():
+                    if spec.category == category:
+                        lines.extend(spec.prompt_lines())
+                blocks.append('\n'.join(lines))
+            self._prompt = f"{self.PROMPT_HEADER}\n" + '\n\n'.join(blocks) + f"\n\n{self.PROMPT_FOOTER}"
+        return self._prompt
+
+    def native_prompt(self):
+        """Промпт для режима tools: инструменты описаны JSON-схемами, в тексте только правила"""
+        return self.NATIVE_PROMPT
+
+    def ollama_tools(self):
+        """Список tools для /api/chat (JSON-схемы функций); один и тот же объект для всех запросов"""
+        if self._schemas is None:
+            self._schemas = [spec.json_schema() for spec in self._tools.values()]
+        return self._schemas
+
+    def prompt_info(self):
+        prompt = self.system_prompt()
+        schemas = json.dumps(self.ollama_tools(), ensure_ascii=False, separators=(',', ':'))
+        return {
+            "tokens": ContextBuilder.estimate_tokens(prompt),
+            "chars": len(prompt),
+            "sha1": hashlib.sha1(prompt.encode('utf-8')).hexdigest(),
+            "native_prompt_tokens": ContextBuilder.estimate_tokens(self.native_prompt()),
+            "native_schema_tokens": ContextBuilder.estimate_tokens(schemas),
+        }
+
+    @staticmethod
+    def is_tools_prompt(message):
+        """Системное сообщение с описанием инструментов от старого клиента"""
+        content = message.get('content')
+        return message.get('role') == 'system' and isinstance(content, str) and ToolCallParser.MARKER in content
+
+
+tool_registry = ToolRegistry()
+
+tool_registry.register(ToolSpec(
+    'list_drives', 'files', "Просмотр всех дисков.",
+    examples=[(None, {})]))
+tool_registry.register(ToolSpec(
+    'create_file', 'files', "Создание/перезапись файла с содержимым.",
+    params=[ToolParam('filename', "полный_путь_к_файлу", required=True),
+            ToolParam('content', "содержимое", required=True)],
+    examples=[(None, {"filename": "C:\\temp\\new.txt", "content": "Hello!"})],
+    aliases=('write_file',)))
+tool_registry.register(ToolSpec(
+    'read_file', 'files', "Чтение текстового файла.",
+    params=[ToolParam('filename', "полный_путь_к_файлу", required=True)],
+    examples=[(None, {"filename": "C:\\boot.ini"})]))
+tool_registry.register(ToolSpec(
+    'edit_file', 'files', "Редактирование существующего файла (старое содержимое заменяется новым).",
+    params=[ToolParam('filename', "полный_путь_к_файлу", required=True),
+            ToolParam('content', "новое_содержимое", required=True)]))
+tool_registry.register(ToolSpec(
+    'create_directory', 'files', "Создание новой папки.",
+    params=[ToolParam('dirname', "полный_путь_к_папке", required=True)],
+    examples=[(None, {"dirname": "C:\\NewFolder"})]))
+tool_registry.register(ToolSpec(
+    'list_files', 'files', "Просмотр содержимого папки.",
+    params=[ToolParam('path', "путь_к_папке"),
+            ToolParam('offset', "смещение", type='integer'),
+            ToolParam('limit', "число_элементов", type='integer'),
+            ToolParam('sort', "сортировка", enum=["name", "size", "mtime"]),
+            ToolParam('order', "порядок", enum=["asc", "desc"]),
+            ToolParam('type', "тип", enum=["all", "files", "dirs"])],
+    params_text=('{"path": "путь_к_папке"} (если path не указан, используется текущий или корневой каталог). '
+                 'Необязательно: "offset" и "limit" (страница, по умолчанию 200), "sort": "name"|"size"|"mtime", '
+                 '"order": "asc"|"desc", "type": "all"|"files"|"dirs".'),
+    examples=[(None, {"path": "D:\\Downloads"})]))
+tool_registry.register(ToolSpec(
+    'delete_file', 'files', "Удаление файла или папки (включая содержимое папки).",
+    params=[ToolParam('filename', "полный_путь_к_файлу_или_папке", required=True)]))
+tool_registry.register(ToolSpec(
+    'file_operations', 'files', "Расширенные файловые операции.",
+    params=[ToolParam('operation', "операция", enum=["copy", "move", "search", "permissions"], required=True),
+            ToolParam('source', "путь_источник", required=True),
+            ToolParam('destination', "путь_назначение", note="для copy/move"),
+            ToolParam('pattern', "шаблон", note="для search: glob вроде *.docx или часть имени"),
+            ToolParam('extensions', "расширения", note="для search, через запятую: pdf,docx"),
+            ToolParam('regex', "регулярное_выражение", note="для search, по имени файла"),
+            ToolParam('max_depth', "глубина", type='integer', note="для search"),
+            ToolParam('limit', "максимум_результатов", type='integer', note="для search, по умолчанию 50")],
+    examples=[("поиск", {"operation": "search", "source": "C:\\Users", "pattern": "*.docx"})]))
+tool_registry.register(ToolSpec(
+    'execute_command', 'system', "Выполнение команды в терминале (cmd/bash).",
+    params=[ToolParam('command', "команда_с_аргументами", required=True)],
+    examples=[(None, {"command": "ipconfig /all"})]))
+tool_registry.register(ToolSpec(
+    'run_application', 'system', "Запуск приложения.",
+    params=[ToolParam('app_name', "имя.exe"),
+            ToolParam('app_path', "полный_путь_к\\имя.exe"),
+            ToolParam('arguments', "аргументы")],
+    params_text='{"app_name": "имя.exe"} (для программ из PATH) ИЛИ {"app_path": "полный_путь_к\\\\имя.exe"}. Можно добавить {"arguments": "аргументы"}.',
+    examples=[("имя", {"app_name": "notepad.exe"}),
+              ("путь", {"app_path": "C:\\Program Files\\MyApp\\app.exe", "arguments": "--nogui"})],
+    aliases=('launch_application',)))
+tool_registry.register(ToolSpec(
+    'get_system_info', 'system', "Общая информация о системе (ОС, CPU, GPU, память, диски).",
+    examples=[(None, {})],
+    aliases=('get_cpu_info', 'get_gpu_info', 'get_hardware_info')))
+tool_registry.register(ToolSpec(
+    'manage_processes', 'system', "Управление процессами.",
+    params=[ToolParam('action', "действие", enum=["list", "kill", "info"], required=True),
+            ToolParam('process_name', "имя_процесса", note="для kill/info"),
+            ToolParam('process_id', "id_процесса", type='integer', note="для kill/info"),
+            ToolParam('force', "true/false", type='boolean', note="для kill, необязательно")],
+    examples=[("список", {"action": "list"}),
+              ("завершить", {"action": "kill", "process_name": "notepad.exe"}),
+              ("завершить принудительно по PID", {"action": "kill", "process_id": 1234, "force": True})]))
+tool_registry.register(ToolSpec(
+    'network_info', 'system', "Информация о сетевых интерфейсах и соединениях."))
+tool_registry.register(ToolSpec(
+    'manage_services', 'system', "Управление службами (Windows/Linux).",
+    params=[ToolParam('action', "действие", enum=["list", "start", "stop", "restart", "status"], required=True),
+            ToolParam('service_name', "имя_службы")],
+    examples=[(None, {"action": "status", "service_name": "spooler"})]))
+tool_registry.register(ToolSpec(
+    'find_executable', 'system', "Поиск исполняемого файла в системных путях.",
+    params=[ToolParam('executable_name', "имя_файла.exe", required=True)],
+    examples=[(None, {"executable_name": "python.exe"})]))
+
+
+class ContextBuilder:
+    """Укладывает историю в контекст модели (num_ctx): системные сообщения и последние реплики
+    сохраняются, длинные выводы инструментов обрезаются, старые реплики сворачиваются в краткую
+    выжимку. Точка сворачивания сдвигается шагами, чтобы префикс промпта (и KV-кэш Ollama)
+    не менялся каждый ход. Бюджет считается только от известного окна модели: num_ctx из настроек
+    или из Modelfile (/api/show); иначе настоящее окно неизвестно и история не трогается."""
+
+    MESSAGE_OVERHEAD = 4  # служебные токены шаблона на сообщение
+    IMAGE_TOKENS = 768
+    TOKEN_RE = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+    WINDOW_TTL = 600  # сколько секунд помнить num_ctx из Modelfile (или его отсутствие)
+
+    def __init__(self, default_num_ctx=None, model_num_ctx=None, reserve=1024, keep_recent=4,
+                 tool_output_max_tokens=1024, collapse_step=8, summary_tokens=400, cache_size=8192,
+                 window_lookup=None):
+        self.default_num_ctx = default_num_ctx
+        self.model_num_ctx = dict(model_num_ctx or {})
+        self.window_lookup = window_lookup  # window_lookup(model) -> num_ctx из Modelfile или None
+        self._windows = {}  # модель -> (num_ctx или None, когда узнали)
+        self.reserve = reserve
+        self.keep_recent = keep_recent
+        self.tool_output_max_tokens = tool_output_max_tokens
+        self.collapse_step = collapse_step
+        self.summary_tokens = summary_tokens
+        self.cache_size = cache_size
+        self._token_cache = OrderedDict()
+        self._lock = Lock()
+        self._counters = {
+            'builds': 0,
+            'trimmed_builds': 0,
+            'collapsed_messages': 0,
+            'tool_outputs_truncated': 0,
+            'token_cache_hits': 0,
+            'token_cache_misses': 0,
+            'window_lookups': 0,
+        }
+
+    def num_ctx_for(self, model):
+        """Окно модели: model_num_ctx / num_ctx из настроек, иначе num_ctx из Modelfile; None - неизвестно"""
+        configured = self.model_num_ctx.get(model, self.default_num_ctx)
+        if configured is not None:
+            return int(configured)
+        if self.window_lookup is None:
+            return None
+        with self._lock:
+            cached = self._windows.get(model)
+        if cached is not None and time.monotonic() - cached[1] < self.WINDOW_TTL:
+            return cached[0]
+        try:
+            num_ctx = self.window_lookup(model)
+        except Exception as e:
+            app.logger.warning(f"context: failed to read the context window of {model}: {e}")
+            num_ctx = None
+        with self._lock:
+            self._counters['window_lookups'] += 1
+            self._windows[model] = (num_ctx, time.monotonic())
+        return num_ctx
+
+    @staticmethod
+    def estimate_tokens(text):
+        """Оценка без токенизатора модели: слово ~ 1 токен на каждые 4 (латиница) или 3 (прочие) символа"""
+        count = 0
+        for piece in ContextBuilder.TOKEN_RE.findall(text):
+            count += 1 + (len(piece) - 1) // (4 if piece.isascii() else 3)
+        return count
+
+    def count_text(self, text):
+        key = hashlib.sha1(text.encode('utf-8', 'surrogatepass')).digest()
+        with self._lock:
+            cached = self._token_cache.get(key)
+            if cached is not None:
+                self._token_cache.move_to_end(key)
+                self._counters['token_cache_hits'] += 1
+                return cached
+            self._counters['token_cache_misses'] += 1
+        count = self.estimate_tokens(text)
+        with self._lock:
+            self._token_cache[key] = count
+            while len(self._token_cache) > self.cache_size:
+                self._token_cache.popitem(last=False)
+        return count
+
+    def count_message(self, message):
+        content = message.get('content') or ''
+        return (self.MESSAGE_OVERHEAD + self.count_text(content if isinstance(content, str) else json.dumps(content))
+                + self.IMAGE_TOKENS * len(message.get('images') or []))
+
+    @staticmethod
+    def is_tool_output(message):
+        content = message.get('content')
+        return message.get('role') == 'tool' or (
+            message.get('role') == 'user' and isinstance(content, str) and content.startswith('[TOOL_RESULT'))
+
+    def truncate_tool_output(self, message, max_tokens):
+        content = message['content']
+        tokens = self.count_text(content)
+        if tokens <= max_tokens:
+            return message
+        # Оставляем начало и конец вывода: обычно там заголовок и итог
+        keep_chars = int(len(content) * max_tokens / tokens)
+        head, tail = content[:keep_chars * 2 // 3], content[-(keep_chars // 3):] if keep_chars >= 3 else ''
+        with self._lock:
+            self._counters['tool_outputs_truncated'] += 1
+        truncated = dict(message)
+        truncated['content'] = f"{head}\n... [вывод сокращен: пропущено {len(content) - len(head) - len(tail)} символов] ...\n{tail}"
+        return truncated
+
+    def summarize(self, messages):
+        """Краткая выжимка свернутых реплик: по строке на сообщение, пока хватает бюджета"""
+        lines = []
+        budget = self.summary_tokens
+        for message in messages:
+            if self.is_tool_output(message):
+                continue
+            text = ' '.join(str(message.get('content') or '').split())
+            if not text:
+                continue
+            snippet = text if len(text) <= 160 else text[:157] + '...'
+            line = f"- {message.get('role')}: {snippet}"
+            cost = self.count_text(line)
+            if cost > budget:
+                break
+            budget -= cost
+            lines.append(line)
+        header = f"[Краткое содержание начала диалога: свернуто сообщений - {len(messages)}]"
+        return {"role": "system", "content": '\n'.join([header] + lines)}
+
+    def build(self, messages, num_ctx):
+        """Возвращает (сообщения для отправки, сведения о бюджете). Исходный список не изменяется."""
+        budget = num_ctx - self.reserve
+        with self._lock:
+            self._counters['builds'] += 1
+        system = [m for m in messages if m.get('role') == 'system']
+        turns = [m for m in messages if m.get('role') != 'system']
+        last_tool = max((i for i, m in enumerate(turns) if self.is_tool_output(m)), default=None)
+        # Последнему выводу (на него сейчас отвечает модель) позволено больше, но не больше трети бюджета
+        last_limit = min(self.tool_output_max_tokens * 2, max(self.tool_output_max_tokens, budget // 3))
+        turns = [self.truncate_tool_output(m, last_limit if i == last_tool else self.tool_output_max_tokens)
+                 if self.is_tool_output(m) else m for i, m in enumerate(turns)]
+
+        system_tokens = sum(self.count_message(m) for m in system)
+        costs = [self.count_message(m) for m in turns]
+        total = system_tokens + sum(costs)
+        info = {"num_ctx": num_ctx, "budget": budget, "tokens": total, "collapsed": 0}
+        if total <= budget:
+            return system + turns, info
+
+        # Ищем наименьшую точку сворачивания, кратную collapse_step, при которой остаток помещается
+        limit = max(0, len(turns) - self.keep_recent)
+        cut = 0
+        while cut < limit:
+            cut = min(cut + self.collapse_step, limit)
+            if system_tokens + self.summary_tokens + sum(costs[cut:]) <= budget:
+                break
+        # Оставшаяся часть должна начинаться с реплики пользователя
+        while cut < limit and turns[cut].get('role') != 'user':
+            cut += 1
+        summary = self.summarize(turns[:cut]) if cut else None
+        kept = system + ([summary] if summary else []) + turns[cut:]
+        with self._lock:
+            self._counters['trimmed_builds'] += 1
+            self._counters['collapsed_messages'] += cut
+        info["collapsed"] = cut
+        info["tokens"] = sum(self.count_message(m) for m in kept)
+        return kept, info
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+            data['token_cache_size'] = len(self._token_cache)
+        data['default_num_ctx'] = self.default_num_ctx
+        data['reserve'] = self.reserve
+        with self._lock:
+            data['model_windows'] = {model: num_ctx for model, (num_ctx, _) in self._windows.items()}
+        return data
+
+
+def modelfile_num_ctx(model):
+    """num_ctx, с которым Ollama загружает модель по умолчанию (PARAMETER num_ctx в Modelfile), или None"""
+    parameters = ollama_client.show(model).get('parameters') or ''
+    match = re.search(r'^num_ctx\s+(\d+)', parameters, re.MULTILINE)
+    return int(match.group(1)) if match else None
+
+
+context_builder = ContextBuilder(
+    default_num_ctx=settings.get("num_ctx"),
+    model_num_ctx=settings.get("model_num_ctx"),
+    reserve=int(settings.get("context_reserve_tokens", 1024)),
+    keep_recent=int(settings.get("context_keep_recent", 4)),
+    tool_output_max_tokens=int(settings.get("tool_output_max_tokens", 1024)),
+    window_lookup=modelfile_num_ctx,
+)
+
+
+def apply_context_budget(payload):
+    """Подгоняет payload['messages'] под окно модели и передает Ollama тот num_ctx, под который считался
+    бюджет. Окно - num_ctx запроса (options), настроек или Modelfile; если оно неизвестно, payload не меняется."""
+    if not settings.get("context_management", True):
+        return payload
+    model = payload['model']
+    options = payload.get('options') or {}
+    try:
+        num_ctx = int(options['num_ctx']) if options.get('num_ctx') is not None else context_builder.num_ctx_for(model)
+    except (TypeError, ValueError):
+        return payload  # некорректный num_ctx клиента проверит Ollama
+    if num_ctx is None or num_ctx <= context_builder.reserve:
+        return payload
+    payload['messages'], info = context_builder.build(payload['messages'], num_ctx)
+    payload.setdefault("options", {})["num_ctx"] = num_ctx
+    if info["collapsed"]:
+        app.logger.info(f"context: {model}: collapsed {info['collapsed']} messages, ~{info['tokens']}/{info['budget']} tokens")
+    return payload
+
+
+# Модели, на которых Ollama ответила "does not support tools": для них сразу текстовый режим
+native_tools_unsupported = set()
+
+
+def use_native_tools(data, model):
+    """Структурные вызовы (tools) возможны только при серверном выполнении инструментов.
+    tool_mode: "native" - всегда, "text" - никогда, "auto" - если модель не отказывалась от tools."""
+    if not data.get('server_tools'):
+        return False
+    mode = data.get('tool_mode') or settings.get("tool_mode", "auto")
+    if mode == 'native':
+        return True
+    return mode == 'auto' and model not in native_tools_unsupported
+
+
+def tools_unsupported_error(status, body):
+    return status == 400 and 'does not support tools' in body
+
+
+def build_stream_payload(data):
+    """Собирает payload для потокового /api/chat из тела запроса /generate-stream"""
+    if "modelhs" in data:
+        model = data["modelhs"][-1] if data["modelhs"] else current_model
+    else:
+        model = data.get('model', current_model)
+    
+    # Получаем сообщение пользователя
+    user_message = data.get('message', '')
+    tools_enabled = data.get('tools_enabled', False)
+    
+    if "history" in data:
+        messages = data["history"]
+    else:
+        messages = data.get('messages', [])
+    
+    # Если есть новое сообщение пользователя, добавляем его
+    if user_message:
+        messages.append({"role": "user", "content": user_message})
+    
+    # Промпт инструментов всегда один и тот же и всегда первым сообщением (стабильный префикс для
+    # KV-кэша Ollama); собственные копии промпта от клиентов заменяются канонической
+    native_tools = tools_enabled and use_native_tools(data, model)
+    if tools_enabled:
+        prompt = tool_registry.native_prompt() if native_tools else tool_registry.system_prompt()
+        messages = [{"role": "system", "content": prompt}] + \
+                   [msg for msg in messages if not ToolRegistry.is_tools_prompt(msg) and msg.get('content') != tool_registry.native_prompt()]
+    
+    payload = {
+        "model": model,
+        "messages": messages,
+        "stream": True,
+        "keep_alive": "30m"
+    }
+    if native_tools:
+        payload["tools"] = tool_registry.ollama_tools()
+
+    options = {}
+    model_temp = settings.get("model_temperature")
+    if model_temp is not None:
+        try:
+            options["temperature"] = float(model_temp)
+        except ValueError:
+            app.logger.warning(f"Invalid temperature value in settings: {model_temp}. Using Ollama's default.")
+    
+    if options:
+        payload["options"] = options
+    return apply_context_budget(payload)
+
+
+@app.route('/generate-stream', methods=['POST'])
+def generate_stream():
      
-    global current_model
     try:
         data = request.json
-        model = data.get('model', '')
-        with model_lock:
-            current_model = model
-            with open(LAST_MODEL_FILE, 'w', encoding='utf-8') as f:
-                f.write(model)
-        return jsonify({"status": "success", "model": model})
+        session = None
+        try:
+            max_iterations = max_tool_iterations(data)
+            if data.get('session'):
+                session, data = open_chat_session(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        payload = build_stream_payload(data)
+        ticket = ollama_scheduler.submit(payload['model'], 'interactive')
+        run = StreamRun(payload, tool_loop_for(data, payload, max_iterations), session, ticket,
+                        data.get('stream_format', 'raw'))
+        try:
+            upstream = open_run_stream(run) if ticket.granted else None
+        except Exception:
+            ticket.release()
+            raise
+        stream_registry.register(run)
+        if run.replay is not None:
+            subscriber = run.attach()
+            start_stream_producer(run, upstream)
+            response = Response(stream_run_subscriber(run, subscriber), mimetype='text/event-stream')
+            response.call_on_close(lambda: run.detach(subscriber))
+        else:
+            response = Response(stream_run_frames(run, upstream), mimetype='text/event-stream')
+            # Генератор мог так и не стартовать (клиент ушел до первого кадра) - слоты пула и планировщика
+            # и запись в реестре все равно освобождаем
+            def on_close():
+                if upstream is not None:
+                    upstream.close()
+                run.finish('disconnected')
+            response.call_on_close(on_close)
+        response.headers['X-Stream-Id'] = run.id
+        return response
+    except SchedulerQueueFull as e:
+        return queue_full_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/installed-models', methods=['GET'])
-def get_installed_models():
-     
-    try:
-        result = subprocess.run(["ollama", "list"], capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(result.stderr)
-        output = result.stdout.strip()
-        lines = output.splitlines()
-        if lines and "NAME" in lines[0].upper():
-            lines = lines[1:]
-        models = [line.strip().split()[0] for line in lines if line.strip()]
-        return jsonify(models)
-    except Exception as e:
-        app.logger.error("Error syncing with ollama list: %s", e)
-        return jsonify([])
+@app.route('/generate-stream/<stream_id>', methods=['GET'])
+def resume_stream(stream_id):
+    """Переподключение после обрыва: пропущенные события после Last-Event-ID и дальше живой поток"""
+    run, after, error = resume_target(stream_id, request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    if error is not None:
+        return jsonify(error[0]), error[1]
+    subscriber = run.attach()
+    response = Response(stream_run_subscriber(run, subscriber, after), mimetype='text/event-stream')
+    response.call_on_close(lambda: run.detach(subscriber))
+    response.headers['X-Stream-Id'] = run.id
+    return response
+
+@app.route('/generate-stream/<stream_id>/cancel', methods=['POST'])
+def cancel_stream(stream_id):
+    run = stream_registry.get(stream_id)
+    if run is None:
+        return jsonify({"error": "Stream not found"}), 404
+    cancelled = run.cancel()
+    return jsonify({"status": "success", "cancelled": cancelled, "stream": run.describe()})
+
+@app.route('/streams', methods=['GET'])
+def list_streams():
+    return jsonify({"streams": stream_registry.list(), "stats": stream_registry.stats()})
+
+class LocalTitler:
+    """Заголовок без модели: первая короткая фраза пользователя или ключевые слова последних сообщений
+    (частота с весом реплик пользователя и распространенностью по сообщениям). Работает за миллисекунды."""
+
+    STOP_WORDS = frozenset("""
+        a an the and or but if then else of to in on at by for with from into about as is are was were be been
+        being do does did have has had i you he she it we they me him her us them my your his its our their this
+        that these those what which who whom how why when where there here can could would should will shall may
+        might must not no yes so just also very too please thanks thank hi hello hey ok okay let lets get make
+        some any all more most other such only own same than s t don now up out over again further once
+        и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот
+        от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь опять
+        уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб
+        без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом
+        один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец два об другой хоть
+        после над больше тот через эти нас про всего них какая много разве три эту моя впрочем хорошо свою
+        этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между это эта привет
+        пожалуйста спасибо здравствуйте скажи подскажи помоги расскажи объясни напиши покажи хочу нужно
+        можешь могу знаю давай как-то очень просто который которые которая
+    """.split())
+    # Грубый стемминг: формы одного слова складываются вместе, показывается самая частая форма
+    RU_ENDINGS = ('иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ость', 'ах', 'ях', 'ов',
+                  'ев', 'ей', 'ой', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ом', 'ем',
+                  'ам', 'ям', 'а', 'я', 'ы', 'и', 'у', 'ю', 'е', 'о')
+    EN_ENDINGS = ('ing', 'ed', 'es', 's')
+    RU_VERB_ENDINGS = ('ться', 'тся', 'ать', 'ять', 'ить', 'еть', 'уть', 'ешь', 'ишь')
+    WORD_RE = re.compile(r"[^\W_][\w+#.\-]*[\w+#]|[^\W_]", re.UNICODE)
+    NOISE_RES = (
+        re.compile(r'```[\s\S]*?(```|$)'),
+        re.compile(r'<(think|thought)[^>]*>[\s\S]*?</\1>', re.IGNORECASE),
+        re.compile(r'\[TOOL_RESULT for \w+\]:[\s\S]*?(?=\n\n|$)'),
+        re.compile(r'\[TOOL_CALL\]\s*\w+\s*\([^)]*\)'),
+        re.compile(r'https?://\S+'),
+        re.compile(r'`[^`]*`'),
+    )
+    SENTENCE_RE = re.compile(r'[^.!?\n]+')
+
+    def __init__(self, max_words=6, user_weight=2.0, max_messages=10):
+        self.max_words = max_words
+        self.user_weight = user_weight
+        self.max_messages = max_messages
+
+    def clean(self, text):
+        for pattern in self.NOISE_RES:
+            text = pattern.sub(' ', text)
+        return text
+
+    def stem(self, word):
+        endings = self.RU_ENDINGS if re.search('[а-яё]', word) else self.EN_ENDINGS
+        for ending in endings:
+            if len(word) - len(ending) >= 3 and word.endswith(ending):
+                return word[:-len(ending)]
+        return word
+
+    def tokens(self, text):
+        return [w for w in self.WORD_RE.findall(text) if w.lower() not in self.STOP_WORDS and not w.isdigit() and len(w) > 1]
+
+    def specificity(self, word):
+        if re.search(r'[A-Za-z0-9]', word) or word[:1].isupper():
+            return 1.5
+        if word.lower().endswith(self.RU_VERB_ENDINGS):
+            return 0.5
+        return 1.0
+
+    def fallback(self, text):
+        return "Диалог" if re.search('[А-Яа-яЁё]', text) else "Chat"
+
+    def title(self, history):
+        messages = [m for m in history if m.get('role') in ('user', 'assistant') and isinstance(m.get('content'), str)]
+        messages = messages[-self.max_messages:]
+        texts = [(m['role'], self.clean(m.get('display') or m['content'])) for m in messages]
+        user_texts = [text for role, text in texts if role == 'user' and text.strip()]
+        if not user_texts:
+            return self.fallback(' '.join(text for _, text in texts))
+
+        # Короткий первый вопрос пользователя - уже готовый заголовок
+        first = self.SENTENCE_RE.search(user_texts[0])
+        if first:
+            words = first.group(0).split()
+            content_words = self.tokens(first.group(0))
+            if 2 <= len(words) <= self.max_words + 1 and content_words:
+                return self._format(' '.join(words))
+
+        # Иначе ключевые слова: частота с весом реплик пользователя, бонус словам, которые повторяются
+        # в нескольких сообщениях (тема диалога) и "специфичным" токенам (латиница, цифры, имена)
+        documents = [(role, self.tokens(text)) for role, text in texts]
+        df = {}
+        for _, words in documents:
+            for stem in {self.stem(w.lower()) for w in words}:
+                df[stem] = df.get(stem, 0) + 1
+        scores, surface, first_seen = {}, {}, {}
+        position = 0
+        for role, words in documents:
+            weight = self.user_weight if role == 'user' else 1.0
+            for word in words:
+                stem = self.stem(word.lower())
+                scores[stem] = scores.get(stem, 0.0) + weight * self.specificity(word)
+                forms = surface.setdefault(stem, {})
+                forms[word] = forms.get(word, 0) + 1
+                first_seen.setdefault(stem, position)
+                position += 1
+        for stem in scores:
+            scores[stem] *= 1.0 + math.log(df[stem])
+        best = sorted(scores, key=lambda k: (-scores[k], first_seen[k]))[:min(4, self.max_words)]
+        if not best:
+            return self.fallback(' '.join(user_texts))
+        best.sort(key=lambda k: first_seen[k])
+        return self._format(' '.join(max(surface[k], key=lambda w: (surface[k][w], -len(w))) for k in best))
+
+    def _format(self, text):
+        text = text.strip(' \t"\'«»:;,-')
+        if len(text) > 80:
+            text = text[:80].rsplit(' ', 1)[0]
+        return text[:1].upper() + text[1:]
+
+
+local_titler = LocalTitler()
+
+
+def request_title(history, model_name):
+    """Заголовок диалога от LLM (фоновая задача TitleJobs). Ошибки запроса к Ollama пробрасываются."""
+    relevant_history_messages = [m for m in history if m.get('role') == 'user' or m.get('role') == 'assistant'][-10:]
+    
+    dialog_context_parts = []
+    for m in relevant_history_messages:
+        role = m.get('role', 'unknown').capitalize()
+        content = m.get('content', '')
+        content_preview = (content[:150] + '...') if len(content) > 150 else content
+        dialog_context_parts.append(f"{role}: {content_preview}")
+    dialog_context_for_title = "\n---\n".join(dialog_context_parts)
+    
+    app.logger.warning(f"generate_title: Dialog context for title: {dialog_context_for_title}")
+
+    title_prompt_text = f'''Проанализируй следующий диалог:
+---
+{dialog_context_for_title}
+---
+Твоя задача: придумать ОЧЕНЬ краткий заголовок (от 3 до 7 слов) для этого диалога.
+Заголовок должен быть на том же языке, на котором велся диалог.
+Пожалуйста, помести заголовок ВНУТРИ тегов <title> и </title>.
+Пример: <title>Пример заголовка здесь</title>
+Не добавляй никаких своих мыслей, объяснений или комментариев вне тегов <title>. Твой ответ должен содержать ТОЛЬКО теги <title> и заголовок внутри них.
+'''
+    
+    messages_for_title = [
+        {"role": "user", "content": title_prompt_text.strip()}
+    ]
+    app.logger.warning(f"generate_title: Final prompt for title (single message to LLM): {messages_for_title[0]['content']}")
+
+    payload = {
+        "model": model_name,
+        "messages": messages_for_title,
+        "stream": False,
+        "options": {"temperature": 0.4} # Slightly lower temp for more deterministic titles
+    }
+    app.logger.warning(f"generate_title: Sending payload to Ollama: {json.dumps(payload, ensure_ascii=False, indent=2)}")
+
+    resp = scheduled_chat(payload, priority='background', endpoint='title')
+    resp.raise_for_status()
+    response_data = resp.json()
+    app.logger.warning(f"generate_title: Received response from Ollama: {response_data}")
+
+    raw_content = response_data.get('message', {}).get('content', '').strip()
+    app.logger.warning(f"generate_title: Raw content from model: '{raw_content}'")
+
+    generated_title = ""
+    
+    _, content_cleaned_from_thoughts = StreamEventParser.split(raw_content)
+    content_cleaned_from_thoughts = content_cleaned_from_thoughts.strip()
+    app.logger.warning(f"generate_title: Content after ALL think/thought tags removal: '{content_cleaned_from_thoughts}'")
+
+    title_match = re.search(r'<title>(.*?)</title>', content_cleaned_from_thoughts, re.IGNORECASE | re.DOTALL)
+    
+    if title_match and title_match.group(1).strip():
+        generated_title = title_match.group(1).strip()
+        app.logger.warning(f"generate_title: Title extracted from <title> tags (after pre-cleaning thoughts): '{generated_title}'")
+    else:
+        app.logger.warning(f"generate_title: <title> tags not found or empty in thought-cleaned content. Using this cleaned content for fallback: '{content_cleaned_from_thoughts}'")
+        temp_title = content_cleaned_from_thoughts
+        
+        common_llm_prefixes_patterns = [
+            r"^\s*okay,\s*here's\s*a\s*(?:short\s*)?title(?:.*?)?:\s*",
+            r"^\s*okay,\s*the\s*user\s*wants\s*a\s*title(?:.*?)?:\s*",
+            r"^\s*sure,\s*here's\s*a\s*title:\s*",
+            r"^\s*here's\s*a\s*(?:short\s*)?title:\s*",
+            r"^\s*here\s*is\s*a\s*(?:short\s*)?title:\s*",
+            r"^\s*(?:short\s*)?title\s*is:\s*",
+            r"^\s*title:\s*",
+            r"^\s*вот\s*(?:короткий\s*)?заголовок:\s*",
+            r"^\s*заголовок:\s*",
+            r"^\s*краткий\s*заголовок:\s*"
+        ]
+        original_title_before_prefix_strip = temp_title 
+        for pattern in common_llm_prefixes_patterns:
+            new_title_candidate = re.sub(pattern, '', temp_title, count=1, flags=re.IGNORECASE).strip()
+            if new_title_candidate != temp_title: 
+                app.logger.warning(f"generate_title (fallback): Removed prefix matching '{pattern}'. New: '{new_title_candidate}'")
+                temp_title = new_title_candidate
+                break 
+        if original_title_before_prefix_strip == temp_title: 
+             app.logger.warning(f"generate_title (fallback): No common LLM prefixes found or removed. Title remains: '{temp_title}'")
+        
+        lines = [line.strip() for line in temp_title.splitlines() if line.strip()]
+        if lines:
+            generated_title = lines[0]
+        else:
+            generated_title = "" 
+        app.logger.warning(f"generate_title (fallback): Title after taking first line: '{generated_title}'")
+
+    if generated_title:
+        if (generated_title.startswith('"') and generated_title.endswith('"')) or \
+           (generated_title.startswith("'") and generated_title.endswith("'")):
+            if len(generated_title) > 1:
+               generated_title = generated_title[1:-1]
+        if generated_title.endswith('.'):
+            generated_title = generated_title[:-1]
+    app.logger.warning(f"generate_title: Title after final quote/period removal: '{generated_title}'")
+    
+    if not generated_title:
+        generated_title = "Диалог"
+        app.logger.warning("generate_title: Title is empty after all processing, using default 'Диалог'.")
+
+    app.logger.warning(f"generate_title: Final processed title: '{generated_title}'")
+    return generated_title
+
+
+def title_history_key(history, model_name):
+    """Хэш той части истории, по которой строится заголовок: одинаковые запросы дают один ключ"""
+    relevant = [(m.get('role'), (m.get('content') or '')[:150])
+                for m in history if m.get('role') in ('user', 'assistant')][-10:]
+    return hashlib.sha1(json.dumps([model_name, relevant], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class TitleJob:
+    def __init__(self, key, history, model):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.history = history
+        self.model = model
+        self.chat_ids = set()
+        self.status = 'queued'  # queued | running | done | error
+        self.title = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+    def describe(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "title": self.title,
+            "error": self.error,
+            "model": self.model,
+            "chat_ids": sorted(self.chat_ids),
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class TitleJobs:
+    """Фоновая генерация заголовков: запрос ставит задачу и сразу возвращается, одинаковые запросы
+    (тот же хэш истории) склеиваются в одну задачу, готовые заголовки кэшируются и записываются в чат"""
+
+    def __init__(self, workers=1, cache_size=512, keep_jobs=256):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='title')
+        self._lock = Lock()
+        self._pending = {}  # ключ истории -> незавершенная задача
+        self._jobs = OrderedDict()  # id -> задача (последние keep_jobs)
+        self._cache = OrderedDict()  # ключ истории -> заголовок
+        self.cache_size = cache_size
+        self.keep_jobs = keep_jobs
+        self._counters = {'submitted': 0, 'coalesced': 0, 'cache_hits': 0, 'generated': 0, 'errors': 0}
+
+    def submit(self, history, model, chat_id=None):
+        key = title_history_key(history, model)
+        with self._lock:
+            self._counters['submitted'] += 1
+            job = self._pending.get(key)
+            if job is not None:
+                self._counters['coalesced'] += 1
+                if chat_id is not None:
+                    job.chat_ids.add(chat_id)
+                return job
+            job = TitleJob(key, history, model)
+            if chat_id is not None:
+                job.chat_ids.add(chat_id)
+            self._remember(job)
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self._counters['cache_hits'] += 1
+            else:
+                self._pending[key] = job
+        if cached is not None:
+            self._complete(job, cached)
+        else:
+            self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _remember(self, job):
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.keep_jobs:
+            self._jobs.popitem(last=False)
+
+    def _run(self, job):
+        job.status = 'running'
+        try:
+            title = request_title(job.history, job.model)
+        except Exception as e:
+            app.logger.error(f"TitleJobs: title generation failed: {e}", exc_info=True)
+            with self._lock:
+                self._pending.pop(job.key, None)
+                self._counters['errors'] += 1
+            job.error = str(e)
+            job.status = 'error'
+            job.finished = time.time()
+            job.done.set()
+            return
+        with self._lock:
+            self._pending.pop(job.key, None)
+            self._counters['generated'] += 1
+            self._cache[job.key] = title
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        self._complete(job, title)
+
+    def _complete(self, job, title):
+        with self._lock:
+            chat_ids = sorted(job.chat_ids)
+        for chat_id in chat_ids:
+            try:
+                chat_store.set_auto_title(chat_id, title, 'llm')
+            except Exception as e:
+                app.logger.error(f"TitleJobs: failed to save title for chat {chat_id}: {e}", exc_info=True)
+        job.title = title
+        job.status = 'done'
+        job.finished = time.time()
+        job.done.set()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+            data['pending'] = len(self._pending)
+            data['cached'] = len(self._cache)
+        return data
+
+
+title_jobs = TitleJobs(workers=int(settings.get("title_workers", 1)))
+
+
+@app.route('/generate-title', methods=['POST'])
+def generate_title():
+    try:
+        data = request.json
+        chat_id = data.get('chat_id')
+        chat_id = str(chat_id) if chat_id is not None else None
+        history = data.get('history')
+        chat = None
+        if chat_id is not None:
+            # История целиком читается из хранилища, только если клиент ее не прислал
+            chat = chat_store.get_chat(chat_id) if history is None else chat_store.get_meta(chat_id)
+        if history is None:
+            history = chat['history'] if chat else []
+        # Отдельная (обычно более легкая) модель для заголовков, иначе модель чата
+        model_name = settings.get("title_model") or data.get('model') or current_model
+        upgrade = data.get('upgrade', settings.get("title_llm_upgrade", True))
+
+        if not history:
+            return jsonify({'error': 'История чата пуста для генерации заголовка'}), 400
+
+        # Быстрый локальный заголовок сразу; LLM-заголовок (если нужен) позже заменит его в чате
+        local_title = local_titler.title(history)
+        if chat is not None:
+            if chat.get('titleSource') not in (None,) + ChatStore.AUTO_TITLE_SOURCES:
+                # Чат переименован пользователем: его заголовок сервер не трогает
+                return jsonify({'title': chat.get('chatnamess'), 'title_source': chat.get('titleSource')})
+            chat_store.set_auto_title(chat_id, local_title, 'local')
+        if not upgrade:
+            return jsonify({'title': local_title, 'title_source': 'local'})
+
+        job = title_jobs.submit(history, model_name, chat_id)
+        if data.get('wait'):
+            job.done.wait(float(data.get('timeout', SCHEDULER_WAIT_TIMEOUT)))
+        if job.status == 'done':
+            return jsonify({'title': job.title, 'title_source': 'llm', 'job': job.describe()})
+        if job.status == 'error' and data.get('wait'):
+            return jsonify({'error': job.error, 'job': job.describe()}), 500
+        return jsonify({'title': local_title, 'title_source': 'local', 'job': job.describe()}), 202
+    except Exception as e:
+        app.logger.error(f"generate_title: Error generating title: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/title-jobs/<job_id>', methods=['GET'])
+def get_title_job(job_id):
+    job = title_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Title job not found"}), 404
+    return jsonify(job.describe())
+
+@app.route('/server-stats', methods=['GET'])
+def server_stats():
+    return jsonify({
+        "ollama_client": ollama_client.stats(),
+        "async_server": async_server.stats() if async_server else None,
+        "streams": stream_registry.stats(),
+        "scheduler": ollama_scheduler.stats(),
+        "title_jobs": title_jobs.stats(),
+        "response_cache": response_cache.stats(),
+        "context": context_builder.stats(),
+        "tool_prompt": tool_registry.prompt_info(),
+        "tools": tool_executor.stats(),
+        "reply_checkpoints": reply_checkpoints.stats(),
+        "chat_writes": chat_store.deferred.stats() if chat_store.deferred else None,
+        "file_index": file_index.stats() if file_index else None,
+    })
+
+@app.route('/switch-model', methods=['POST'])
+def switch_model():
+     
+    global current_model
+    try:
+        data = request.json
+        model = data.get('model', '')
+        with model_lock:
+            current_model = model
+            with open(LAST_MODEL_FILE, 'w', encoding='utf-8') as f:
+                f.write(model)
+        return jsonify({"status": "success", "model": model})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/installed-models', methods=['GET'])
+def get_installed_models():
+     
+    try:
+        result = subprocess.run(["ollama", "list"], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(result.stderr)
+        output = result.stdout.strip()
+        lines = output.splitlines()
+        if lines and "NAME" in lines[0].upper():
+            lines = lines[1:]
+        models = [line.strip().split()[0] for line in lines if line.strip()]
+        return jsonify(models)
+    except Exception as e:
+        app.logger.error("Error syncing with ollama list: %s", e)
+        return jsonify([])
+
+@app.route('/delete-model', methods=['POST'])
+def delete_model():
+     
+    data = request.json
+    model = data.get('model')
+    try:
+        result = subprocess.run(["ollama", "rm", model], capture_output=True, text=True)
+        if result.returncode != 0:
+            app.logger.error("Error deleting model: %s", result.stderr)
+            return jsonify({"status": "error", "message": result.stderr}), 500
+        return jsonify({"status": "success"})
+    except Exception as e:
+        app.logger.error("Exception deleting model: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/install-model-stream', methods=['POST'])
+def install_model_stream():
+     
+    data = request.json
+    model_name = data.get("model")
+    if not model_name:
+        return jsonify({"error": "No model name provided"}), 400
+
+    command = ["ollama", "run", model_name]
+    app.logger.info("Installing model via command: %s", " ".join(command))
+
+    def generate():
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for line in iter(process.stdout.readline, ""):
+            yield f"data: {line.strip()}\n\n"
+        process.stdout.close()
+        process.wait()
+        yield "data: DONE\n\n"
+
+    return Response(generate(), mimetype='text/event-stream')
+
+@app.route('/settings', methods=['GET', 'POST'])
+def settings_handler():
+     
+    global settings, current_model
+    if request.method == 'GET':
+        return jsonify(settings)
+    else:
+        try:
+            new_settings = request.json
+            settings.update(new_settings)
+
+            if "model_temperature" in new_settings:
+                try:
+                    settings["model_temperature"] = float(new_settings["model_temperature"])
+                except ValueError:
+                    app.logger.error(f"Invalid temperature value received: {new_settings['model_temperature']}")
+                    # Можно вернуть ошибку или использовать дефолтное значение, пока оставляем как есть, 
+                    # но клиент должен валидировать ввод
+            
+            with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
+                json.dump(settings, f, indent=2, ensure_ascii=False)
+
+            if "default_model" in new_settings:
+                current_model = new_settings["default_model"]
+                with open(LAST_MODEL_FILE, 'w', encoding='utf-8') as f:
+                    f.write(current_model)
+
+            return jsonify({"status": "success"})
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+def get_gpu_info_os_specific():
+    gpus = []
+    try:
+        if platform.system() == "Windows":
+            import wmi # Потребуется установка 'pip install WMI'
+            c = wmi.WMI()
+            for board in c.Win32_VideoController():
+                gpus.append(board.Name)
+        elif platform.system() == "Linux":
+            try:
+                result = subprocess.run(['lspci'], capture_output=True, text=True, check=True)
+                for line in result.stdout.splitlines():
+                    if "VGA compatible controller" in line or "Display controller" in line:
+                        parts = line.split(': ')
+                        if len(parts) > 1:
+                            gpus.append(parts[1].strip())
+            except Exception as e_lspci:
+                app.logger.error(f"Failed to get GPU info from lspci: {e_lspci}")
+                gpus.append("Не удалось получить информацию о GPU (lspci)")
+        # macOS можно добавить позже, если нужно: system_profiler SPDisplaysDataType
+    except ImportError:
+        app.logger.warning("WMI module not found for GPU info on Windows. Try 'pip install WMI'.")
+        gpus.append("Не удалось получить информацию о GPU (WMI модуль не найден)")
+    except Exception as e_gpu:
+        app.logger.error(f"Error getting GPU info: {e_gpu}")
+        gpus.append("Ошибка при получении информации о GPU")
+    return gpus if gpus else ["Информация о GPU недоступна"]
+
+def get_cpu_model_name_os_specific():
+    try:
+        if platform.system() == "Windows":
+            # WMIC может быть медленным, platform.processor() часто достаточно
+            # Если platform.processor() пуст или слишком общий, можно использовать WMIC как fallback
+            # result = subprocess.run(['wmic', 'cpu', 'get', 'Name'], capture_output=True, text=True, check=True)
+            # lines = result.stdout.strip().splitlines()
+            # if len(lines) > 1: return lines[1].strip()
+            return platform.processor() # Пока оставляем platform.processor() для Windows
+        elif platform.system() == "Linux":
+            try:
+                with open('/proc/cpuinfo', 'r') as f:
+                    for line in f:
+                        if "model name" in line:
+                            return line.split(':')[1].strip()
+            except Exception:
+                pass # Если не удалось, вернем platform.processor()
+        elif platform.system() == "Darwin": # macOS
+            try:
+                result = subprocess.run(['sysctl', '-n', 'machdep.cpu.brand_string'], capture_output=True, text=True, check=True)
+                return result.stdout.strip()
+            except Exception:
+                pass
+        return platform.processor() # Fallback для всех остальных или если специфичный метод не сработал
+    except Exception as e_cpu_model:
+        app.logger.error(f"Error getting CPU model name: {e_cpu_model}")
+        return platform.processor() # Fallback
+
+# Tools API для работы с файлами
+@app.route('/api/tools/prompt', methods=['GET'])
+def tools_prompt():
+    """Канонический системный промпт инструментов и его размер в токенах"""
+    info = tool_registry.prompt_info()
+    info["prompt"] = tool_registry.system_prompt()
+    return jsonify(info)
+
+@app.route('/api/tools', methods=['POST'])
+@app.route('/tools', methods=['POST'])
+def execute_tool():
+    """Выполнение инструментов для работы с файлами"""
+    try:
+        data = request.get_json()
+        tool_name = data.get('tool_name') or data.get('tool')  # Поддержка обоих форматов
+        parameters = data.get('parameters', {})
+    except Exception as e:
+        return jsonify({'error': f'Ошибка выполнения инструмента: {str(e)}'}), 500
+    return run_tool(tool_name, parameters)
+
+@app.route('/api/tools/batch', methods=['POST'])
+def execute_tool_batch():
+    """Пакет вызовов: {"calls": [{"tool_name", "parameters", "id"?}, ...], "stream"?}.
+    Читающие вызовы выполняются параллельно, меняющие систему - по порядку (ToolExecutor.run_batch);
+    результаты идут в исходном порядке с временем каждого вызова.
+    С "stream": true результат отдается SSE-событием result, как только готовы он и все предыдущие."""
+    data = request.get_json(silent=True)
+    calls, error = parse_tool_batch(data)
+    if error is not None:
+        return jsonify({'error': error}), 400
+    started = time.perf_counter()
+    if data.get('stream'):
+        def generate():
+            for item in tool_executor.run_batch(calls):
+                yield sse_event('result', item)
+            yield sse_event('end', {'count': len(calls), 'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+        return Response(generate(), mimetype='text/event-stream')
+    results = list(tool_executor.run_batch(calls))
+    return jsonify({'results': results, 'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+
+@app.route('/api/files/search', methods=['POST'])
+def search_files():
+    """Поиск файлов: {"path", "pattern" | "regex" | "extensions", "max_depth"?, "exclude"?, "limit"?,
+    "include_dirs"?, "stream"?}. С "stream": true каждое совпадение сразу отдается SSE-событием match,
+    в конце - событие end со сводкой."""
+    data = request.get_json(silent=True) or {}
+    path = data.get('path') or data.get('source')
+    if not path:
+        return jsonify({'error': 'Не указан путь поиска'}), 400
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        return jsonify({'error': f'Папка не найдена: {path}'}), 404
+    try:
+        search = FileSearch.from_parameters(path, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if data.get('stream'):
+        def generate():
+            for item in search:
+                yield sse_event('match', item)
+            yield sse_event('end', search.summary())
+        return Response(generate(), mimetype='text/event-stream')
+    results = list(search)
+    return jsonify({'results': results, **search.summary()})
+
+@app.route('/api/files/list', methods=['POST'])
+def list_directory():
+    """Листинг папки: {"path", "offset"?, "limit"?, "sort"?: name|size|mtime|none, "order"?, "type"?, "pattern"?,
+    "stream"?}. С "stream": true элементы идут SSE-событиями entries пачками, в конце - end с total;
+    при sort=none папка читается и отдается одновременно, без ограничения limit по умолчанию."""
+    data = request.get_json(silent=True) or {}
+    path = list_files_path(data.get('path'))
+    if not os.path.isdir(path):
+        return jsonify({'error': f'Папка не найдена: {path}'}), 404
+    try:
+        listing, offset, limit = DirListing.from_parameters(path, data, default_limit=None if data.get('stream') else LIST_FILES_LIMIT)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if data.get('stream'):
+        def generate():
+            sent = 0
+            try:
+                for batch in listing.stream(offset, limit):
+                    sent += len(batch)
+                    yield sse_event('entries', {'entries': batch})
+            except OSError as e:
+                yield sse_event('error', {'error': f'Ошибка при чтении папки {path}: {str(e)}'})
+                return
+            yield sse_event('end', {'path': path, 'offset': offset, 'count': sent})
+        return Response(generate(), mimetype='text/event-stream')
+    try:
+        entries, total = listing.page(offset, limit)
+    except PermissionError:
+        return jsonify({'error': f'Нет доступа к папке {path}'}), 403
+    shown = offset + len(entries)
+    return jsonify({'path': path, 'entries': entries, 'total': total, 'offset': offset, 'limit': limit,
+                    'next_offset': shown if shown < total else None})
+
+def call_tool(tool_name, parameters):
+    """Выполняет инструмент в процессе (без HTTP) и возвращает (данные ответа, HTTP-статус)"""
+    return tool_executor.execute(tool_name, parameters)
+
+FILE_SEARCH_TIMEOUT = float(settings.get("file_search_timeout", 60))
+FILE_SEARCH_MAX_LIMIT = int(settings.get("file_search_max_limit", 1000))
+
+
+class FileSearch:
+    """Поиск файлов по дереву папок. Папки читаются через os.scandir несколькими задачами общего пула,
+    поэтому поддеревья сканируются параллельно; совпадения выдаются по мере нахождения. Обход
+    прекращается, как только набрано limit совпадений, истек timeout или потребитель перестал читать."""
+
+    SKIP_DIRS = ('$Recycle.Bin', 'System Volume Information', '.git', 'node_modules', '__pycache__')
+    PARALLEL = int(settings.get("file_search_parallel", 4))  # задач пула на один поиск
+    _pool = ThreadPoolExecutor(max_workers=int(settings.get("file_search_workers", 8)), thread_name_prefix='search')
+
+    def __init__(self, root, pattern=None, regex=None, extensions=None, max_depth=None, exclude=None,
+                 limit=50, include_dirs=False, timeout=None):
+        self.root = os.path.abspath(root)
+        self.limit = limit
+        self.max_depth = max_depth
+        self.include_dirs = include_dirs
+        self.timeout = FILE_SEARCH_TIMEOUT if timeout is None else timeout
+        self.match = self.name_matcher(pattern, regex, extensions)
+        excludes = self.SKIP_DIRS if exclude is None else exclude
+        self._exclude = re.compile('|'.join(fnmatch.translate(e) for e in excludes), re.IGNORECASE) if excludes else None
+        self._lock = Lock()
+        self._stop = threading.Event()
+        self._dirs = deque()  # (путь, глубина) - еще не прочитанные папки
+        self._active = 0
+        self._results = queue.Queue()
+        self.found = 0
+        self.dirs_scanned = 0
+        self.errors = 0
+        self.limited = False
+        self.timed_out = False
+        self.duration = 0.0
+
+    @staticmethod
+    def name_matcher(pattern=None, regex=None, extensions=None):
+        """Проверка имени файла без учета регистра: должны выполниться все заданные условия.
+        pattern с *, ? или [ - glob по всему имени, без них - подстрока (как раньше)"""
+        tests = []
+        if pattern:
+            if any(c in pattern for c in '*?['):
+                tests.append(re.compile(fnmatch.translate(pattern), re.IGNORECASE).match)
+            else:
+                needle = pattern.lower()
+                tests.append(lambda name: needle in name.lower())
+        if regex:
+            tests.append(re.compile(regex, re.IGNORECASE).search)
+        if extensions:
+            if isinstance(extensions, str):
+                extensions = extensions.split(',')
+            suffixes = tuple('.' + e.strip().lstrip('.').lower() for e in extensions if e.strip())
+            tests.append(lambda name: name.lower().endswith(suffixes))
+        return lambda name: all(test(name) for test in tests)
+
+    @staticmethod
+    def parse_parameters(parameters):
+        """Аргументы поиска из параметров инструмента / запроса; ValueError - если параметры неверны"""
+        pattern = parameters.get('pattern')
+        regex = parameters.get('regex')
+        extensions = parameters.get('extensions')
+        if not (pattern or regex or extensions):
+            raise ValueError('Не указан шаблон поиска (pattern, regex или extensions)')
+        if regex:
+            try:
+                re.compile(regex)
+            except re.error as e:
+                raise ValueError(f'Неверное регулярное выражение: {e}')
+        try:
+            limit = int(parameters.get('limit') or 50)
+            max_depth = parameters.get('max_depth')
+            max_depth = None if max_depth in (None, '') else int(max_depth)
+        except (TypeError, ValueError):
+            raise ValueError('limit и max_depth должны быть целыми числами')
+        exclude = parameters.get('exclude')
+        if isinstance(exclude, str):
+            exclude = [e.strip() for e in exclude.split(',') if e.strip()]
+        return {
+            'pattern': pattern, 'regex': regex, 'extensions': extensions, 'max_depth': max_depth,
+            'exclude': exclude, 'limit': max(1, min(limit, FILE_SEARCH_MAX_LIMIT)),
+            'include_dirs': bool(parameters.get('include_dirs')),
+        }
+
+    @classmethod
+    def from_parameters(cls, root, parameters):
+        """Поиск по индексу, если он включен и покрывает root, иначе обход диска"""
+        options = cls.parse_parameters(parameters)
+        if file_index is not None:
+            search = file_index.searcher(root, **options)
+            if search is not None:
+                return search
+        return cls(root, **options)
+
+    def __iter__(self):
+        started = time.perf_counter()
+        deadline = started + self.timeout
+        with self._lock:
+            self._push([(self.root, 0)])
+        yielded = 0
+        try:
+            while yielded < self.limit:
+                try:
+                    item = self._results.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    self.timed_out = True
+                    return
+                if item is None:
+                    return
+                yielded += 1
+                yield item
+        finally:
+            self._stop.set()
+            self.duration = time.perf_counter() - started
+
+    def summary(self):
+        return {
+            'found': self.found,
+            'limited': self.limited,
+            'timed_out': self.timed_out,
+            'dirs_scanned': self.dirs_scanned,
+            'errors': self.errors,
+            'duration_ms': round(self.duration * 1000, 1),
+            'indexed': False,
+        }
+
+    def _push(self, dirs):
+        # Вызывается под self._lock
+        self._dirs.extend(dirs)
+        while self._active < self.PARALLEL and self._active < len(self._dirs):
+            self._active += 1
+            self._pool.submit(self._work)
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if self._stop.is_set() or not self._dirs:
+                    self._active -= 1
+                    if self._active == 0:
+                        self._results.put(None)  # обход закончен
+                    return
+                path, depth = self._dirs.popleft()
+            try:
+                subdirs = self._scan(path, depth)
+            except Exception as e:
+                app.logger.error(f"FileSearch: failed to scan {path}: {e}")
+                subdirs = []
+            with self._lock:
+                self.dirs_scanned += 1
+                if subdirs and not self._stop.is_set():
+                    self._push(subdirs)
+
+    def _scan(self, path, depth):
+        subdirs = []
+        descend = self.max_depth is None or depth < self.max_depth
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if self._stop.is_set():
+                        break
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    if is_dir and self._exclude is not None and (
+                            self._exclude.match(entry.name) or self._exclude.match(entry.path)):
+                        continue
+                    if (self.include_dirs or not is_dir) and self.match(entry.name):
+                        self._found(entry, is_dir)
+                    if is_dir and descend:
+                        subdirs.append((entry.path, depth + 1))
+        except OSError:
+            with self._lock:
+                self.errors += 1
+        return subdirs
+
+    def _found(self, entry, is_dir):
+        with self._lock:
+            if self.found >= self.limit:
+                return
+            self.found += 1
+            if self.found >= self.limit:
+                self.limited = True
+                self._stop.set()
+        item = {'path': entry.path, 'type': 'dir' if is_dir else 'file'}
+        if not is_dir:
+            try:
+                stat = entry.stat()
+                item['size'] = stat.st_size
+                item['mtime'] = stat.st_mtime
+            except OSError:
+                pass
+        self._results.put(item)
+
+
+class InotifyWatcher:
+    """Наблюдение за папками через inotify (Linux, через ctypes). Где inotify нет, available = False
+    и индекс обновляется только периодическими пересканированиями"""
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; за ним имя длиной len
+
+    def __init__(self):
+        self.fd = None
+        self.exhausted = False  # исчерпан лимит fs.inotify.max_user_watches
+        self._wds = {}  # wd -> путь папки
+        self._paths = {}  # путь папки -> wd
+        if platform.system() != 'Linux':
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            app.logger.warning(f"inotify unavailable: {e}")
+            return
+        if fd >= 0:
+            self.fd = fd
+
+    @property
+    def available(self):
+        return self.fd is not None
+
+    @property
+    def watches(self):
+        return len(self._wds)
+
+    def covers(self, path):
+        """Изменения файлов папки приходят событиями (наблюдение установлено и не снято ядром)"""
+        return path in self._paths
+
+    def watch(self, path):
+        if self.fd is None or self.exhausted or path in self._paths:
+            return
+        wd = self._add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                self.exhausted = True
+                app.logger.warning("inotify watch limit reached, falling back to periodic rescans for the rest")
+            return
+        self._wds[wd] = path
+        self._paths[path] = wd
+
+    def read(self, timeout):
+        """Ждет события до timeout секунд. Возвращает множество папок, в которых что-то изменилось,
+        или None, если очередь ядра переполнилась и события потеряны"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        dirty = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                path = self._wds.get(wd)
+                if path is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    # Папка удалена или перемещена - ядро уже сняло наблюдение
+                    del self._wds[wd]
+                    self._paths.pop(path, None)
+                elif mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    dirty.add(os.path.dirname(path))
+                else:
+                    dirty.add(path)
+        return None if overflow else dirty
+
+
+class FileIndex:
+    """Постоянный индекс файлов настроенных корней в SQLite (включается настройкой file_index_roots).
+    Путь хранится деревом: папка - (родитель, имя), файл - (папка, имя, размер, mtime, расширение),
+    поэтому строки полных путей не повторяются, а память процесса не зависит от числа файлов: в ней
+    только LRU-кэш путей папок. Фоновый поток строит индекс, затем держит его актуальным по событиям
+    inotify и периодически пересканирует: папки под наблюдением перечитываются, только если изменилось
+    их mtime, остальные (нет inotify, исчерпан лимит наблюдений) - каждый раз, со stat всех файлов."""
+
+    SCHEMA_VERSION = 1
+    NEW = -1.0  # mtime еще не прочитанной папки
+    SKIPPED = -2.0  # папка-исключение или символическая ссылка: видна в листинге, внутрь не заходим
+    BATCH_DIRS = 256  # папок на одну транзакцию записи
+    PATH_CACHE_SIZE = 65536
+
+    def __init__(self, db_path, roots, rescan_interval=300, use_inotify=True, exclude=FileSearch.SKIP_DIRS):
+        self.db_path = db_path
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.rescan_interval = rescan_interval
+        self.exclude = tuple(exclude)
+        self._exclude = re.compile('|'.join(fnmatch.translate(e) for e in exclude), re.IGNORECASE) if exclude else None
+        self.watcher = InotifyWatcher() if use_inotify else None
+        self._local = threading.local()
+        self._paths = OrderedDict()  # id папки -> полный путь
+        self._paths_lock = Lock()
+        self._ready = set()  # корни, полностью прочитанные хотя бы раз
+        self._thread = None
+        self._lock = Lock()
+        self._counters = {'dirs_synced': 0, 'rescans': 0, 'events': 0, 'queries': 0, 'listings': 0}
+        self._init_schema()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # Условия текущего запроса этого потока (см. query) - функции регистрируются один раз на соединение
+            conn.create_function('fs_match', 1, lambda name: self._local.match(name))
+            conn.create_function('fs_excluded', 1, lambda name: self._local.excluded(name))
+            self._local.conn = conn
+        return conn
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._counters[key] += n
+
+    def _init_schema(self):
+        with _SqliteTransaction(self._conn()) as conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+                conn.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                    id INTEGER PRIMARY KEY,
+                    parent INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    mtime REAL NOT NULL)""")
+                conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS dirs_by_parent ON dirs (parent, name)')
+                conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                    dir INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    ext TEXT NOT NULL,
+                    PRIMARY KEY (dir, name)) WITHOUT ROWID""")
+                conn.execute('CREATE INDEX IF NOT EXISTS files_by_ext ON files (ext)')
+                conn.execute('CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY, dir INTEGER NOT NULL, scanned_at REAL)')
+            conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='file-index', daemon=True)
+        self._thread.start()
+
+    # --- Запросы ---
+
+    def _root_of(self, path):
+        for root in tuple(self._ready):
+            if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+                return root
+        return None
+
+    def _lookup(self, path):
+        """id папки по полному пути, если она в готовом корне индекса"""
+        root = self._root_of(path)
+        if root is None:
+            return None
+        conn = self._conn()
+        row = conn.execute('SELECT dir FROM roots WHERE path = ?', (root,)).fetchone()
+        if row is None:
+            return None
+        dir_id = row[0]
+        rest = os.path.relpath(path, root)
+        for name in ([] if rest == '.' else rest.split(os.sep)):
+            row = conn.execute('SELECT id FROM dirs WHERE parent = ? AND name = ?', (dir_id, name)).fetchone()
+            if row is None:
+                return None
+            dir_id = row[0]
+        return dir_id
+
+    def dir_path(self, dir_id):
+        with self._paths_lock:
+            path = self._paths.get(dir_id)
+            if path is not None:
+                self._paths.move_to_end(dir_id)
+                return path
+        parent, name = self._conn().execute('SELECT parent, name FROM dirs WHERE id = ?', (dir_id,)).fetchone()
+        path = name if parent == 0 else os.path.join(self.dir_path(parent), name)
+        with self._paths_lock:
+            self._paths[dir_id] = path
+            if len(self._paths) > self.PATH_CACHE_SIZE:
+                self._paths.popitem(last=False)
+        return path
+
+    def searcher(self, root, pattern=None, regex=None, extensions=None, max_depth=None, exclude=None,
+                 limit=50, include_dirs=False):
+        """IndexSearch для поиска под root или None, если индекс его не покрывает. Явный exclude,
+        который не скрывает папки, пропущенные при индексации, индексом не обслужить."""
+        if exclude is not None and not {e.lower() for e in self.exclude} <= {e.lower() for e in exclude}:
+            return None
+        dir_id = self._lookup(os.path.abspath(root))
+        if dir_id is None:
+            return None
+        return IndexSearch(self, dir_id, pattern, regex, extensions, max_depth, exclude, limit, include_dirs)
+
+    def query(self, dir_id, match, extensions, max_depth, excluded, limit, include_dirs):
+        conn = self._conn()
+        self._count('queries')
+        subtree = """WITH RECURSIVE sub(id, name, depth) AS (
+                SELECT ?, '', 0
+                UNION ALL
+                SELECT d.id, d.name, sub.depth + 1 FROM dirs d JOIN sub ON d.parent = sub.id
+                WHERE sub.depth < ? AND NOT fs_excluded(d.name))"""
+        depth = (1 << 30) if max_depth is None else max_depth
+        # Обе выборки (не больше limit строк) читаются сразу: условия запроса лежат в self._local,
+        # и между yield их мог бы заменить другой запрос того же потока
+        self._local.match = match
+        self._local.excluded = excluded or (lambda name: False)
+        dirs = []
+        if include_dirs:
+            dirs = conn.execute(f"{subtree} SELECT id FROM sub WHERE depth > 0 AND fs_match(name) LIMIT ?",
+                                (dir_id, depth + 1, limit)).fetchall()
+        files = []
+        if len(dirs) < limit:
+            where = 'fs_match(f.name)'
+            params = [dir_id, depth]
+            if extensions:
+                where += f" AND f.ext IN ({','.join('?' * len(extensions))})"
+                params.extend(extensions)
+            params.append(limit - len(dirs))
+            files = conn.execute(
+                f"{subtree} SELECT f.dir, f.name, f.size, f.mtime FROM sub JOIN files f ON f.dir = sub.id "
+                f"WHERE {where} LIMIT ?", params).fetchall()
+        for (found_id,) in dirs:
+            yield {'path': self.dir_path(found_id), 'type': 'dir'}
+        for parent, name, size, mtime in files:
+            yield {'path': os.path.join(self.dir_path(parent), name), 'type': 'file', 'size': size, 'mtime': mtime}
+
+    def list_dir(self, path):
+        """Содержимое папки из индекса: {имя: (папка ли, размер, mtime)}, или None, если папки нет в индексе,
+        она изменилась после последнего чтения (ее mtime не совпадает с записанным) или за ней не следит
+        inotify: перезапись файла не меняет mtime папки, и без событий размеры в индексе могут устареть"""
+        if not self.watched(path):
+            return None
+        dir_id = self._lookup(path)
+        if dir_id is None:
+            return None
+        conn = self._conn()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if conn.execute('SELECT mtime FROM dirs WHERE id = ?', (dir_id,)).fetchone()[0] != mtime:
+            return None
+        entries = {name: (True, None, mtime if mtime >= 0 else None) for name, mtime in
+                   conn.execute('SELECT name, mtime FROM dirs WHERE parent = ?', (dir_id,))}
+        for name, size, file_mtime in conn.execute('SELECT name, size, mtime FROM files WHERE dir = ?', (dir_id,)):
+            entries[name] = (False, size, file_mtime)
+        self._count('listings')
+        return entries
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+        data['roots'] = self.roots
+        data['ready'] = sorted(self._ready)
+        data['inotify'] = bool(self.watcher and self.watcher.available)
+        data['watches'] = self.watcher.watches if self.watcher else 0
+        try:
+            data['db_bytes'] = os.path.getsize(self.db_path)
+        except OSError:
+            data['db_bytes'] = 0
+        return data
+
+    # --- Построение и обновление ---
+
+    def _run(self):
+        try:
+            self._drop_stale_roots()
+            for root in self.roots:
+                self._index_root(root)
+        except Exception as e:
+            app.logger.error(f"FileIndex: initial scan failed: {e}", exc_info=True)
+        watching = self.watcher is not None and self.watcher.available
+        next_rescan = time.time() + self.rescan_interval
+        while True:
+            try:
+                if watching:
+                    dirty = self.watcher.read(max(0.0, min(next_rescan - time.time(), 1.0)))
+                    if dirty is None:
+                        next_rescan = 0  # события потеряны - пересканировать все
+                    elif dirty:
+                        self._count('events', len(dirty))
+                        for path in sorted(dirty):
+                            self._sync_path(path)
+                else:
+                    time.sleep(max(0.0, next_rescan - time.time()))
+                if time.time() >= next_rescan:
+                    self._count('rescans')
+                    for root in self.roots:
+                        self._index_root(root)
+                    next_rescan = time.time() + self.rescan_interval
+            except Exception as e:
+                app.logger.error(f"FileIndex: update failed: {e}", exc_info=True)
+                time.sleep(1)
+
+    def _drop_stale_roots(self):
+        with _SqliteTransaction(self._conn()) as conn:
+            for path, dir_id in conn.execute('SELECT path, dir FROM roots').fetchall():
+                if path not in self.roots:
+                    self._delete_dirs(conn, dir_id)
+                    conn.execute('DELETE FROM roots WHERE path = ?', (path,))
+
+    def _index_root(self, root):
+        """Первое построение или пересканирование корня: обходится все дерево, перечитываются
+        папки, чье mtime изменилось с прошлого раза, и все папки без наблюдения inotify"""
+        conn = self._conn()
+        row = conn.execute('SELECT r.dir, d.id FROM roots r LEFT JOIN dirs d ON d.id = r.dir WHERE r.path = ?',
+                           (root,)).fetchone()
+        if row is None or row[1] is None:
+            # Корня еще нет в индексе или он был удален (строка папки удалена вместе с поддеревом):
+            # id корня определяется заново, чтобы созданный снова корень проиндексировался
+            if not os.path.isdir(root):
+                self._ready.discard(root)
+                return
+            with _SqliteTransaction(conn):
+                conn.execute('DELETE FROM roots WHERE path = ?', (root,))
+                dir_id = conn.execute('INSERT INTO dirs (parent, name, mtime) VALUES (0, ?, ?)', (root, self.NEW)).lastrowid
+                conn.execute('INSERT INTO roots (path, dir) VALUES (?, ?)', (root, dir_id))
+        else:
+            dir_id = row[0]
+        self._walk([(dir_id, root)], recursive=True)
+        if conn.execute('SELECT 1 FROM dirs WHERE id = ?', (dir_id,)).fetchone() is None:
+            self._ready.discard(root)  # корень пропал во время обхода
+            return
+        conn.execute('UPDATE roots SET scanned_at = ? WHERE path = ?', (time.time(), root))
+        self._ready.add(root)
+
+    def _sync_path(self, path):
+        """Папка, о которой сообщил inotify: перечитывается она сама и новые подпапки"""
+        dir_id = self._lookup(path)
+        if dir_id is not None:
+            self._walk([(dir_id, path)], recursive=False, force=True)
+
+    def _walk(self, stack, recursive, force=False):
+        conn = self._conn()
+        while stack:
+            with _SqliteTransaction(conn):
+                for _ in range(self.BATCH_DIRS):
+                    if not stack:
+                        break
+                    dir_id, path = stack.pop()
+                    for child_id, child_path, is_new in self._refresh_dir(conn, dir_id, path, force):
+                        if recursive or is_new:
+                            stack.append((child_id, child_path))
+                    force = False  # принудительно перечитывается только исходная папка
+
+    def watched(self, path):
+        return self.watcher is not None and self.watcher.covers(path)
+
+    def _refresh_dir(self, conn, dir_id, path, force):
+        """Сверяет папку с диском, если она изменилась или за ней не следит inotify (тогда заново читаются
+        stat всех файлов). Возвращает подпапки для обхода: (id, путь, новая ли)"""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._delete_dirs(conn, dir_id)
+            return []
+        if self.watcher is not None:
+            self.watcher.watch(path)
+        stored = conn.execute('SELECT mtime FROM dirs WHERE id = ?', (dir_id,)).fetchone()
+        if stored is None:
+            return []
+        is_new = stored[0] == self.NEW
+        if force or mtime != stored[0] or not self.watched(path):
+            self._sync_dir(conn, dir_id, path, mtime)
+        return [(child_id, os.path.join(path, name), is_new or child_mtime == self.NEW)
+                for child_id, name, child_mtime in conn.execute(
+                    'SELECT id, name, mtime FROM dirs WHERE parent = ? AND mtime != ?', (dir_id, self.SKIPPED))]
+
+    def _sync_dir(self, conn, dir_id, path, mtime):
+        files = {}
+        subdirs = {}
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            skip = entry.is_symlink() or (self._exclude is not None and self._exclude.match(entry.name))
+                            subdirs[entry.name] = self.SKIPPED if skip else self.NEW
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            files[entry.name] = (stat.st_size, stat.st_mtime)
+                    except OSError:
+                        continue
+        except OSError:
+            return
+        old_files = {name: (size, file_mtime) for name, size, file_mtime in
+                     conn.execute('SELECT name, size, mtime FROM files WHERE dir = ?', (dir_id,))}
+        conn.executemany('DELETE FROM files WHERE dir = ? AND name = ?',
+                         [(dir_id, name) for name in old_files.keys() - files.keys()])
+        conn.executemany('INSERT OR REPLACE INTO files (dir, name, size, mtime, ext) VALUES (?, ?, ?, ?, ?)',
+                         [(dir_id, name, size, file_mtime, os.path.splitext(name)[1][1:].lower())
+                          for name, (size, file_mtime) in files.items() if old_files.get(name) != (size, file_mtime)])
+        old_dirs = {name: (child_id, child_mtime) for child_id, name, child_mtime in
+                    conn.execute('SELECT id, name, mtime FROM dirs WHERE parent = ?', (dir_id,))}
+        for name, (child_id, child_mtime) in old_dirs.items():
+            if name not in subdirs or (child_mtime == self.SKIPPED) != (subdirs[name] == self.SKIPPED):
+                self._delete_dirs(conn, child_id)
+        conn.executemany('INSERT OR IGNORE INTO dirs (parent, name, mtime) VALUES (?, ?, ?)',
+                         [(dir_id, name, kind) for name, kind in subdirs.items()])
+        conn.execute('UPDATE dirs SET mtime = ? WHERE id = ?', (mtime, dir_id))
+        self._count('dirs_synced')
+
+    def _delete_dirs(self, conn, dir_id):
+        """Удаляет папку со всем поддеревом"""
+        ids = [row[0] for row in conn.execute(
+            """WITH RECURSIVE sub(id) AS (SELECT ? UNION ALL SELECT d.id FROM dirs d JOIN sub ON d.parent = sub.id)
+               SELECT id FROM sub""", (dir_id,))]
+        conn.executemany('DELETE FROM files WHERE dir = ?', [(i,) for i in ids])
+        conn.executemany('DELETE FROM dirs WHERE id = ?', [(i,) for i in ids])
+        with self._paths_lock:
+            for i in ids:
+                self._paths.pop(i, None)
+
+
+class IndexSearch:
+    """Поиск по FileIndex с тем же интерфейсом, что у FileSearch: итерация по совпадениям и summary()"""
+
+    timed_out = False
+    timeout = 0
+
+    def __init__(self, index, dir_id, pattern, regex, extensions, max_depth, exclude, limit, include_dirs):
+        self.index = index
+        self.dir_id = dir_id
+        self.limit = limit
+        self.max_depth = max_depth
+        self.include_dirs = include_dirs
+        self.match = FileSearch.name_matcher(pattern, regex, extensions)
+        # Условие на расширение сужает выборку по индексу files_by_ext
+        if isinstance(extensions, str):
+            extensions = extensions.split(',')
+        self.extensions = [e.strip().lstrip('.').lower() for e in extensions or () if e.strip()]
+        simple = re.fullmatch(r'\*\.(\w+)', pattern or '')
+        if simple and not self.extensions:
+            self.extensions = [simple.group(1).lower()]
+        self.excluded = None
+        if exclude:
+            excluded = re.compile('|'.join(fnmatch.translate(e) for e in exclude), re.IGNORECASE)
+            self.excluded = lambda name: excluded.match(name) is not None
+        self.found = 0
+        self.limited = False
+        self.duration = 0.0
+
+    def __iter__(self):
+        started = time.perf_counter()
+        try:
+            for item in self.index.query(self.dir_id, self.match, self.extensions, self.max_depth,
+                                         self.excluded, self.limit, self.include_dirs):
+                self.found += 1
+                yield item
+            self.limited = self.found >= self.limit
+        finally:
+            self.duration = time.perf_counter() - started
+
+    def summary(self):
+        return {
+            'found': self.found,
+            'limited': self.limited,
+            'timed_out': False,
+            'dirs_scanned': 0,
+            'errors': 0,
+            'duration_ms': round(self.duration * 1000, 1),
+            'indexed': True,
+        }
+
+
+file_index = None  # создается и запускается при старте сервера (см. __main__), не при импорте модуля
+
+
+LIST_FILES_LIMIT = int(settings.get("list_files_limit", 200))
+LIST_FILES_MAX_LIMIT = int(settings.get("list_files_max_limit", 5000))
+
+
+def list_files_path(path):
+    """Путь папки для листинга: без path - корень системы, относительный - от текущего каталога"""
+    if not path:
+        path = 'C:\\' if platform.system() == 'Windows' else '/'
+
+    # Поддержка абсолютных и относительных путей
+    if not os.path.isabs(path):
+        path = os.path.abspath(path)
+
+    # Нормализуем путь для Windows
+    path = os.path.normpath(path)
+
+    # Специальная обработка для корневых дисков Windows
+    if platform.system() == 'Windows' and len(path) == 2 and path[1] == ':':
+        path = path + '\\'
+    return path
+
+
+class DirListing:
+    """Листинг папки через os.scandir. Тип элемента берется из DirEntry без stat; stat (размер, mtime)
+    делается только если он нужен: для сортировки по size/mtime или для элементов выдаваемой страницы.
+    Проиндексированная папка читается из FileIndex."""
+
+    SORTS = ('name', 'size', 'mtime', 'none')
+    TYPES = ('all', 'files', 'dirs')
+
+    def __init__(self, path, sort='name', reverse=False, kind='all', pattern=None):
+        self.path = path
+        self.sort = sort
+        self.reverse = reverse
+        self.kind = kind
+        self.match = FileSearch.name_matcher(pattern) if pattern else None
+
+    @classmethod
+    def from_parameters(cls, path, parameters, default_limit=LIST_FILES_LIMIT):
+        """(листинг, offset, limit) из параметров инструмента / запроса; ValueError - если они неверны"""
+        sort = parameters.get('sort') or 'name'
+        if sort not in cls.SORTS:
+            raise ValueError(f"sort должен быть одним из: {', '.join(cls.SORTS)}")
+        kind = parameters.get('type') or 'all'
+        if kind not in cls.TYPES:
+            raise ValueError(f"type должен быть одним из: {', '.join(cls.TYPES)}")
+        order = parameters.get('order') or 'asc'
+        if order not in ('asc', 'desc'):
+            raise ValueError('order должен быть asc или desc')
+        try:
+            offset = max(0, int(parameters.get('offset') or 0))
+            limit = parameters.get('limit')
+            limit = default_limit if limit in (None, '') else max(1, min(int(limit), LIST_FILES_MAX_LIMIT))
+        except (TypeError, ValueError):
+            raise ValueError('offset и limit должны быть целыми числами')
+        return cls(path, sort, order == 'desc', kind, parameters.get('pattern')), offset, limit
+
+    def _wanted(self, name, is_dir):
+        if self.kind == 'files' and is_dir or self.kind == 'dirs' and not is_dir:
+            return False
+        return self.match is None or self.match(name)
+
+    def scan(self):
+        """Элементы в порядке папки: {'name', 'type', 'size', 'mtime'}; у еще не прочитанных stat - '_entry'"""
+        wanted = self._wanted if self.kind != 'all' or self.match is not None else None
+        indexed = file_index.list_dir(self.path) if file_index is not None else None
+        if indexed is not None:
+            for name, (is_dir, size, mtime) in indexed.items():
+                if wanted is None or wanted(name, is_dir):
+                    yield {'name': name, 'type': 'dir' if is_dir else 'file', 'size': size, 'mtime': mtime}
+            return
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        is_dir = True
+                    elif entry.is_file():
+                        is_dir = False
+                    else:
+                        continue  # битые ссылки, сокеты и т.п.
+                except OSError:
+                    continue
+                if wanted is None or wanted(entry.name, is_dir):
+                    yield {'name': entry.name, 'type': 'dir' if is_dir else 'file', '_entry': entry}
+
+    @staticmethod
+    def stat(item):
+        entry = item.pop('_entry', None)
+        if entry is not None:
+            try:
+                stat = entry.stat()
+                item['size'] = None if item['type'] == 'dir' else stat.st_size
+                item['mtime'] = stat.st_mtime
+            except OSError:
+                item['size'] = item['mtime'] = None
+                item['denied'] = True
+        return item
+
+    def _sorted(self, items):
+        # Ключи - одиночные значения, а не кортежи: на сотнях тысяч элементов это в разы быстрее
+        if self.sort == 'none':
+            return items
+        by_name = lambda item: item['name'].lower()
+        if self.sort == 'mtime':
+            return sorted(items, key=lambda item: item['mtime'] or 0, reverse=self.reverse)
+        dirs = sorted((item for item in items if item['type'] == 'dir'), key=by_name, reverse=self.reverse)
+        files = [item for item in items if item['type'] != 'dir']
+        if self.sort == 'size':
+            # У папок размера нет: при сортировке по возрастанию они идут первыми, по убыванию - последними
+            files.sort(key=lambda item: item['size'] or 0, reverse=self.reverse)
+            return files + dirs if self.reverse else dirs + files
+        # По имени: папки перед файлами, как в проводнике
+        files.sort(key=by_name, reverse=self.reverse)
+        return dirs + files
+
+    def page(self, offset, limit):
+        """Страница отсортированного листинга и общее число элементов"""
+        items = list(self.scan())
+        if self.sort in ('size', 'mtime'):
+            for item in items:
+                self.stat(item)
+        items = self._sorted(items)
+        return [self.stat(item) for item in items[offset:offset + limit]], len(items)
+
+    def stream(self, offset=0, limit=None, chunk=500):
+        """Пачки элементов для больших папок. Без сортировки (sort=none) элементы отдаются по ходу
+        чтения папки, без накопления всего листинга в памяти"""
+        if self.sort == 'none':
+            items = self.scan()
+        else:
+            items = iter(self.page(0, 1 << 62)[0])
+        batch = []
+        for index, item in enumerate(items):
+            if index < offset:
+                continue
+            if limit is not None and index >= offset + limit:
+                break
+            batch.append(self.stat(item))
+            if len(batch) >= chunk:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def format_size(size):
+        if size < 1024:
+            return f"{size} B"
+        elif size < 1024*1024:
+            return f"{size/1024:.1f} KB"
+        elif size < 1024*1024*1024:
+            return f"{size/(1024*1024):.1f} MB"
+        return f"{size/(1024*1024*1024):.1f} GB"
+
+    @classmethod
+    def format_line(cls, item):
+        if item.get('denied'):
+            return f"🔒 {item['name']} (нет доступа)"
+        if item['type'] == 'dir':
+            return f"📁 {item['name']}/"
+        return f"📄 {item['name']} ({cls.format_size(item['size'])})"
+
+
+@tool_registry.handler('list_drives', timeout=10, concurrency='fast', read_only=True)
+def tool_list_drives(parameters):
+    """Показать все доступные диски в системе"""
+    drives = []
+
+    if platform.system() == 'Windows':
+        for letter in string.ascii_uppercase:
+            drive = f"{letter}:\\"
+            if os.path.exists(drive):
+                try:
+                    # Проверяем доступность диска
+                    os.listdir(drive)
+                    drives.append(f"💾 {drive}")
+                except (PermissionError, OSError):
+                    drives.append(f"🔒 {drive} (нет доступа)")
+    else:
+        # Unix-подобные системы
+        drives.append("💾 / (корневая файловая система)")
+        # Добавляем популярные точки монтирования
+        mount_points = ['/mnt', '/media', '/Volumes', '/home', '/usr', '/var', '/tmp']
+        for mount in mount_points:
+            if os.path.exists(mount) and os.path.isdir(mount):
+                drives.append(f"📁 {mount}")
+
+    drives_list = '\n'.join(drives) if drives else 'Диски не найдены'
+    return {'result': f'Доступные диски и основные папки:\n{drives_list}'}
+
+@tool_registry.handler('create_file', timeout=30, concurrency='fast')
+def tool_create_file(parameters):
+    """Создание или перезапись файла"""
+    filename = parameters.get('filename')
+    content = parameters.get('content', '')
+
+    if not filename:
+        return {'error': 'Не указано имя файла'}, 400
+
+    # Поддержка абсолютных и относительных путей
+    if not os.path.isabs(filename):
+        filename = os.path.abspath(filename)
+
+    # Создаем директории если их нет
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+    return {'result': f'Файл {filename} создан успешно'}
+
+@tool_registry.handler('read_file', timeout=30, concurrency='fast', read_only=True)
+def tool_read_file(parameters):
+    """Чтение текстового файла"""
+    filename = parameters.get('filename')
+
+    if not filename:
+        return {'error': 'Не указано имя файла'}, 400
+
+    # Поддержка абсолютных и относительных путей
+    if not os.path.isabs(filename):
+        filename = os.path.abspath(filename)
+
+    if not os.path.exists(filename):
+        return {'error': f'Файл {filename} не найден'}, 404
+
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            content = f.read()
+        return {'result': f'Содержимое файла {filename}:\n{content}'}
+    except UnicodeDecodeError:
+        return {'error': f'Не удается прочитать файл {filename} (возможно, это бинарный файл)'}, 400
+
+@tool_registry.handler('create_directory', timeout=10, concurrency='fast')
+def tool_create_directory(parameters):
+    """Создание папки (вместе с родительскими)"""
+    dirname = parameters.get('dirname')
+
+    if not dirname:
+        return {'error': 'Не указано имя папки'}, 400
+
+    # Поддержка абсолютных и относительных путей
+    if not os.path.isabs(dirname):
+        dirname = os.path.abspath(dirname)
+
+    os.makedirs(dirname, exist_ok=True)
+
+    return {'result': f'Папка {dirname} создана успешно'}
+
+@tool_registry.handler('list_files', timeout=30, concurrency='fast', read_only=True)
+def tool_list_files(parameters):
+    """Содержимое папки: постранично (offset/limit), с сортировкой и фильтром по типу"""
+    path = list_files_path(parameters.get('path'))
+
+    if not os.path.exists(path):
+        return {'error': f'Путь {path} не найден'}, 404
+
+    if not os.path.isdir(path):
+        return {'error': f'{path} не является папкой'}, 400
 
-@app.route('/delete-model', methods=['POST'])
-def delete_model():
-     
-    data = request.json
-    model = data.get('model')
     try:
-        result = subprocess.run(["ollama", "rm", model], capture_output=True, text=True)
-        if result.returncode != 0:
-            app.logger.error("Error deleting model: %s", result.stderr)
-            return jsonify({"status": "error", "message": result.stderr}), 500
-        return jsonify({"status": "success"})
+        listing, offset, limit = DirListing.from_parameters(path, parameters)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    try:
+        entries, total = listing.page(offset, limit)
+    except PermissionError:
+        return {'error': f'Нет доступа к папке {path}'}, 403
     except Exception as e:
-        app.logger.error("Exception deleting model: %s", e)
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return {'error': f'Ошибка при чтении папки {path}: {str(e)}'}, 500
 
-@app.route('/install-model-stream', methods=['POST'])
-def install_model_stream():
-     
-    data = request.json
-    model_name = data.get("model")
-    if not model_name:
-        return jsonify({"error": "No model name provided"}), 400
+    files = []
+    # Добавляем родительскую папку если не в корне
+    parent_path = os.path.dirname(path)
+    if parent_path != path and offset == 0:
+        files.append('📁 .. (родительская папка)')
+    files.extend(DirListing.format_line(item) for item in entries)
+    files_list = '\n'.join(files) if files else 'Папка пуста'
+    shown = offset + len(entries)
+    next_offset = shown if shown < total else None
 
-    command = ["ollama", "run", model_name]
-    app.logger.info("Installing model via command: %s", " ".join(command))
+    # Добавляем информацию о текущем пути
+    result_text = f'📍 Текущий путь: {path}\n'
+    result_text += f'📊 Всего элементов: {total}\n'
+    if offset or next_offset is not None:
+        result_text += f'📑 Показаны {offset + 1}-{shown}' if entries else f'📑 Элементов после {offset} нет'
+        result_text += f' (следующая страница: offset={next_offset})\n' if next_offset is not None else '\n'
+    result_text += '─' * 50 + '\n'
+    result_text += files_list
 
-    def generate():
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        for line in iter(process.stdout.readline, ""):
-            yield f"data: {line.strip()}\n\n"
-        process.stdout.close()
-        process.wait()
-        yield "data: DONE\n\n"
+    return {'result': result_text, 'current_path': path, 'items': files, 'entries': entries,
+            'total': total, 'offset': offset, 'limit': limit, 'next_offset': next_offset}
 
-    return Response(generate(), mimetype='text/event-stream')
+@tool_registry.handler('delete_file', timeout=60, concurrency='fast')
+def tool_delete_file(parameters):
+    """Удаление файла или папки"""
+    filename = parameters.get('filename')
 
-@app.route('/settings', methods=['GET', 'POST'])
-def settings_handler():
-     
-    global settings, current_model
-    if request.method == 'GET':
-        return jsonify(settings)
-    else:
-        try:
-            new_settings = request.json
-            settings.update(new_settings)
+    if not filename:
+        return {'error': 'Не указано имя файла'}, 400
 
-            if "model_temperature" in new_settings:
-                try:
-                    settings["model_temperature"] = float(new_settings["model_temperature"])
-                except ValueError:
-                    app.logger.error(f"Invalid temperature value received: {new_settings['model_temperature']}")
-                    # Можно вернуть ошибку или использовать дефолтное значение, пока оставляем как есть, 
-                    # но клиент должен валидировать ввод
-            
-            with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(settings, f, indent=2, ensure_ascii=False)
+    # Поддержка абсолютных и относительных путей
+    if not os.path.isabs(filename):
+        filename = os.path.abspath(filename)
 
-            if "default_model" in new_settings:
-                current_model = new_settings["default_model"]
-                with open(LAST_MODEL_FILE, 'w', encoding='utf-8') as f:
-                    f.write(current_model)
+    if not os.path.exists(filename):
+        return {'error': f'Файл {filename} не найден'}, 404
 
-            return jsonify({"status": "success"})
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
+    try:
+        if os.path.isfile(filename):
+            os.remove(filename)
+            return {'result': f'Файл {filename} удален успешно'}
+        elif os.path.isdir(filename):
+            shutil.rmtree(filename)
+            return {'result': f'Папка {filename} удалена успешно'}
+        else:
+            return {'error': f'{filename} не является файлом или папкой'}, 400
+    except PermissionError:
+        return {'error': f'Нет доступа для удаления {filename}'}, 403
+
+@tool_registry.handler('edit_file', timeout=30, concurrency='fast')
+def tool_edit_file(parameters):
+    """Перезапись файла с резервной копией .backup"""
+    filename = parameters.get('filename')
+    content = parameters.get('content', '')
+
+    if not filename:
+        return {'error': 'Не указано имя файла'}, 400
+
+    # Поддержка абсолютных и относительных путей
+    if not os.path.isabs(filename):
+        filename = os.path.abspath(filename)
+
+    if not os.path.exists(filename):
+        return {'error': f'Файл {filename} не найден'}, 404
+
+    if not os.path.isfile(filename):
+        return {'error': f'{filename} не является файлом'}, 400
 
-def get_gpu_info_os_specific():
-    gpus = []
     try:
-        if platform.system() == "Windows":
-            import wmi # Потребуется установка 'pip install WMI'
-            c = wmi.WMI()
-            for board in c.Win32_VideoController():
-                gpus.append(board.Name)
-        elif platform.system() == "Linux":
-            try:
-                result = subprocess.run(['lspci'], capture_output=True, text=True, check=True)
-                for line in result.stdout.splitlines():
-                    if "VGA compatible controller" in line or "Display controller" in line:
-                        parts = line.split(': ')
-                        if len(parts) > 1:
-                            gpus.append(parts[1].strip())
-            except Exception as e_lspci:
-                app.logger.error(f"Failed to get GPU info from lspci: {e_lspci}")
-                gpus.append("Не удалось получить информацию о GPU (lspci)")
-        # macOS можно добавить позже, если нужно: system_profiler SPDisplaysDataType
-    except ImportError:
-        app.logger.warning("WMI module not found for GPU info on Windows. Try 'pip install WMI'.")
-        gpus.append("Не удалось получить информацию о GPU (WMI модуль не найден)")
-    except Exception as e_gpu:
-        app.logger.error(f"Error getting GPU info: {e_gpu}")
-        gpus.append("Ошибка при получении информации о GPU")
-    return gpus if gpus else ["Информация о GPU недоступна"]
+        # Создаем резервную копию
+        backup_filename = filename + '.backup'
+        shutil.copy2(filename, backup_filename)
+
+        # Записываем новое содержимое
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+        return {'result': f'Файл {filename} отредактирован успешно (резервная копия: {backup_filename})'}
+    except Exception as e:
+        return {'error': f'Ошибка при редактировании файла: {str(e)}'}, 500
+
+@tool_registry.handler('execute_command', timeout=45, concurrency='slow')
+def tool_execute_command(parameters):
+    """Выполнение команды оболочки"""
+    command = parameters.get('command')
+
+    if not command:
+        return {'error': 'Не указана команда для выполнения'}, 400
 
-def get_cpu_model_name_os_specific():
     try:
-        if platform.system() == "Windows":
-            # WMIC может быть медленным, platform.processor() часто достаточно
-            # Если platform.processor() пуст или слишком общий, можно использовать WMIC как fallback
-            # result = subprocess.run(['wmic', 'cpu', 'get', 'Name'], capture_output=True, text=True, check=True)
-            # lines = result.stdout.strip().splitlines()
-            # if len(lines) > 1: return lines[1].strip()
-            return platform.processor() # Пока оставляем platform.processor() для Windows
-        elif platform.system() == "Linux":
-            try:
-                with open('/proc/cpuinfo', 'r') as f:
-                    for line in f:
-                        if "model name" in line:
-                            return line.split(':')[1].strip()
-            except Exception:
-                pass # Если не удалось, вернем platform.processor()
-        elif platform.system() == "Darwin": # macOS
-            try:
-                result = subprocess.run(['sysctl', '-n', 'machdep.cpu.brand_string'], capture_output=True, text=True, check=True)
-                return result.stdout.strip()
-            except Exception:
-                pass
-        return platform.processor() # Fallback для всех остальных или если специфичный метод не сработал
-    except Exception as e_cpu_model:
-        app.logger.error(f"Error getting CPU model name: {e_cpu_model}")
-        return platform.processor() # Fallback
+        # Выполняем команду в зависимости от ОС
+        if platform.system() == 'Windows':
+            result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
+        else:
+            result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
+
+        output = result.stdout if result.stdout else result.stderr
+        return_code = result.returncode
+
+        return {
+            'result': f'Команда выполнена (код возврата: {return_code})\nВывод:\n{output}',
+            'return_code': return_code,
+            'stdout': result.stdout,
+            'stderr': result.stderr
+        }
+    except subprocess.TimeoutExpired:
+        return {'error': 'Команда превысила лимит времени выполнения (30 сек)'}, 408
+    except Exception as e:
+        return {'error': f'Ошибка выполнения команды: {str(e)}'}, 500
+
+@tool_registry.handler('run_application', timeout=30, concurrency='slow')
+def tool_run_application(parameters):
+    """Запуск приложения"""
+    app_path = parameters.get('app_path')
+    app_name = parameters.get('app_name')
+    arguments_str = parameters.get('arguments', '') # Переименовал во избежание путаницы с arguments_list
+
+    app.logger.info(f"run_application: app_path='{app_path}', app_name='{app_name}', arguments_str='{arguments_str}'")
+
+    if not app_path and not app_name:
+        app.logger.error("run_application: Neither app_path nor app_name provided.")
+        return {'error': 'Не указан путь к приложению или имя приложения'}, 400
+
+    # Преобразуем строку аргументов в список
+    # Внимание: arguments_str.split() просто делит по пробелам.
+    # Для сложных аргументов с пробелами внутри кавычек это может работать некорректно.
+    # Модель должна либо передавать простые аргументы, либо правильно их экранировать/обрамлять кавычками.
+    arguments_list = arguments_str.split() if arguments_str else []
+    app.logger.info(f"run_application: arguments_list after split: {arguments_list}")
 
-# Tools API для работы с файлами
-@app.route('/api/tools', methods=['POST'])
-@app.route('/tools', methods=['POST'])
-def execute_tool():
-    """Выполнение инструментов для работы с файлами"""
     try:
-        data = request.get_json()
-        tool_name = data.get('tool_name') or data.get('tool')  # Поддержка обоих форматов
-        parameters = data.get('parameters', {})
-        
-        print(f"[DEBUG] Tool request: {tool_name} with parameters: {parameters}")
-        
-        # --- Блок для обработки псевдонимов (алиасов) ---
-        if tool_name == 'launch_application':
-            print(f"[DEBUG] Alias: '{tool_name}' -> 'run_application'")
-            tool_name = 'run_application'
-        elif tool_name == 'get_cpu_info':
-            print(f"[DEBUG] Alias: '{tool_name}' -> 'get_system_info'")
-            tool_name = 'get_system_info'
-        elif tool_name == 'get_gpu_info':
-            print(f"[DEBUG] Alias: '{tool_name}' -> 'get_system_info'. Note: get_system_info does not provide detailed GPU info.")
-            tool_name = 'get_system_info'
-        elif tool_name == 'get_hardware_info':
-            print(f"[DEBUG] Alias: '{tool_name}' -> 'get_system_info'")
-            tool_name = 'get_system_info'
-        # --- Конец блока псевдонимов ---
-        
-        if tool_name == 'list_drives':
-            """Показать все доступные диски в системе"""
-            drives = []
-            
-            if platform.system() == 'Windows':
-                import string
-                for letter in string.ascii_uppercase:
-                    drive = f"{letter}:\\"
-                    if os.path.exists(drive):
-                        try:
-                            # Проверяем доступность диска
-                            os.listdir(drive)
-                            drives.append(f"💾 {drive}")
-                        except (PermissionError, OSError):
-                            drives.append(f"🔒 {drive} (нет доступа)")
-            else:
-                # Unix-подобные системы
-                drives.append("💾 / (корневая файловая система)")
-                # Добавляем популярные точки монтирования
-                mount_points = ['/mnt', '/media', '/Volumes', '/home', '/usr', '/var', '/tmp']
-                for mount in mount_points:
-                    if os.path.exists(mount) and os.path.isdir(mount):
-                        drives.append(f"📁 {mount}")
-            
-            drives_list = '\n'.join(drives) if drives else 'Диски не найдены'
-            return jsonify({'result': f'Доступные диски и основные папки:\n{drives_list}'})
-        
-        elif tool_name == 'create_file':
-            filename = parameters.get('filename')
-            content = parameters.get('content', '')
-            
-            if not filename:
-                return jsonify({'error': 'Не указано имя файла'}), 400
-            
-            # Поддержка абсолютных и относительных путей
-            if not os.path.isabs(filename):
-                filename = os.path.abspath(filename)
-            
-            # Создаем директории если их нет
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(content)
-            
-            return jsonify({'result': f'Файл {filename} создан успешно'})
-        
-        elif tool_name == 'read_file':
-            filename = parameters.get('filename')
-            
-            if not filename:
-                return jsonify({'error': 'Не указано имя файла'}), 400
-            
-            # Поддержка абсолютных и относительных путей
-            if not os.path.isabs(filename):
-                filename = os.path.abspath(filename)
-            
-            if not os.path.exists(filename):
-                return jsonify({'error': f'Файл {filename} не найден'}), 404
-            
-            try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                return jsonify({'result': f'Содержимое файла {filename}:\n{content}'})
-            except UnicodeDecodeError:
-                return jsonify({'error': f'Не удается прочитать файл {filename} (возможно, это бинарный файл)'}), 400
-        
-        elif tool_name == 'create_directory':
-            dirname = parameters.get('dirname')
-            
-            if not dirname:
-                return jsonify({'error': 'Не указано имя папки'}), 400
-            
-            # Поддержка абсолютных и относительных путей
-            if not os.path.isabs(dirname):
-                dirname = os.path.abspath(dirname)
-            
-            os.makedirs(dirname, exist_ok=True)
-            
-            return jsonify({'result': f'Папка {dirname} создана успешно'})
-        
-        elif tool_name == 'list_files':
-            path = parameters.get('path')
-            
-            print(f"[DEBUG] list_files called with path: {path}")
-            
-            # Если путь не указан, используем корень системы
-            if not path:
-                if platform.system() == 'Windows':
-                    path = 'C:\\'
-                else:
-                    path = '/'
-            
-            print(f"[DEBUG] Using path: {path}")
-            
-            # Поддержка абсолютных и относительных путей
-            if not os.path.isabs(path):
-                path = os.path.abspath(path)
-            
-            # Нормализуем путь для Windows
-            path = os.path.normpath(path)
-            
-            # Специальная обработка для корневых дисков Windows
-            if platform.system() == 'Windows' and len(path) == 2 and path[1] == ':':
-                path = path + '\\'
-            
-            print(f"[DEBUG] Final path: {path}")
-            
-            if not os.path.exists(path):
-                return jsonify({'error': f'Путь {path} не найден'}), 404
-            
-            if not os.path.isdir(path):
-                return jsonify({'error': f'{path} не является папкой'}), 400
-            
-            files = []
-            try:
-                print(f"[DEBUG] Starting to list directory: {path}")
-                
-                # Добавляем родительскую папку если не в корне
-                parent_path = os.path.dirname(path)
-                if parent_path != path:  # Не в корне
-                    files.append('📁 .. (родительская папка)')
-                
-                print(f"[DEBUG] About to call os.listdir({path})")
-                
-                # Ограничиваем количество файлов для корневых директорий
-                items = os.listdir(path)
-                if path == '/' or path == 'C:\\':
-                    items = items[:20]  # Показываем только первые 20 элементов для корня
-                
-                print(f"[DEBUG] Got {len(items)} items")
-                
-                for item in items:
-                    item_path = os.path.join(path, item)
-                    try:
-                        if os.path.isfile(item_path):
-                            size = os.path.getsize(item_path)
-                            # Форматируем размер файла
-                            if size < 1024:
-                                size_str = f"{size} B"
-                            elif size < 1024*1024:
-                                size_str = f"{size/1024:.1f} KB"
-                            elif size < 1024*1024*1024:
-                                size_str = f"{size/(1024*1024):.1f} MB"
-                            else:
-                                size_str = f"{size/(1024*1024*1024):.1f} GB"
-                            files.append(f'📄 {item} ({size_str})')
-                        elif os.path.isdir(item_path):
-                            files.append(f'📁 {item}/')
-                    except (PermissionError, OSError):
-                        files.append(f'🔒 {item} (нет доступа)')
-                
-                files_list = '\n'.join(files) if files else 'Папка пуста'
-                
-                # Добавляем информацию о текущем пути
-                result_text = f'📍 Текущий путь: {path}\n'
-                result_text += f'📊 Всего элементов: {len(files)}\n'
-                result_text += '─' * 50 + '\n'
-                result_text += files_list
-                
-                print(f"[DEBUG] Returning result for {path}")
-                return jsonify({'result': result_text, 'current_path': path, 'items': files})
-            except PermissionError:
-                print(f"[DEBUG] Permission error for {path}")
-                return jsonify({'error': f'Нет доступа к папке {path}'}), 403
-            except Exception as e:
-                print(f"[DEBUG] Exception in list_files: {e}")
-                return jsonify({'error': f'Ошибка при чтении папки {path}: {str(e)}'}), 500
-        
-        elif tool_name == 'delete_file':
-            filename = parameters.get('filename')
-            
-            if not filename:
-                return jsonify({'error': 'Не указано имя файла'}), 400
-            
-            # Поддержка абсолютных и относительных путей
-            if not os.path.isabs(filename):
-                filename = os.path.abspath(filename)
-            
-            if not os.path.exists(filename):
-                return jsonify({'error': f'Файл {filename} не найден'}), 404
-            
-            try:
-                if os.path.isfile(filename):
-                    os.remove(filename)
-                    return jsonify({'result': f'Файл {filename} удален успешно'})
-                elif os.path.isdir(filename):
-                    import shutil
-                    shutil.rmtree(filename)
-                    return jsonify({'result': f'Папка {filename} удалена успешно'})
-                else:
-                    return jsonify({'error': f'{filename} не является файлом или папкой'}), 400
-            except PermissionError:
-                return jsonify({'error': f'Нет доступа для удаления {filename}'}), 403
-        
-        elif tool_name == 'edit_file':
-            filename = parameters.get('filename')
-            content = parameters.get('content', '')
-            
-            if not filename:
-                return jsonify({'error': 'Не указано имя файла'}), 400
-            
-            # Поддержка абсолютных и относительных путей
-            if not os.path.isabs(filename):
-                filename = os.path.abspath(filename)
-            
-            if not os.path.exists(filename):
-                return jsonify({'error': f'Файл {filename} не найден'}), 404
-            
-            if not os.path.isfile(filename):
-                return jsonify({'error': f'{filename} не является файлом'}), 400
-            
-            try:
-                # Создаем резервную копию
-                backup_filename = filename + '.backup'
-                import shutil
-                shutil.copy2(filename, backup_filename)
-                
-                # Записываем новое содержимое
-                with open(filename, 'w', encoding='utf-8') as f:
-                    f.write(content)
-                
-                return jsonify({'result': f'Файл {filename} отредактирован успешно (резервная копия: {backup_filename})'})
-            except Exception as e:
-                return jsonify({'error': f'Ошибка при редактировании файла: {str(e)}'}), 500
-        
-        elif tool_name == 'execute_command':
-            command = parameters.get('command')
-            
-            if not command:
-                return jsonify({'error': 'Не указана команда для выполнения'}), 400
-            
-            try:
-                # Выполняем команду в зависимости от ОС
-                if platform.system() == 'Windows':
-                    result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
-                else:
-                    result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
-                
-                output = result.stdout if result.stdout else result.stderr
-                return_code = result.returncode
-                
-                return jsonify({
-                    'result': f'Команда выполнена (код возврата: {return_code})\nВывод:\n{output}',
-                    'return_code': return_code,
-                    'stdout': result.stdout,
-                    'stderr': result.stderr
-                })
-            except subprocess.TimeoutExpired:
-                return jsonify({'error': 'Команда превысила лимит времени выполнения (30 сек)'}), 408
-            except Exception as e:
-                return jsonify({'error': f'Ошибка выполнения команды: {str(e)}'}), 500
-        
-        elif tool_name == 'run_application':
-            app_path = parameters.get('app_path')
-            app_name = parameters.get('app_name')
-            arguments_str = parameters.get('arguments', '') # Переименовал во избежание путаницы с arguments_list
+        cmd_list = []
+        log_app_identifier = ''
 
-            app.logger.info(f"run_application: app_path='{app_path}', app_name='{app_name}', arguments_str='{arguments_str}'")
+        if app_path:
+            log_app_identifier = app_path
+            # Проверка пути перед использованием
+            abs_app_path = os.path.abspath(app_path)
+            app.logger.info(f"run_application: Using app_path. Absolute path: '{abs_app_path}'")
+            if not os.path.exists(abs_app_path):
+                app.logger.error(f"run_application: app_path does not exist: '{abs_app_path}'")
+                return {'error': f'Файл приложения по указанному пути не найден: {abs_app_path}'}, 404
+            if not os.path.isfile(abs_app_path):
+                app.logger.error(f"run_application: app_path is not a file: '{abs_app_path}'")
+                return {'error': f'Указанный путь к приложению не является файлом: {abs_app_path}'}, 400
 
-            if not app_path and not app_name:
-                app.logger.error("run_application: Neither app_path nor app_name provided.")
-                return jsonify({'error': 'Не указан путь к приложению или имя приложения'}), 400
-            
-            # Преобразуем строку аргументов в список
-            # Внимание: arguments_str.split() просто делит по пробелам.
-            # Для сложных аргументов с пробелами внутри кавычек это может работать некорректно.
-            # Модель должна либо передавать простые аргументы, либо правильно их экранировать/обрамлять кавычками.
-            arguments_list = arguments_str.split() if arguments_str else []
-            app.logger.info(f"run_application: arguments_list after split: {arguments_list}")
+            cmd_list = [abs_app_path] + arguments_list
+            app.logger.info(f"run_application: Command list for Popen (with app_path): {cmd_list}")
+            # Для прямого пути shell=False безопаснее и обычно не нужен
+            subprocess.Popen(cmd_list, shell=False)
+        else: # app_name
+            log_app_identifier = app_name
+            cmd_list = [app_name] + arguments_list
+            app.logger.info(f"run_application: Command list for Popen (with app_name): {cmd_list}")
+            # Для app_name, особенно в Windows, shell=True может помочь найти программу в PATH
+            # и обработать системные ассоциации, но менее безопасно, если app_name контролируется извне.
+            # Однако, здесь app_name приходит от AI, которая должна быть доверенной.
+            use_shell = True if platform.system() == 'Windows' else False 
+            app.logger.info(f"run_application: Popen with shell={use_shell}")
+            subprocess.Popen(cmd_list, shell=use_shell) 
 
+        app.logger.info(f"run_application: Successfully initiated Popen for '{log_app_identifier}'")
+        return {'result': f'Приложение {log_app_identifier} запущено успешно'}
+
+    except FileNotFoundError:
+        app.logger.error(f"run_application: FileNotFoundError for '{log_app_identifier}'. Command list: {cmd_list}")
+        return {'error': f'Приложение не найдено: {log_app_identifier}'}, 404
+    except PermissionError as e_perm:
+        app.logger.error(f"run_application: PermissionError for '{log_app_identifier}': {e_perm}. Command list: {cmd_list}")
+        return {'error': f'Ошибка прав доступа при запуске {log_app_identifier}: {str(e_perm)}'}, 403
+    except Exception as e:
+        app.logger.error(f"run_application: Generic error for '{log_app_identifier}': {e}. Command list: {cmd_list}")
+        return {'error': f'Ошибка запуска приложения {log_app_identifier}: {str(e)}'}, 500
+
+@tool_registry.handler('get_system_info', timeout=15, concurrency='slow', read_only=True)
+def tool_get_system_info(parameters):
+    """Сведения о системе и оборудовании"""
+    try:
+        # Получаем информацию о системе
+        system_info = {
+            'os': platform.system(),
+            'os_version': platform.version(),
+            'architecture': platform.architecture()[0],
+            'processor': platform.processor(),
+            'processor_model': get_cpu_model_name_os_specific(),
+            'gpus': get_gpu_info_os_specific(),
+            'hostname': platform.node(),
+            'python_version': platform.python_version(),
+            'cpu_count': psutil.cpu_count(),
+            'cpu_percent': psutil.cpu_percent(interval=1),
+            'memory_total': f"{psutil.virtual_memory().total / (1024**3):.2f} GB",
+            'memory_available': f"{psutil.virtual_memory().available / (1024**3):.2f} GB",
+            'memory_percent': psutil.virtual_memory().percent,
+            'disk_usage': []
+        }
+
+        # Информация о дисках
+        for partition in psutil.disk_partitions():
             try:
-                cmd_list = []
-                log_app_identifier = ''
-
-                if app_path:
-                    log_app_identifier = app_path
-                    # Проверка пути перед использованием
-                    abs_app_path = os.path.abspath(app_path)
-                    app.logger.info(f"run_application: Using app_path. Absolute path: '{abs_app_path}'")
-                    if not os.path.exists(abs_app_path):
-                        app.logger.error(f"run_application: app_path does not exist: '{abs_app_path}'")
-                        return jsonify({'error': f'Файл приложения по указанному пути не найден: {abs_app_path}'}), 404
-                    if not os.path.isfile(abs_app_path):
-                        app.logger.error(f"run_application: app_path is not a file: '{abs_app_path}'")
-                        return jsonify({'error': f'Указанный путь к приложению не является файлом: {abs_app_path}'}), 400
-                    
-                    cmd_list = [abs_app_path] + arguments_list
-                    app.logger.info(f"run_application: Command list for Popen (with app_path): {cmd_list}")
-                    # Для прямого пути shell=False безопаснее и обычно не нужен
-                    subprocess.Popen(cmd_list, shell=False)
-                else: # app_name
-                    log_app_identifier = app_name
-                    cmd_list = [app_name] + arguments_list
-                    app.logger.info(f"run_application: Command list for Popen (with app_name): {cmd_list}")
-                    # Для app_name, особенно в Windows, shell=True может помочь найти программу в PATH
-                    # и обработать системные ассоциации, но менее безопасно, если app_name контролируется извне.
-                    # Однако, здесь app_name приходит от AI, которая должна быть доверенной.
-                    use_shell = True if platform.system() == 'Windows' else False 
-                    app.logger.info(f"run_application: Popen with shell={use_shell}")
-                    subprocess.Popen(cmd_list, shell=use_shell) 
-                    
-                app.logger.info(f"run_application: Successfully initiated Popen for '{log_app_identifier}'")
-                return jsonify({'result': f'Приложение {log_app_identifier} запущено успешно'})
-
-            except FileNotFoundError:
-                app.logger.error(f"run_application: FileNotFoundError for '{log_app_identifier}'. Command list: {cmd_list}")
-                return jsonify({'error': f'Приложение не найдено: {log_app_identifier}'}), 404
-            except PermissionError as e_perm:
-                app.logger.error(f"run_application: PermissionError for '{log_app_identifier}': {e_perm}. Command list: {cmd_list}")
-                return jsonify({'error': f'Ошибка прав доступа при запуске {log_app_identifier}: {str(e_perm)}'}), 403
-            except Exception as e:
-                app.logger.error(f"run_application: Generic error for '{log_app_identifier}': {e}. Command list: {cmd_list}")
-                return jsonify({'error': f'Ошибка запуска приложения {log_app_identifier}: {str(e)}'}), 500
-        
-        elif tool_name == 'get_system_info':
-            try:
-                # Получаем информацию о системе
-                system_info = {
-                    'os': platform.system(),
-                    'os_version': platform.version(),
-                    'architecture': platform.architecture()[0],
-                    'processor': platform.processor(),
-                    'processor_model': get_cpu_model_name_os_specific(),
-                    'gpus': get_gpu_info_os_specific(),
-                    'hostname': platform.node(),
-                    'python_version': platform.python_version(),
-                    'cpu_count': psutil.cpu_count(),
-                    'cpu_percent': psutil.cpu_percent(interval=1),
-                    'memory_total': f"{psutil.virtual_memory().total / (1024**3):.2f} GB",
-                    'memory_available': f"{psutil.virtual_memory().available / (1024**3):.2f} GB",
-                    'memory_percent': psutil.virtual_memory().percent,
-                    'disk_usage': []
-                }
-                
-                # Информация о дисках
-                for partition in psutil.disk_partitions():
-                    try:
-                        usage = psutil.disk_usage(partition.mountpoint)
-                        system_info['disk_usage'].append({
-                            'device': partition.device,
-                            'mountpoint': partition.mountpoint,
-                            'fstype': partition.fstype,
-                            'total': f"{usage.total / (1024**3):.2f} GB",
-                            'used': f"{usage.used / (1024**3):.2f} GB",
-                            'free': f"{usage.free / (1024**3):.2f} GB",
-                            'percent': f"{(usage.used / usage.total) * 100:.1f}%"
-                        })
-                    except PermissionError:
-                        continue
-                
-                info_text = f"""Информация о системе:
+                usage = psutil.disk_usage(partition.mountpoint)
+                system_info['disk_usage'].append({
+                    'device': partition.device,
+                    'mountpoint': partition.mountpoint,
+                    'fstype': partition.fstype,
+                    'total': f"{usage.total / (1024**3):.2f} GB",
+                    'used': f"{usage.used / (1024**3):.2f} GB",
+                    'free': f"{usage.free / (1024**3):.2f} GB",
+                    'percent': f"{(usage.used / usage.total) * 100:.1f}%"
+                })
+            except PermissionError:
+                continue
+
+        info_text = f"""Информация о системе:
 ОС: {system_info['os']} {system_info['os_version']}
 Архитектура: {system_info['architecture']}
 Процессор: {system_info['processor']}
@@ -919,176 +4924,179 @@ def execute_tool():
 Имя компьютера: {system_info['hostname']}
 Python: {system_info['python_version']}
 
-Видеокарты:"""
-                for gpu_name in system_info['gpus']:
-                    info_text += f"\n  - {gpu_name}"
+Видеокарты:"""
+        for gpu_name in system_info['gpus']:
+            info_text += f"\n  - {gpu_name}"
+
+        info_text += f"""
+
+Ресурсы:
+CPU: {system_info['cpu_count']} ядер, загрузка {system_info['cpu_percent']}%
+Память: {system_info['memory_available']} доступно из {system_info['memory_total']} ({system_info['memory_percent']}% используется)
+
+Диски:"""
+
+        for disk in system_info['disk_usage']:
+            info_text += f"\n{disk['device']} ({disk['fstype']}): {disk['used']} из {disk['total']} ({disk['percent']})"
+
+        return {'result': info_text, 'data': system_info}
+    except Exception as e:
+        return {'error': f'Ошибка получения информации о системе: {str(e)}'}, 500
+
+@tool_registry.handler('manage_processes', timeout=30, concurrency='slow',
+                       read_only=lambda p: p.get('action') in ('list', 'info'))
+def tool_manage_processes(parameters):
+    """Процессы: list / kill / info"""
+    action = parameters.get('action')  # 'list', 'kill', 'info'
+    process_name = parameters.get('process_name')
+    process_id = parameters.get('process_id')
+
+    if not action:
+        return {'error': 'Не указано действие (list, kill, info)'}, 400
+
+    try:
+        if action == 'list':
+            processes = []
+            for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
+                try:
+                    processes.append({
+                        'pid': proc.info['pid'],
+                        'name': proc.info['name'],
+                        'cpu_percent': proc.info['cpu_percent'],
+                        'memory_percent': proc.info['memory_percent']
+                    })
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+
+            # Сортируем по использованию CPU
+            processes.sort(key=lambda x: x['cpu_percent'] or 0, reverse=True)
+
+            result_text = "Список процессов (топ 20 по CPU):\n"
+            for proc in processes[:20]:
+                result_text += f"PID: {proc['pid']}, Имя: {proc['name']}, CPU: {proc['cpu_percent']:.1f}%, Память: {proc['memory_percent']:.1f}%\n"
+
+            return {'result': result_text, 'processes': processes[:20]}
+
+        elif action == 'kill':
+            process_id_param = parameters.get('process_id')
+            process_name_param = parameters.get('process_name')
+            force_kill = parameters.get('force', False) # Новый параметр для принудительного kill
+
+            app.logger.info(f"Attempting to kill process. Provided ID: {process_id_param}, Name: {process_name_param}, Force: {force_kill}")
+
+            if not process_id_param and not process_name_param:
+                return {'error': 'Не указан ID или имя процесса для завершения'}, 400
+
+            killed_processes_info = []
+            processes_to_check = []
+
+            if process_id_param:
+                try:
+                    pid = int(process_id_param)
+                    proc = psutil.Process(pid)
+                    processes_to_check.append(proc)
+                except (psutil.NoSuchProcess, ValueError) as e_pid:
+                    app.logger.warning(f"Could not find process by ID {process_id_param}: {e_pid}")
+                    # Не возвращаем ошибку сразу, может быть найдено по имени
+                except psutil.AccessDenied:
+                    app.logger.warning(f"Access denied for process ID {process_id_param}")
+                    killed_processes_info.append(f"Нет прав доступа к процессу PID {process_id_param}")
+
+            if process_name_param:
+                for p in psutil.process_iter(['pid', 'name']):
+                    try:
+                        if p.info['name'].lower() == process_name_param.lower():
+                            # Избегаем дублирования, если уже добавили по ID
+                            if not any(existing_proc.pid == p.info['pid'] for existing_proc in processes_to_check):
+                               processes_to_check.append(psutil.Process(p.info['pid']))
+                    except (psutil.NoSuchProcess, psutil.AccessDenied):
+                        continue # Пропускаем процессы, к которым нет доступа или которые исчезли
+
+            if not processes_to_check and not killed_processes_info: # Если ничего не нашли и не было ошибок доступа по ID
+                return {'error': f'Процесс с ID "{process_id_param}" или именем "{process_name_param}" не найден'}, 404
+
+            for proc_to_kill in processes_to_check:
+                try:
+                    proc_name_actual = proc_to_kill.name()
+                    pid_actual = proc_to_kill.pid
+                    app.logger.info(f"Targeting process PID: {pid_actual}, Name: {proc_name_actual} for termination.")
+
+                    if force_kill:
+                        app.logger.info(f"Attempting force kill (proc.kill()) for PID: {pid_actual}")
+                        proc_to_kill.kill()
+                        killed_processes_info.append(f"Принудительно завершен PID {pid_actual} ({proc_name_actual})")
+                    else:
+                        app.logger.info(f"Attempting graceful termination (proc.terminate()) for PID: {pid_actual}")
+                        proc_to_kill.terminate()
+                        # Дадим процессу немного времени на завершение
+                        try:
+                            proc_to_kill.wait(timeout=1) # Ждем 1 секунду
+                            app.logger.info(f"Process PID: {pid_actual} terminated gracefully.")
+                            killed_processes_info.append(f"Завершен PID {pid_actual} ({proc_name_actual})")
+                        except psutil.TimeoutExpired:
+                            app.logger.warning(f"Process PID: {pid_actual} did not terminate gracefully within timeout. Attempting proc.kill().")
+                            proc_to_kill.kill()
+                            killed_processes_info.append(f"Принудительно завершен (после таймаута) PID {pid_actual} ({proc_name_actual})")
+                except psutil.NoSuchProcess:
+                    app.logger.warning(f"Process PID: {pid_actual} no longer exists.")
+                    killed_processes_info.append(f"Процесс PID {pid_actual} уже не существует")
+                except psutil.AccessDenied:
+                    app.logger.warning(f"Access denied when trying to terminate/kill PID: {pid_actual} ({proc_name_actual})")
+                    killed_processes_info.append(f"Нет прав для завершения PID {pid_actual} ({proc_name_actual})")
+                except Exception as e_term:
+                    app.logger.error(f"Error terminating process PID {pid_actual} ({proc_name_actual}): {e_term}")
+                    killed_processes_info.append(f"Ошибка при завершении PID {pid_actual} ({proc_name_actual}): {str(e_term)}")
+
+            if killed_processes_info:
+                return {'result': ', '.join(killed_processes_info)}
+            else:
+                # Эта ветка не должна достигаться, если processes_to_check не пуст, но на всякий случай
+                return {'error': f'Не удалось найти или обработать процессы для завершения (ID: {process_id_param}, Name: {process_name_param})'}, 500
+
+        elif action == 'info':
+            if not process_id and not process_name:
+                return {'error': 'Не указан ID или имя процесса для получения информации'}, 400
 
-                info_text += f"""
+            target_proc = None
 
-Ресурсы:
-CPU: {system_info['cpu_count']} ядер, загрузка {system_info['cpu_percent']}%
-Память: {system_info['memory_available']} доступно из {system_info['memory_total']} ({system_info['memory_percent']}% используется)
+            if process_id:
+                try:
+                    target_proc = psutil.Process(int(process_id))
+                except psutil.NoSuchProcess:
+                    return {'error': f'Процесс с PID {process_id} не найден'}, 404
+            elif process_name:
+                for proc in psutil.process_iter(['pid', 'name']):
+                    try:
+                        if proc.info['name'].lower() == process_name.lower():
+                            target_proc = psutil.Process(proc.info['pid'])
+                            break
+                    except (psutil.NoSuchProcess, psutil.AccessDenied):
+                        continue
+
+            if not target_proc:
+                return {'error': f'Процесс "{process_name}" не найден'}, 404
 
-Диски:"""
-                
-                for disk in system_info['disk_usage']:
-                    info_text += f"\n{disk['device']} ({disk['fstype']}): {disk['used']} из {disk['total']} ({disk['percent']})"
-                
-                return jsonify({'result': info_text, 'data': system_info})
-            except Exception as e:
-                return jsonify({'error': f'Ошибка получения информации о системе: {str(e)}'}), 500
-        
-        elif tool_name == 'manage_processes':
-            action = parameters.get('action')  # 'list', 'kill', 'info'
-            process_name = parameters.get('process_name')
-            process_id = parameters.get('process_id')
-            
-            if not action:
-                return jsonify({'error': 'Не указано действие (list, kill, info)'}), 400
-            
             try:
-                if action == 'list':
-                    processes = []
-                    for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
-                        try:
-                            processes.append({
-                                'pid': proc.info['pid'],
-                                'name': proc.info['name'],
-                                'cpu_percent': proc.info['cpu_percent'],
-                                'memory_percent': proc.info['memory_percent']
-                            })
-                        except (psutil.NoSuchProcess, psutil.AccessDenied):
-                            continue
-                    
-                    # Сортируем по использованию CPU
-                    processes.sort(key=lambda x: x['cpu_percent'] or 0, reverse=True)
-                    
-                    result_text = "Список процессов (топ 20 по CPU):\n"
-                    for proc in processes[:20]:
-                        result_text += f"PID: {proc['pid']}, Имя: {proc['name']}, CPU: {proc['cpu_percent']:.1f}%, Память: {proc['memory_percent']:.1f}%\n"
-                    
-                    return jsonify({'result': result_text, 'processes': processes[:20]})
-                
-                elif action == 'kill':
-                    process_id_param = parameters.get('process_id')
-                    process_name_param = parameters.get('process_name')
-                    force_kill = parameters.get('force', False) # Новый параметр для принудительного kill
-
-                    app.logger.info(f"Attempting to kill process. Provided ID: {process_id_param}, Name: {process_name_param}, Force: {force_kill}")
-
-                    if not process_id_param and not process_name_param:
-                        return jsonify({'error': 'Не указан ID или имя процесса для завершения'}), 400
-                    
-                    killed_processes_info = []
-                    processes_to_check = []
-
-                    if process_id_param:
-                        try:
-                            pid = int(process_id_param)
-                            proc = psutil.Process(pid)
-                            processes_to_check.append(proc)
-                        except (psutil.NoSuchProcess, ValueError) as e_pid:
-                            app.logger.warning(f"Could not find process by ID {process_id_param}: {e_pid}")
-                            # Не возвращаем ошибку сразу, может быть найдено по имени
-                        except psutil.AccessDenied:
-                            app.logger.warning(f"Access denied for process ID {process_id_param}")
-                            killed_processes_info.append(f"Нет прав доступа к процессу PID {process_id_param}")
-
-                    if process_name_param:
-                        for p in psutil.process_iter(['pid', 'name']):
-                            try:
-                                if p.info['name'].lower() == process_name_param.lower():
-                                    # Избегаем дублирования, если уже добавили по ID
-                                    if not any(existing_proc.pid == p.info['pid'] for existing_proc in processes_to_check):
-                                       processes_to_check.append(psutil.Process(p.info['pid']))
-                            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                                continue # Пропускаем процессы, к которым нет доступа или которые исчезли
-                    
-                    if not processes_to_check and not killed_processes_info: # Если ничего не нашли и не было ошибок доступа по ID
-                        return jsonify({'error': f'Процесс с ID "{process_id_param}" или именем "{process_name_param}" не найден'}), 404
-
-                    for proc_to_kill in processes_to_check:
-                        try:
-                            proc_name_actual = proc_to_kill.name()
-                            pid_actual = proc_to_kill.pid
-                            app.logger.info(f"Targeting process PID: {pid_actual}, Name: {proc_name_actual} for termination.")
-
-                            if force_kill:
-                                app.logger.info(f"Attempting force kill (proc.kill()) for PID: {pid_actual}")
-                                proc_to_kill.kill()
-                                killed_processes_info.append(f"Принудительно завершен PID {pid_actual} ({proc_name_actual})")
-                            else:
-                                app.logger.info(f"Attempting graceful termination (proc.terminate()) for PID: {pid_actual}")
-                                proc_to_kill.terminate()
-                                # Дадим процессу немного времени на завершение
-                                try:
-                                    proc_to_kill.wait(timeout=1) # Ждем 1 секунду
-                                    app.logger.info(f"Process PID: {pid_actual} terminated gracefully.")
-                                    killed_processes_info.append(f"Завершен PID {pid_actual} ({proc_name_actual})")
-                                except psutil.TimeoutExpired:
-                                    app.logger.warning(f"Process PID: {pid_actual} did not terminate gracefully within timeout. Attempting proc.kill().")
-                                    proc_to_kill.kill()
-                                    killed_processes_info.append(f"Принудительно завершен (после таймаута) PID {pid_actual} ({proc_name_actual})")
-                        except psutil.NoSuchProcess:
-                            app.logger.warning(f"Process PID: {pid_actual} no longer exists.")
-                            killed_processes_info.append(f"Процесс PID {pid_actual} уже не существует")
-                        except psutil.AccessDenied:
-                            app.logger.warning(f"Access denied when trying to terminate/kill PID: {pid_actual} ({proc_name_actual})")
-                            killed_processes_info.append(f"Нет прав для завершения PID {pid_actual} ({proc_name_actual})")
-                        except Exception as e_term:
-                            app.logger.error(f"Error terminating process PID {pid_actual} ({proc_name_actual}): {e_term}")
-                            killed_processes_info.append(f"Ошибка при завершении PID {pid_actual} ({proc_name_actual}): {str(e_term)}")
-
-                    if killed_processes_info:
-                        return jsonify({'result': ', '.join(killed_processes_info)})
-                    else:
-                        # Эта ветка не должна достигаться, если processes_to_check не пуст, но на всякий случай
-                        return jsonify({'error': f'Не удалось найти или обработать процессы для завершения (ID: {process_id_param}, Name: {process_name_param})'}), 500
-                
-                elif action == 'info':
-                    if not process_id and not process_name:
-                        return jsonify({'error': 'Не указан ID или имя процесса для получения информации'}), 400
-                    
-                    target_proc = None
-                    
-                    if process_id:
-                        try:
-                            target_proc = psutil.Process(int(process_id))
-                        except psutil.NoSuchProcess:
-                            return jsonify({'error': f'Процесс с PID {process_id} не найден'}), 404
-                    elif process_name:
-                        for proc in psutil.process_iter(['pid', 'name']):
-                            try:
-                                if proc.info['name'].lower() == process_name.lower():
-                                    target_proc = psutil.Process(proc.info['pid'])
-                                    break
-                            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                                continue
-                    
-                    if not target_proc:
-                        return jsonify({'error': f'Процесс "{process_name}" не найден'}), 404
-                    
-                    try:
-                        proc_info = {
-                            'pid': target_proc.pid,
-                            'name': target_proc.name(),
-                            'status': target_proc.status(),
-                            'cpu_percent': target_proc.cpu_percent(),
-                            'memory_percent': target_proc.memory_percent(),
-                            'create_time': time.ctime(target_proc.create_time()),
-                            'num_threads': target_proc.num_threads(),
-                        }
-                        
-                        try:
-                            proc_info['exe'] = target_proc.exe()
-                            proc_info['cwd'] = target_proc.cwd()
-                            proc_info['cmdline'] = ' '.join(target_proc.cmdline())
-                        except psutil.AccessDenied:
-                            proc_info['exe'] = 'Нет доступа'
-                            proc_info['cwd'] = 'Нет доступа'
-                            proc_info['cmdline'] = 'Нет доступа'
-                        
-                        info_text = f"""Информация о процессе:
+                proc_info = {
+                    'pid': target_proc.pid,
+                    'name': target_proc.name(),
+                    'status': target_proc.status(),
+                    'cpu_percent': target_proc.cpu_percent(),
+                    'memory_percent': target_proc.memory_percent(),
+                    'create_time': time.ctime(target_proc.create_time()),
+                    'num_threads': target_proc.num_threads(),
+                }
+
+                try:
+                    proc_info['exe'] = target_proc.exe()
+                    proc_info['cwd'] = target_proc.cwd()
+                    proc_info['cmdline'] = ' '.join(target_proc.cmdline())
+                except psutil.AccessDenied:
+                    proc_info['exe'] = 'Нет доступа'
+                    proc_info['cwd'] = 'Нет доступа'
+                    proc_info['cmdline'] = 'Нет доступа'
+
+                info_text = f"""Информация о процессе:
 PID: {proc_info['pid']}
 Имя: {proc_info['name']}
 Статус: {proc_info['status']}
@@ -1099,304 +5107,1236 @@ CPU: {proc_info['cpu_percent']:.1f}%
 Исполняемый файл: {proc_info['exe']}
 Рабочая папка: {proc_info['cwd']}
 Командная строка: {proc_info['cmdline']}"""
-                        
-                        return jsonify({'result': info_text, 'process_info': proc_info})
-                    except psutil.AccessDenied:
-                        return jsonify({'error': 'Нет прав доступа к информации о процессе'}), 403
-                
-                else:
-                    return jsonify({'error': f'Неизвестное действие: {action}'}), 400
-                    
-            except Exception as e:
-                return jsonify({'error': f'Ошибка управления процессами: {str(e)}'}), 500
-        
-        elif tool_name == 'network_info':
-            try:
-                network_info = {
-                    'interfaces': [],
-                    'connections': []
-                }
-                
-                # Информация о сетевых интерфейсах
-                for interface, addrs in psutil.net_if_addrs().items():
-                    interface_info = {'name': interface, 'addresses': []}
-                    for addr in addrs:
-                        interface_info['addresses'].append({
-                            'family': str(addr.family),
-                            'address': addr.address,
-                            'netmask': addr.netmask,
-                            'broadcast': addr.broadcast
-                        })
-                    network_info['interfaces'].append(interface_info)
-                
-                # Активные сетевые соединения
-                for conn in psutil.net_connections(kind='inet')[:10]:  # Ограничиваем до 10
-                    try:
-                        network_info['connections'].append({
-                            'fd': conn.fd,
-                            'family': str(conn.family),
-                            'type': str(conn.type),
-                            'local_address': f"{conn.laddr.ip}:{conn.laddr.port}" if conn.laddr else None,
-                            'remote_address': f"{conn.raddr.ip}:{conn.raddr.port}" if conn.raddr else None,
-                            'status': conn.status,
-                            'pid': conn.pid
-                        })
-                    except:
-                        continue
-                
-                result_text = "Сетевая информация:\n\nИнтерфейсы:\n"
-                for iface in network_info['interfaces']:
-                    result_text += f"{iface['name']}:\n"
-                    for addr in iface['addresses']:
-                        result_text += f"  {addr['address']} ({addr['family']})\n"
-                
-                result_text += "\nАктивные соединения (топ 10):\n"
-                for conn in network_info['connections']:
-                    result_text += f"{conn['local_address']} -> {conn['remote_address']} ({conn['status']})\n"
-                
-                return jsonify({'result': result_text, 'network_data': network_info})
-            except Exception as e:
-                return jsonify({'error': f'Ошибка получения сетевой информации: {str(e)}'}), 500
-        
-        elif tool_name == 'manage_services':
-            action = parameters.get('action')  # 'list', 'start', 'stop', 'restart', 'status'
-            service_name = parameters.get('service_name')
-            
-            if not action:
-                return jsonify({'error': 'Не указано действие (list, start, stop, restart, status)'}), 400
-            
+
+                return {'result': info_text, 'process_info': proc_info}
+            except psutil.AccessDenied:
+                return {'error': 'Нет прав доступа к информации о процессе'}, 403
+
+        else:
+            return {'error': f'Неизвестное действие: {action}'}, 400
+
+    except Exception as e:
+        return {'error': f'Ошибка управления процессами: {str(e)}'}, 500
+
+@tool_registry.handler('network_info', timeout=15, concurrency='slow', read_only=True)
+def tool_network_info(parameters):
+    """Сетевые интерфейсы и соединения"""
+    try:
+        network_info = {
+            'interfaces': [],
+            'connections': []
+        }
+
+        # Информация о сетевых интерфейсах
+        for interface, addrs in psutil.net_if_addrs().items():
+            interface_info = {'name': interface, 'addresses': []}
+            for addr in addrs:
+                interface_info['addresses'].append({
+                    'family': str(addr.family),
+                    'address': addr.address,
+                    'netmask': addr.netmask,
+                    'broadcast': addr.broadcast
+                })
+            network_info['interfaces'].append(interface_info)
+
+        # Активные сетевые соединения
+        for conn in psutil.net_connections(kind='inet')[:10]:  # Ограничиваем до 10
             try:
-                if action == 'list':
-                    if platform.system() == 'Windows':
-                        # Попытка получить вывод с кодировкой cp866, стандартной для консоли Windows
-                        try:
-                            # Используем queryex для более структурированного вывода, увеличиваем bufsize
-                            # type= service чтобы получать только сервисы
-                            # state= all чтобы получать все состояния
-                            process = subprocess.run(['sc', 'queryex', 'type=', 'service', 'state=', 'all', 'bufsize=', '200000'], 
-                                                     capture_output=True, timeout=60, check=False) 
-                            stdout_decoded = process.stdout.decode('cp866', errors='replace')
-                            stderr_decoded = process.stderr.decode('cp866', errors='replace')
-
-                            if process.returncode != 0:
-                                return jsonify({'result': f'Ошибка выполнения sc queryex (код {process.returncode}):\n{stdout_decoded}\n{stderr_decoded}'})
-                            
-                            services_list = []
-                            current_service_info = {}
-
-                            for line in stdout_decoded.splitlines():
-                                line = line.strip()
-                                if not line: # Пропускаем пустые строки, которые могут быть между записями служб
-                                    if current_service_info.get("SERVICE_NAME"): # Если есть имя сервиса, значит блок закончен
-                                        services_list.append(f"Имя: {current_service_info.get('SERVICE_NAME', 'N/A')}, " +
-                                                             f"Отображаемое имя: {current_service_info.get('DISPLAY_NAME', 'N/A')}, " +
-                                                             f"Состояние: {current_service_info.get('STATE_TEXT', 'N/A')}")
-                                        current_service_info = {} # Сброс для следующей службы
-                                    continue
-
-                                if ':' in line:
-                                    key, value = line.split(":", 1)
-                                    key = key.strip()
-                                    value = value.strip()
-                                    
-                                    if key == "SERVICE_NAME":
-                                        current_service_info["SERVICE_NAME"] = value
-                                    elif key == "DISPLAY_NAME":
-                                        current_service_info["DISPLAY_NAME"] = value
-                                    elif key == "STATE":
-                                        # Пример строки: STATE              : 4  RUNNING 
-                                        state_parts = value.split()
-                                        if len(state_parts) > 1: # Ожидаем как минимум код состояния и текст
-                                            current_service_info["STATE_TEXT"] = state_parts[-1] # Берем последнее слово как текстовое состояние
-                                        else:
-                                            current_service_info["STATE_TEXT"] = value # Если формат другой
-                            
-                            # Добавляем последний сервис, если он есть в буфере
-                            if current_service_info.get("SERVICE_NAME"):
+                network_info['connections'].append({
+                    'fd': conn.fd,
+                    'family': str(conn.family),
+                    'type': str(conn.type),
+                    'local_address': f"{conn.laddr.ip}:{conn.laddr.port}" if conn.laddr else None,
+                    'remote_address': f"{conn.raddr.ip}:{conn.raddr.port}" if conn.raddr else None,
+                    'status': conn.status,
+                    'pid': conn.pid
+                })
+            except:
+                continue
+
+        result_text = "Сетевая информация:\n\nИнтерфейсы:\n"
+        for iface in network_info['interfaces']:
+            result_text += f"{iface['name']}:\n"
+            for addr in iface['addresses']:
+                result_text += f"  {addr['address']} ({addr['family']})\n"
+
+        result_text += "\nАктивные соединения (топ 10):\n"
+        for conn in network_info['connections']:
+            result_text += f"{conn['local_address']} -> {conn['remote_address']} ({conn['status']})\n"
+
+        return {'result': result_text, 'network_data': network_info}
+    except Exception as e:
+        return {'error': f'Ошибка получения сетевой информации: {str(e)}'}, 500
+
+@tool_registry.handler('manage_services', timeout=45, concurrency='slow',
+                       read_only=lambda p: p.get('action') in ('list', 'status'))
+def tool_manage_services(parameters):
+    """Службы: list / start / stop / restart / status"""
+    action = parameters.get('action')  # 'list', 'start', 'stop', 'restart', 'status'
+    service_name = parameters.get('service_name')
+
+    if not action:
+        return {'error': 'Не указано действие (list, start, stop, restart, status)'}, 400
+
+    try:
+        if action == 'list':
+            if platform.system() == 'Windows':
+                # Попытка получить вывод с кодировкой cp866, стандартной для консоли Windows
+                try:
+                    # Используем queryex для более структурированного вывода, увеличиваем bufsize
+                    # type= service чтобы получать только сервисы
+                    # state= all чтобы получать все состояния
+                    process = subprocess.run(['sc', 'queryex', 'type=', 'service', 'state=', 'all', 'bufsize=', '200000'], 
+                                             capture_output=True, timeout=60, check=False) 
+                    stdout_decoded = process.stdout.decode('cp866', errors='replace')
+                    stderr_decoded = process.stderr.decode('cp866', errors='replace')
+
+                    if process.returncode != 0:
+                        return {'result': f'Ошибка выполнения sc queryex (код {process.returncode}):\n{stdout_decoded}\n{stderr_decoded}'}
+
+                    services_list = []
+                    current_service_info = {}
+
+                    for line in stdout_decoded.splitlines():
+                        line = line.strip()
+                        if not line: # Пропускаем пустые строки, которые могут быть между записями служб
+                            if current_service_info.get("SERVICE_NAME"): # Если есть имя сервиса, значит блок закончен
                                 services_list.append(f"Имя: {current_service_info.get('SERVICE_NAME', 'N/A')}, " +
                                                      f"Отображаемое имя: {current_service_info.get('DISPLAY_NAME', 'N/A')}, " +
                                                      f"Состояние: {current_service_info.get('STATE_TEXT', 'N/A')}")
+                                current_service_info = {} # Сброс для следующей службы
+                            continue
 
-                            if not services_list:
-                                return jsonify({'result': f'Список служб Windows (sc queryex):\nНе удалось обработать вывод или службы не найдены.\nRaw stdout (first 1000 chars):\n{stdout_decoded[:1000]}'})
-
-                            # Ограничиваем вывод, например, первыми 200 службами, чтобы не перегружать
-                            output_limit = 200
-                            result_text = f'Список служб Windows ({len(services_list)} найдено, показано до {output_limit}):\n' + '\n'.join(services_list[:output_limit])
-                            if len(services_list) > output_limit:
-                                result_text += f"\n... и еще {len(services_list) - output_limit} служб."
-                            
-                            return jsonify({'result': result_text})
-
-                        except FileNotFoundError:
-                            return jsonify({'error': 'Команда sc не найдена. Убедитесь, что она доступна в PATH.'}), 500
-                        except subprocess.TimeoutExpired:
-                            return jsonify({'error': 'Команда sc queryex превысила лимит времени выполнения (60 сек)'}), 408
-                        except Exception as e_sc:
-                            return jsonify({'error': f'Ошибка при вызове sc queryex или обработке вывода: {str(e_sc)}'}), 500
-                    else:
-                        result = subprocess.run(['systemctl', 'list-units', '--type=service'], capture_output=True, text=True, timeout=30)
-                        return jsonify({'result': f'Список служб Linux:\n{result.stdout}'})
-                
-                elif action in ['start', 'stop', 'restart', 'status']:
-                    if not service_name:
-                        return jsonify({'error': 'Не указано имя службы'}), 400
-                    
-                    if platform.system() == 'Windows':
-                        if action == 'start':
-                            result = subprocess.run(['sc', 'start', service_name], capture_output=True, text=True, timeout=30)
-                        elif action == 'stop':
-                            result = subprocess.run(['sc', 'stop', service_name], capture_output=True, text=True, timeout=30)
-                        elif action == 'status':
-                            result = subprocess.run(['sc', 'query', service_name], capture_output=True, text=True, timeout=30)
-                        elif action == 'restart':
-                            subprocess.run(['sc', 'stop', service_name], capture_output=True, text=True, timeout=30)
-                            time.sleep(2)
-                            result = subprocess.run(['sc', 'start', service_name], capture_output=True, text=True, timeout=30)
-                    else:
-                        result = subprocess.run(['systemctl', action, service_name], capture_output=True, text=True, timeout=30)
-                    
-                    return jsonify({
-                        'result': f'Действие "{action}" для службы "{service_name}":\n{result.stdout}\n{result.stderr}',
-                        'return_code': result.returncode
-                    })
-                
+                        if ':' in line:
+                            key, value = line.split(":", 1)
+                            key = key.strip()
+                            value = value.strip()
+
+                            if key == "SERVICE_NAME":
+                                current_service_info["SERVICE_NAME"] = value
+                            elif key == "DISPLAY_NAME":
+                                current_service_info["DISPLAY_NAME"] = value
+                            elif key == "STATE":
+                                # Пример строки: STATE              : 4  RUNNING 
+                                state_parts = value.split()
+                                if len(state_parts) > 1: # Ожидаем как минимум код состояния и текст
+                                    current_service_info["STATE_TEXT"] = state_parts[-1] # Берем последнее слово как текстовое состояние
+                                else:
+                                    current_service_info["STATE_TEXT"] = value # Если формат другой
+
+                    # Добавляем последний сервис, если он есть в буфере
+                    if current_service_info.get("SERVICE_NAME"):
+                        services_list.append(f"Имя: {current_service_info.get('SERVICE_NAME', 'N/A')}, " +
+                                             f"Отображаемое имя: {current_service_info.get('DISPLAY_NAME', 'N/A')}, " +
+                                             f"Состояние: {current_service_info.get('STATE_TEXT', 'N/A')}")
+
+                    if not services_list:
+                        return {'result': f'Список служб Windows (sc queryex):\nНе удалось обработать вывод или службы не найдены.\nRaw stdout (first 1000 chars):\n{stdout_decoded[:1000]}'}
+
+                    # Ограничиваем вывод, например, первыми 200 службами, чтобы не перегружать
+                    output_limit = 200
+                    result_text = f'Список служб Windows ({len(services_list)} найдено, показано до {output_limit}):\n' + '\n'.join(services_list[:output_limit])
+                    if len(services_list) > output_limit:
+                        result_text += f"\n... и еще {len(services_list) - output_limit} служб."
+
+                    return {'result': result_text}
+
+                except FileNotFoundError:
+                    return {'error': 'Команда sc не найдена. Убедитесь, что она доступна в PATH.'}, 500
+                except subprocess.TimeoutExpired:
+                    return {'error': 'Команда sc queryex превысила лимит времени выполнения (60 сек)'}, 408
+                except Exception as e_sc:
+                    return {'error': f'Ошибка при вызове sc queryex или обработке вывода: {str(e_sc)}'}, 500
+            else:
+                result = subprocess.run(['systemctl', 'list-units', '--type=service'], capture_output=True, text=True, timeout=30)
+                return {'result': f'Список служб Linux:\n{result.stdout}'}
+
+        elif action in ['start', 'stop', 'restart', 'status']:
+            if not service_name:
+                return {'error': 'Не указано имя службы'}, 400
+
+            if platform.system() == 'Windows':
+                if action == 'start':
+                    result = subprocess.run(['sc', 'start', service_name], capture_output=True, text=True, timeout=30)
+                elif action == 'stop':
+                    result = subprocess.run(['sc', 'stop', service_name], capture_output=True, text=True, timeout=30)
+                elif action == 'status':
+                    result = subprocess.run(['sc', 'query', service_name], capture_output=True, text=True, timeout=30)
+                elif action == 'restart':
+                    subprocess.run(['sc', 'stop', service_name], capture_output=True, text=True, timeout=30)
+                    time.sleep(2)
+                    result = subprocess.run(['sc', 'start', service_name], capture_output=True, text=True, timeout=30)
+            else:
+                result = subprocess.run(['systemctl', action, service_name], capture_output=True, text=True, timeout=30)
+
+            return {
+                'result': f'Действие "{action}" для службы "{service_name}":\n{result.stdout}\n{result.stderr}',
+                'return_code': result.returncode
+            }
+
+        else:
+            return {'error': f'Неизвестное действие: {action}'}, 400
+
+    except subprocess.TimeoutExpired:
+        return {'error': 'Команда превысила лимит времени выполнения'}, 408
+    except Exception as e:
+        return {'error': f'Ошибка управления службами: {str(e)}'}, 500
+
+@tool_registry.handler('file_operations', timeout=120, concurrency='slow',
+                       read_only=lambda p: p.get('operation') in ('search', 'permissions'))
+def tool_file_operations(parameters):
+    """Файловые операции: copy / move / search / permissions"""
+    operation = parameters.get('operation')  # 'copy', 'move', 'search', 'permissions'
+    source = parameters.get('source')
+    destination = parameters.get('destination')
+    pattern = parameters.get('pattern')
+
+    if not operation:
+        return {'error': 'Не указана операция (copy, move, search, permissions)'}, 400
+
+    try:
+        if operation == 'copy':
+            if not source or not destination:
+                return {'error': 'Не указан источник или назначение'}, 400
+
+            source = os.path.abspath(source)
+            destination = os.path.abspath(destination)
+
+            if os.path.isfile(source):
+                shutil.copy2(source, destination)
+                return {'result': f'Файл скопирован: {source} -> {destination}'}
+            elif os.path.isdir(source):
+                shutil.copytree(source, destination)
+                return {'result': f'Папка скопирована: {source} -> {destination}'}
+            else:
+                return {'error': f'Источник не найден: {source}'}, 404
+
+        elif operation == 'move':
+            if not source or not destination:
+                return {'error': 'Не указан источник или назначение'}, 400
+
+            source = os.path.abspath(source)
+            destination = os.path.abspath(destination)
+
+            shutil.move(source, destination)
+            return {'result': f'Перемещено: {source} -> {destination}'}
+
+        elif operation == 'search':
+            if not source:
+                return {'error': 'Не указан путь поиска или шаблон'}, 400
+
+            source = os.path.abspath(source)
+            if not os.path.isdir(source):
+                return {'error': f'Папка не найдена: {source}'}, 404
+            try:
+                search = FileSearch.from_parameters(source, parameters)
+            except ValueError as e:
+                return {'error': str(e)}, 400
+            found_files = [item['path'] for item in search]
+
+            criteria = pattern or parameters.get('regex') or parameters.get('extensions')
+            result_text = f"Найдено файлов с шаблоном '{criteria}' в {source}:\n"
+            result_text += '\n'.join(found_files) if found_files else 'Ничего не найдено'
+            if search.limited:
+                result_text += f"\n... показаны первые {search.limit}, поиск остановлен"
+            elif search.timed_out:
+                result_text += f"\n... поиск прерван через {search.timeout:.0f} с, результаты неполные"
+
+            return {'result': result_text, 'found_files': found_files, **search.summary()}
+
+        elif operation == 'permissions':
+            if not source:
+                return {'error': 'Не указан путь к файлу'}, 400
+
+            source = os.path.abspath(source)
+
+            if not os.path.exists(source):
+                return {'error': f'Файл не найден: {source}'}, 404
+
+            stat_info = os.stat(source)
+            permissions = oct(stat_info.st_mode)[-3:]
+
+            result_text = f"Права доступа для {source}:\n"
+            result_text += f"Восьмеричное представление: {permissions}\n"
+            result_text += f"Размер: {stat_info.st_size} байт\n"
+            result_text += f"Последнее изменение: {time.ctime(stat_info.st_mtime)}\n"
+            result_text += f"Последний доступ: {time.ctime(stat_info.st_atime)}"
+
+            return {'result': result_text, 'permissions': permissions, 'size': stat_info.st_size}
+
+        else:
+            return {'error': f'Неизвестная операция: {operation}'}, 400
+
+    except Exception as e:
+        return {'error': f'Ошибка файловой операции: {str(e)}'}, 500
+
+@tool_registry.handler('find_executable', timeout=15, concurrency='fast', read_only=True)
+def tool_find_executable(parameters):
+    """Поиск исполняемого файла в PATH"""
+    executable_name = parameters.get('executable_name')
+    if not executable_name:
+        return {'error': 'Не указано имя исполняемого файла (executable_name)'}, 400
+
+    try:
+        if platform.system() == 'Windows':
+            command = ['where', executable_name]
+        else:
+            command = ['which', executable_name]
+
+        result = subprocess.run(command, capture_output=True, text=True, timeout=10, check=False, shell=False)
+
+        stdout_decoded = result.stdout.strip()
+        stderr_decoded = result.stderr.strip()
+
+        if result.returncode == 0 and stdout_decoded:
+            # Команда 'where' может вернуть несколько путей, 'which' обычно один
+            found_path = stdout_decoded.splitlines()[0] # Берем первый найденный путь
+            return {'result': f'Исполняемый файл найден: {found_path}', 'path': found_path}
+        elif stderr_decoded:
+            # Команда where в Windows возвращает код 1 и нет вывода в stdout, если не найдено
+            # Команда which в Linux возвращает код 1 и нет вывода в stdout, если не найдено
+            if result.returncode != 0 and not stdout_decoded : # Типично для 'не найдено'
+                 return {'result': f'Исполняемый файл "{executable_name}" не найден в системных путях.', 'found': False}
+            return {'result': f'Ошибка при поиске исполняемого файла: {stderr_decoded}', 'error_details': stderr_decoded, 'found': False}
+        else:
+            return {'result': f'Исполняемый файл "{executable_name}" не найден в системных путях (код возврата: {result.returncode}).', 'found': False}
+
+    except FileNotFoundError:
+        cmd_str = 'where' if platform.system() == 'Windows' else 'which'
+        return {'error': f'Команда "{cmd_str}" не найдена. Убедитесь, что она доступна в PATH.'}, 500
+    except subprocess.TimeoutExpired:
+        return {'error': f'Команда поиска исполняемого файла превысила лимит времени выполнения (10 сек)'}, 408
+    except Exception as e_find:
+        return {'error': f'Непредвиденная ошибка при поиске исполняемого файла: {str(e_find)}'}, 500
+
+class ToolExecutor:
+    """Выполнение инструментов из реестра в ограниченных пулах потоков. У каждого класса конкурентности
+    свой пул: долгий manage_services list или cpu_percent(interval=1) занимает поток 'slow' и не мешает
+    чтению файлов. Вызывающий ждет не дольше таймаута инструмента; сверх workers + backlog вызовы
+    в очередь не ставятся (HTTP 503)"""
+
+    def __init__(self, registry, workers, backlog=16):
+        self.registry = registry
+        self.workers = dict(workers)
+        self.backlog = backlog
+        self._pools = {cls: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f'tool-{cls}')
+                       for cls, n in self.workers.items()}
+        self._lock = Lock()
+        self._in_flight = {cls: 0 for cls in self.workers}
+        self._stats = {}  # имя инструмента -> счетчики
+
+    def _counters(self, name):
+        counters = self._stats.get(name)
+        if counters is None:
+            counters = self._stats[name] = {'calls': 0, 'errors': 0, 'timeouts': 0, 'rejected': 0,
+                                            'total_ms': 0.0, 'max_ms': 0.0}
+        return counters
+
+    def _count(self, name, key):
+        with self._lock:
+            self._counters(name)[key] += 1
+
+    def _run(self, spec, parameters):
+        started = time.perf_counter()
+        try:
+            rv = spec.handler(parameters)
+            data, status = rv if isinstance(rv, tuple) else (rv, 200)
+        except Exception as e:
+            app.logger.error(f"Tool {spec.name} failed: {e}")
+            data, status = {'error': f'Ошибка выполнения инструмента: {str(e)}'}, 500
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            counters = self._counters(spec.name)
+            counters['calls'] += 1
+            counters['total_ms'] += elapsed
+            counters['max_ms'] = max(counters['max_ms'], elapsed)
+            if status >= 400:
+                counters['errors'] += 1
+        return data, status
+
+    def submit(self, tool_name, parameters):
+        """Ставит вызов в пул. Возвращает (spec, future) или (None, (данные ошибки, HTTP-статус))"""
+        spec = self.registry.get(tool_name) if tool_name else None
+        if spec is None or spec.handler is None:
+            return None, ({'error': f'Неизвестный инструмент: {tool_name}'}, 400)
+        if parameters is None:
+            parameters = {}
+        if not isinstance(parameters, dict):
+            return None, ({'error': 'Параметры инструмента должны быть объектом'}, 400)
+        cls = spec.concurrency
+        with self._lock:
+            if self._in_flight[cls] >= self.workers[cls] + self.backlog:
+                self._counters(spec.name)['rejected'] += 1
+                return None, ({'error': f'Исполнитель инструментов занят ({cls}), повторите позже'}, 503)
+            self._in_flight[cls] += 1
+        future = self._pools[cls].submit(self._run, spec, parameters)
+        future.add_done_callback(lambda _: self._release(cls))
+        return spec, future
+
+    def _release(self, cls):
+        with self._lock:
+            self._in_flight[cls] -= 1
+
+    def _timed_out(self, spec, future):
+        # Выполняющийся поток прервать нельзя: слот освободится, когда обработчик вернется
+        future.cancel()
+        self._count(spec.name, 'timeouts')
+        return {'error': f'Инструмент {spec.name} не завершился за {spec.timeout} с'}, 504
+
+    def execute(self, tool_name, parameters):
+        """Выполняет инструмент и возвращает (данные ответа, HTTP-статус)"""
+        spec, future = self.submit(tool_name, parameters)
+        if spec is None:
+            return future
+        try:
+            return future.result(timeout=spec.timeout)
+        except FuturesTimeout:
+            return self._timed_out(spec, future)
+
+    async def execute_async(self, tool_name, parameters):
+        """То же для asyncio: цикл событий не блокируется на время выполнения"""
+        spec, future = self.submit(tool_name, parameters)
+        if spec is None:
+            return future
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), spec.timeout)
+        except asyncio.TimeoutError:
+            return self._timed_out(spec, future)
+
+    def _batch_groups(self, calls):
+        """Делит пакет на группы, выполняемые одна за другой: подряд идущие только читающие вызовы
+        идут одной параллельной группой, а меняющий систему вызов (write_file, delete_file, execute_command...)
+        - барьер: он ждет все предыдущие вызовы, а следующие ставятся только после него"""
+        group = []
+        for index, call in enumerate(calls):
+            spec = self.registry.get(call.get('tool_name') or call.get('tool'))
+            parameters = call.get('parameters')
+            # Неизвестный инструмент или неверные параметры будут отклонены без выполнения
+            if spec is None or not isinstance(parameters, (dict, type(None))) or spec.is_read_only(parameters):
+                group.append((index, call))
+                continue
+            if group:
+                yield group
+            yield [(index, call)]
+            group = []
+        if group:
+            yield group
+
+    def run_batch(self, calls):
+        """Выполняет пакет (параллельно - только независимые читающие вызовы) и выдает результаты в исходном порядке"""
+        for group in self._batch_groups(calls):
+            batch = [ToolBatchCall(self, index, call) for index, call in group]
+            for call in batch:
+                if call.spec is None:
+                    yield call.result(*call.rejected)
+                    continue
+                try:
+                    data, status = call.future.result(timeout=call.remaining())
+                except FuturesTimeout:
+                    data, status = self._timed_out(call.spec, call.future)
+                yield call.result(data, status)
+
+    async def run_batch_async(self, calls):
+        for group in self._batch_groups(calls):
+            batch = [ToolBatchCall(self, index, call) for index, call in group]
+            for call in batch:
+                if call.spec is None:
+                    yield call.result(*call.rejected)
+                    continue
+                try:
+                    data, status = await asyncio.wait_for(asyncio.wrap_future(call.future), call.remaining())
+                except asyncio.TimeoutError:
+                    data, status = self._timed_out(call.spec, call.future)
+                yield call.result(data, status)
+
+    def stats(self):
+        with self._lock:
+            tools = {}
+            for name, counters in self._stats.items():
+                item = dict(counters)
+                item['total_ms'] = round(item['total_ms'], 1)
+                item['max_ms'] = round(item['max_ms'], 1)
+                item['avg_ms'] = round(counters['total_ms'] / counters['calls'], 1) if counters['calls'] else 0.0
+                tools[name] = item
+            return {
+                'pools': {cls: {'workers': n, 'in_flight': self._in_flight[cls]} for cls, n in self.workers.items()},
+                'backlog': self.backlog,
+                'tools': tools,
+            }
+
+
+class ToolBatchCall:
+    """Вызов из пакета /api/tools/batch. Ставится в пул при создании; время - от постановки до готовности"""
+
+    def __init__(self, executor, index, call):
+        self.index = index
+        self.id = call.get('id')
+        self.tool = call.get('tool_name') or call.get('tool')
+        self.started = time.perf_counter()
+        self.finished = None
+        self.spec, future = executor.submit(self.tool, call.get('parameters'))
+        if self.spec is None:
+            self.future, self.rejected = None, future
+            self.finished = self.started
+        else:
+            self.future, self.rejected = future, None
+            self.future.add_done_callback(self._done)
+
+    def _done(self, _):
+        self.finished = time.perf_counter()
+
+    def remaining(self):
+        return max(0.0, self.started + self.spec.timeout - time.perf_counter())
+
+    def result(self, data, status):
+        finished = self.finished or time.perf_counter()
+        item = {
+            'index': self.index,
+            'tool': self.tool,
+            'status': status,
+            'duration_ms': round((finished - self.started) * 1000, 1),
+            'response': data,
+        }
+        if self.id is not None:
+            item['id'] = self.id
+        return item
+
+
+TOOL_BATCH_MAX_CALLS = int(settings.get("tool_batch_max_calls", 16))
+
+
+def parse_tool_batch(data):
+    """Проверяет тело /api/tools/batch. Возвращает (список вызовов, None) или (None, текст ошибки)"""
+    calls = data.get('calls') if isinstance(data, dict) else None
+    if not isinstance(calls, list) or not calls:
+        return None, 'Ожидается непустой список calls'
+    if len(calls) > TOOL_BATCH_MAX_CALLS:
+        return None, f'Слишком много вызовов в пакете: {len(calls)} (максимум {TOOL_BATCH_MAX_CALLS})'
+    if not all(isinstance(call, dict) for call in calls):
+        return None, 'Каждый вызов должен быть объектом {"tool_name": ..., "parameters": {...}}'
+    return calls, None
+
+
+def sse_event(kind, data):
+    return f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+tool_executor = ToolExecutor(tool_registry, {
+    'fast': int(settings.get("tool_workers_fast", 8)),
+    'slow': int(settings.get("tool_workers_slow", 4)),
+}, backlog=int(settings.get("tool_backlog", 32)))
+
+
+def run_tool(tool_name, parameters):
+    """Выполняет инструмент и возвращает Flask-ответ, как /api/tools"""
+    data, status = tool_executor.execute(tool_name, parameters)
+    return jsonify(data), status
+
+class AsyncOllamaStream:
+    """Потоковый ответ Ollama в asyncio: построчная выдача NDJSON, возврат соединения в пул"""
+
+    def __init__(self, client, reader, writer, headers):
+        self.client = client
+        self.reader = reader
+        self.writer = writer
+        self.headers = headers
+        self._reusable = False
+        self._closed = False
+        self._body = None  # тело, уже прочитанное read_body()
+
+    @property
+    def status(self):
+        return int(self.headers.get('status', 200))
+
+    async def read_body(self):
+        """Тело ответа целиком (для ответов с ошибкой); iter_lines() после этого отдает его же"""
+        if self._body is None:
+            _, read_timeout = self.client.timeout_for('chat_stream')
+            self._body = b''.join([chunk async for chunk in self._iter_body(read_timeout)])
+        return self._body
+
+    async def _iter_body(self, read_timeout):
+        if self._body is not None:
+            yield self._body
+            return
+        reader = self.reader
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), read_timeout)
+                if not size_line:
+                    raise ConnectionError("Ollama closed connection mid-stream")
+                size = int(size_line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # Трейлеры (обычно отсутствуют) до пустой строки
+                    while (await asyncio.wait_for(reader.readline(), read_timeout)) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self._reusable = True
+                    return
+                chunk = await asyncio.wait_for(reader.readexactly(size + 2), read_timeout)
+                yield chunk[:-2]
+        elif 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(65536, remaining)), read_timeout)
+                if not chunk:
+                    raise ConnectionError("Ollama closed connection mid-body")
+                remaining -= len(chunk)
+                yield chunk
+            self._reusable = True
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(65536), read_timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def iter_lines(self):
+        _, read_timeout = self.client.timeout_for('chat_stream')
+        buffer = b''
+        try:
+            async for chunk in self._iter_body(read_timeout):
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    line = line.rstrip(b'\r')
+                    if line:
+                        yield line
+            if buffer.strip():
+                yield buffer.strip()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        keep_alive = self._reusable and self.headers.get('connection', '').lower() != 'close'
+        self.client._release(self.reader, self.writer, keep_alive)
+
+    def abort(self):
+        """Обрывает соединение (вызывается в event loop): ожидающее чтение в iter_lines() завершится
+        ошибкой, а Ollama увидит разрыв и остановит генерацию"""
+        self._reusable = False
+        self.writer.transport.abort()
+
+
+class AsyncOllamaClient:
+    """Асинхронный клиент Ollama для стриминга: пул keep-alive соединений внутри одного event loop"""
+
+    def __init__(self, base_url, pool_size=256, max_retries=2, retry_backoff=0.5, timeouts=None):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 80
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeouts = dict(OllamaClient.DEFAULT_TIMEOUTS)
+        for endpoint, value in (timeouts or {}).items():
+            self.timeouts[endpoint] = tuple(value) if isinstance(value, (list, tuple)) else value
+        self._idle = []
+        self._slots = asyncio.Semaphore(pool_size)
+        self._counters = {
+            'requests': 0,
+            'active': 0,
+            'retries': 0,
+            'errors': 0,
+            'connections_opened': 0,
+            'connections_reused': 0,
+        }
+
+    def timeout_for(self, endpoint):
+        value = self.timeouts.get(endpoint, OllamaClient.DEFAULT_TIMEOUTS['chat'])
+        if isinstance(value, tuple):
+            return value
+        return value, value
+
+    async def _connect(self, connect_timeout):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                self._counters['connections_reused'] += 1
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), connect_timeout)
+        self._counters['connections_opened'] += 1
+        return reader, writer, False
+
+    async def _read_head(self, reader, timeout):
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    def _release(self, reader, writer, keep_alive):
+        self._counters['active'] -= 1
+        if keep_alive and len(self._idle) < self.pool_size and not writer.is_closing():
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        self._slots.release()
+
+    async def open_stream(self, path, payload, endpoint='chat_stream'):
+        """Отправляет POST и ждет заголовки ответа; тело читается через AsyncOllamaStream.iter_lines()"""
+        connect_timeout, read_timeout = self.timeout_for(endpoint)
+        body = json.dumps(payload).encode('utf-8')
+        request_head = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode('latin-1')
+
+        await self._slots.acquire()
+        self._counters['active'] += 1
+        attempt = 0
+        while True:
+            self._counters['requests'] += 1
+            reader = writer = None
+            reused = False
+            try:
+                reader, writer, reused = await self._connect(connect_timeout)
+                writer.write(request_head + body)
+                await writer.drain()
+                status, headers = await self._read_head(reader, read_timeout)
+                headers['status'] = str(status)
+                return AsyncOllamaStream(self, reader, writer, headers)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                if writer is not None:
+                    writer.close()
+                # Протухшее keep-alive соединение повторяем сразу, ошибку подключения - с паузой.
+                # Таймаут ожидания ответа (модель уже считает) не повторяем.
+                stale = reused and not isinstance(e, asyncio.TimeoutError)
+                read_timed_out = isinstance(e, asyncio.TimeoutError) and reader is not None
+                if not stale and (read_timed_out or attempt >= self.max_retries):
+                    self._counters['errors'] += 1
+                    self._counters['active'] -= 1
+                    self._slots.release()
+                    raise
+                self._counters['retries'] += 1
+                if not stale:
+                    delay = self.retry_backoff * (2 ** attempt)
+                    attempt += 1
+                    app.logger.warning(f"AsyncOllamaClient: connection error on {path} ({e!r}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+            except BaseException:
+                if writer is not None:
+                    writer.close()
+                self._counters['active'] -= 1
+                self._slots.release()
+                raise
+
+    def stats(self):
+        data = dict(self._counters)
+        data['pool_size'] = self.pool_size
+        data['idle_connections'] = len(self._idle)
+        return data
+
+
+class AsyncRequest:
+    """Разобранный HTTP-запрос для AsyncStreamingServer"""
+
+    def __init__(self, method, target, version, headers, body, peer):
+        self.method = method
+        self.path, _, self.query = target.partition('?')
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.peer = peer or ('', 0)
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+class AsyncStreamingServer:
+    """HTTP-сервер на asyncio: стриминговые маршруты мультиплексируются в одном event loop,
+    остальные запросы передаются Flask-приложению через ограниченный пул потоков"""
+
+    MAX_HEADER_SIZE = 64 * 1024
+    MAX_BODY_SIZE = 256 * 1024 * 1024
+    KEEP_ALIVE_TIMEOUT = 75
+    RESUME_RE = re.compile(r'/generate-stream/[0-9a-f]+')
+    # CORS как у Flask-маршрутов (flask_cors): без Expose-Headers браузер не покажет клиенту X-Stream-Id
+    CORS_HEADERS = ("Access-Control-Allow-Origin: *\r\n"
+                    f"Access-Control-Expose-Headers: {', '.join(CORS_EXPOSE_HEADERS)}\r\n")
+
+    def __init__(self, wsgi_app, host='0.0.0.0', port=5000, wsgi_workers=16, ollama=None):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.ollama = ollama
+        self._executor = ThreadPoolExecutor(max_workers=wsgi_workers, thread_name_prefix='wsgi')
+        self.loop = None
+        self._producers = set()  # задачи генерации возобновляемых запусков
+        self.stream_routes = {
+            '/generate-stream': self._stream_generate,
+            '/install-model-stream': self._stream_install_model,
+            '/api/tools/batch': self._tool_batch,
+        }
+        self._counters = {
+            'connections_open': 0,
+            'connections_total': 0,
+            'streams_active': 0,
+            'streams_total': 0,
+            'wsgi_requests': 0,
+        }
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        if self.ollama is None:
+            self.ollama = AsyncOllamaClient(
+                OLLAMA_API,
+                pool_size=int(settings.get("async_ollama_pool_size", 256)),
+                max_retries=ollama_client.max_retries,
+                retry_backoff=ollama_client.retry_backoff,
+                timeouts=settings.get("ollama_timeouts"),
+            )
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port, limit=self.MAX_HEADER_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    def stats(self):
+        data = dict(self._counters)
+        data['ollama'] = self.ollama.stats() if self.ollama else None
+        return data
+
+    async def _read_request(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.KEEP_ALIVE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                name = name.strip().lower()
+                headers[name] = f"{headers[name]}, {value.strip()}" if name in headers else value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            await self._send_simple(writer, 411, {"error": "Chunked request bodies are not supported"}, keep_alive=False)
+            return None
+        length = int(headers.get('content-length') or 0)
+        if length > self.MAX_BODY_SIZE:
+            await self._send_simple(writer, 413, {"error": "Request body too large"}, keep_alive=False)
+            return None
+        if length and headers.get('expect', '').lower() == '100-continue':
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+        body = await reader.readexactly(length) if length else b''
+        return AsyncRequest(method.upper(), target, version.strip(), headers, body, writer.get_extra_info('peername'))
+
+    async def _handle_connection(self, reader, writer):
+        self._counters['connections_open'] += 1
+        self._counters['connections_total'] += 1
+        try:
+            while True:
+                req = await self._read_request(reader, writer)
+                if req is None:
+                    break
+                handler = self.stream_routes.get(req.path) if req.method == 'POST' else None
+                if handler is None and req.method == 'GET' and self.RESUME_RE.fullmatch(req.path):
+                    handler = self._stream_resume
+                if handler is not None:
+                    keep_alive = await handler(req, writer, reader)
                 else:
-                    return jsonify({'error': f'Неизвестное действие: {action}'}), 400
-                    
-            except subprocess.TimeoutExpired:
-                return jsonify({'error': 'Команда превысила лимит времени выполнения'}), 408
+                    keep_alive = await self._dispatch_wsgi(req, writer)
+                if not keep_alive or not req.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        except Exception as e:
+            app.logger.error(f"AsyncStreamingServer: connection handler error: {e}", exc_info=True)
+        finally:
+            self._counters['connections_open'] -= 1
+            writer.close()
+
+    async def _send_simple(self, writer, status, data, keep_alive=True, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        reason = 'OK' if status == 200 else 'Error'
+        writer.write((
+            f"HTTP/1.1 {status} {reason}\r\n"
+            "Content-Type: application/json\r\n"
+            + self.CORS_HEADERS
+            + ''.join(f"{name}: {value}\r\n" for name, value in (headers or {}).items()) +
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        ).encode('latin-1') + body)
+        await writer.drain()
+        return keep_alive
+
+    async def _watch_disconnect(self, reader, on_disconnect):
+        """Пока идет SSE, клиент ничего не присылает: EOF на сокете означает, что он ушел,
+        даже если upstream сейчас молчит и записывать в сокет нечего"""
+        try:
+            data = await reader.read(1)
+        except OSError:
+            data = b''
+        if not data:
+            on_disconnect()
+        return data
+
+    async def _send_sse(self, writer, frames, on_disconnect=None, reader=None, headers=None):
+        """Отдает SSE-кадры чанками HTTP/1.1. Возвращает False, если клиент отключился."""
+        self._counters['streams_active'] += 1
+        self._counters['streams_total'] += 1
+        watcher = None
+        try:
+            writer.write((
+                "HTTP/1.1 200 OK\r\n"
+                "Content-Type: text/event-stream; charset=utf-8\r\n"
+                "Cache-Control: no-cache\r\n"
+                + self.CORS_HEADERS
+                + ''.join(f"{name}: {value}\r\n" for name, value in (headers or {}).items()) +
+                "Transfer-Encoding: chunked\r\n\r\n"
+            ).encode('latin-1'))
+            await writer.drain()
+            if reader is not None and on_disconnect is not None:
+                watcher = asyncio.ensure_future(self._watch_disconnect(reader, on_disconnect))
+            try:
+                async for frame in frames:
+                    writer.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+                    await writer.drain()
+            except (ConnectionError, asyncio.CancelledError):
+                if on_disconnect is not None:
+                    on_disconnect()
+                raise
             except Exception as e:
-                return jsonify({'error': f'Ошибка управления службами: {str(e)}'}), 500
-        
-        elif tool_name == 'file_operations':
-            operation = parameters.get('operation')  # 'copy', 'move', 'search', 'permissions'
-            source = parameters.get('source')
-            destination = parameters.get('destination')
-            pattern = parameters.get('pattern')
-            
-            if not operation:
-                return jsonify({'error': 'Не указана операция (copy, move, search, permissions)'}), 400
-            
+                app.logger.error(f"AsyncStreamingServer: stream aborted: {e}", exc_info=True)
+            finally:
+                await frames.aclose()
+            if watcher is not None and watcher.done():
+                # Клиент закрыл соединение или (конвейерный запрос) прислал данные, которые уже прочитаны
+                return False
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return True
+        except ConnectionError:
+            return False
+        finally:
+            if watcher is not None and not watcher.done():
+                watcher.cancel()
+            self._counters['streams_active'] -= 1
+
+    async def _stream_generate(self, req, writer, reader=None):
+        session = None
+        try:
+            data = json.loads(req.body or b'{}')
             try:
-                if operation == 'copy':
-                    if not source or not destination:
-                        return jsonify({'error': 'Не указан источник или назначение'}), 400
-                    
-                    source = os.path.abspath(source)
-                    destination = os.path.abspath(destination)
-                    
-                    if os.path.isfile(source):
-                        import shutil
-                        shutil.copy2(source, destination)
-                        return jsonify({'result': f'Файл скопирован: {source} -> {destination}'})
-                    elif os.path.isdir(source):
-                        import shutil
-                        shutil.copytree(source, destination)
-                        return jsonify({'result': f'Папка скопирована: {source} -> {destination}'})
-                    else:
-                        return jsonify({'error': f'Источник не найден: {source}'}), 404
-                
-                elif operation == 'move':
-                    if not source or not destination:
-                        return jsonify({'error': 'Не указан источник или назначение'}), 400
-                    
-                    source = os.path.abspath(source)
-                    destination = os.path.abspath(destination)
-                    
-                    import shutil
-                    shutil.move(source, destination)
-                    return jsonify({'result': f'Перемещено: {source} -> {destination}'})
-                
-                elif operation == 'search':
-                    if not source or not pattern:
-                        return jsonify({'error': 'Не указан путь поиска или шаблон'}), 400
-                    
-                    source = os.path.abspath(source)
-                    found_files = []
-                    
-                    for root, dirs, files in os.walk(source):
-                        for file in files:
-                            if pattern.lower() in file.lower():
-                                found_files.append(os.path.join(root, file))
-                        if len(found_files) >= 50:  # Ограничиваем результаты
+                max_iterations = max_tool_iterations(data)
+                if data.get('session'):
+                    session, data = await self.loop.run_in_executor(self._executor, open_chat_session, data)
+            except ValueError as e:
+                return await self._send_simple(writer, 400, {"error": str(e)})
+            # Подсчет токенов всей истории (и запрос окна модели к Ollama) - не в event loop
+            payload = await self.loop.run_in_executor(self._executor, build_stream_payload, data)
+            ticket = ollama_scheduler.submit(payload['model'], 'interactive')
+        except SchedulerQueueFull as e:
+            return await self._send_simple(writer, 429, e.to_dict(), headers={'Retry-After': max(1, int(e.eta + 0.5))})
+        except Exception as e:
+            return await self._send_simple(writer, 500, {"error": str(e)})
+        run = StreamRun(payload, tool_loop_for(data, payload, max_iterations), session, ticket,
+                        data.get('stream_format', 'raw'))
+        run.loop = self.loop
+        upstream = None
+        if ticket.granted:
+            try:
+                upstream = await self._open_run_stream(run)
+            except Exception as e:
+                ticket.release()
+                return await self._send_simple(writer, 500, {"error": str(e)})
+        stream_registry.register(run)
+
+        async def frames():
+            # Асинхронный двойник stream_run_frames()
+            nonlocal upstream
+            state = 'error'
+            try:
+                if upstream is None:
+                    while not await ticket.wait_async(1.0):
+                        if run.cancelled:
                             break
-                    
-                    result_text = f"Найдено файлов с шаблоном '{pattern}' в {source}:\n"
-                    result_text += '\n'.join(found_files[:50])
-                    if len(found_files) >= 50:
-                        result_text += f"\n... и еще {len(found_files) - 50} файлов"
-                    
-                    return jsonify({'result': result_text, 'found_files': found_files[:50]})
-                
-                elif operation == 'permissions':
-                    if not source:
-                        return jsonify({'error': 'Не указан путь к файлу'}), 400
-                    
-                    source = os.path.abspath(source)
-                    
-                    if not os.path.exists(source):
-                        return jsonify({'error': f'Файл не найден: {source}'}), 404
-                    
-                    stat_info = os.stat(source)
-                    permissions = oct(stat_info.st_mode)[-3:]
-                    
-                    result_text = f"Права доступа для {source}:\n"
-                    result_text += f"Восьмеричное представление: {permissions}\n"
-                    result_text += f"Размер: {stat_info.st_size} байт\n"
-                    result_text += f"Последнее изменение: {time.ctime(stat_info.st_mtime)}\n"
-                    result_text += f"Последний доступ: {time.ctime(stat_info.st_atime)}"
-                    
-                    return jsonify({'result': result_text, 'permissions': permissions, 'size': stat_info.st_size})
-                
-                else:
-                    return jsonify({'error': f'Неизвестная операция: {operation}'}), 400
-                    
+                        yield run.queued_frame().encode('utf-8')
+                    if run.cancelled:
+                        yield run.cancelled_frame().encode('utf-8')
+                        state = 'cancelled'
+                        return
+                    upstream = await self._open_run_stream(run)
+                while True:
+                    run.attach_upstream(upstream)
+                    call = None
+                    try:
+                        async for line in upstream.iter_lines():
+                            frame, call = run.on_line(line)
+                            if frame:
+                                yield frame.encode('utf-8')
+                            if call is not None:
+                                break
+                            self._schedule_flush(run)
+                    except (OSError, EOFError):
+                        if not run.cancelled:
+                            raise
+                    finally:
+                        upstream.close()
+                    if run.cancelled:
+                        yield run.cancelled_frame().encode('utf-8')
+                        state = 'cancelled'
+                        return
+                    if call is None:
+                        call = run.end_round()
+                        if call is None:
+                            state = 'done'
+                            return
+                    result, status = await tool_executor.execute_async(call['name'], call['arguments'])
+                    yield run.on_tool_result(call, result, status).encode('utf-8')
+                    if run.cancelled:
+                        yield run.cancelled_frame().encode('utf-8')
+                        state = 'cancelled'
+                        return
+                    upstream = await self._open_run_stream(run)
+            except (GeneratorExit, asyncio.CancelledError):
+                state = 'disconnected'
+                raise
+            except (OSError, EOFError) as e:
+                app.logger.error(f"generate-stream {run.id}: upstream error: {e!r}")
+                yield run.error_frame(str(e) or repr(e)).encode('utf-8')
+            finally:
+                if upstream is not None:
+                    upstream.close()
+                await self.loop.run_in_executor(self._executor, run.finish, state)
+
+        if run.replay is None:
+            return await self._send_sse(writer, frames(), on_disconnect=run.mark_disconnected,
+                                        reader=reader, headers={'X-Stream-Id': run.id})
+        subscriber = run.attach()
+        self._start_producer(run, frames())
+        return await self._send_subscriber(writer, run, subscriber, 0, reader)
+
+    def _schedule_flush(self, run):
+        """Накопленный коалесцером текст уходит в буфер по истечении окна, даже если Ollama молчит.
+        Кадры из on_line() публикуются без переключения задач, поэтому таймер не обгоняет их."""
+        if run.coalescer is None or run.replay is None or run.flush_timer is not None:
+            return
+        delay = run.coalescer.deadline()
+        if delay is None:
+            return
+
+        def flush():
+            run.flush_timer = None
+            delay = run.coalescer.deadline()
+            if delay is None or run.replay.closed:
+                return
+            if delay > 0:
+                self._schedule_flush(run)  # накопленное уже уходило, окно началось заново
+                return
+            run.replay.publish(run.coalescer.flush())
+        run.flush_timer = self.loop.call_later(delay, flush)
+
+    def _start_producer(self, run, frames):
+        # Асинхронный двойник start_stream_producer(): генерация - отдельная задача event loop
+        async def produce():
+            try:
+                async for frame in frames:
+                    run.replay.publish(frame.decode('utf-8'))
             except Exception as e:
-                return jsonify({'error': f'Ошибка файловой операции: {str(e)}'}), 500
+                app.logger.error(f"generate-stream {run.id}: producer error: {e!r}", exc_info=True)
+                run.replay.publish(run.error_frame(str(e) or repr(e)))
+            finally:
+                run.replay.publish(run.event('end', {"state": run.state}))
+                run.replay.close()
+        task = self.loop.create_task(produce())
+        self._producers.add(task)
+        task.add_done_callback(self._producers.discard)
+
+    async def _send_subscriber(self, writer, run, subscriber, after, reader=None):
+        # Асинхронный двойник stream_run_subscriber()
+        async def frames():
+            nonlocal after
+            try:
+                while True:
+                    chunk, after, closed = await run.replay.read_async(after, STREAM_KEEPALIVE)
+                    if chunk:
+                        yield chunk.encode('utf-8')
+                        if after is None:
+                            return
+                    elif closed:
+                        return
+                    else:
+                        yield b": keep-alive\n\n"
+            finally:
+                run.detach(subscriber)
 
-        elif tool_name == 'find_executable':
-            executable_name = parameters.get('executable_name')
-            if not executable_name:
-                return jsonify({'error': 'Не указано имя исполняемого файла (executable_name)'}), 400
+        return await self._send_sse(writer, frames(), on_disconnect=lambda: run.detach(subscriber),
+                                    reader=reader, headers={'X-Stream-Id': run.id})
 
+    async def _stream_resume(self, req, writer, reader=None):
+        stream_id = req.path[len('/generate-stream/'):]
+        query = urllib.parse.parse_qs(req.query)
+        last_event_id = req.headers.get('last-event-id') or (query.get('last_event_id') or [None])[0]
+        run, after, error = resume_target(stream_id, last_event_id)
+        if error is not None:
+            return await self._send_simple(writer, error[1], error[0])
+        subscriber = run.attach()
+        return await self._send_subscriber(writer, run, subscriber, after, reader)
+
+    async def _open_run_stream(self, run):
+        # Асинхронный двойник open_run_stream()
+        upstream = await self.ollama.open_stream('/api/chat', run.payload)
+        if run.tool_loop is not None and run.tool_loop.native and upstream.status == 400:
+            body = (await upstream.read_body()).decode('utf-8', 'replace')
+            if tools_unsupported_error(upstream.status, body):
+                upstream.close()
+                await self.loop.run_in_executor(self._executor, fall_back_to_text_tools, run)
+                upstream = await self.ollama.open_stream('/api/chat', run.payload)
+        return upstream
+
+    async def _stream_install_model(self, req, writer, reader=None):
+        try:
+            data = json.loads(req.body or b'{}')
+        except ValueError as e:
+            return await self._send_simple(writer, 400, {"error": str(e)})
+        model_name = data.get("model")
+        if not model_name:
+            return await self._send_simple(writer, 400, {"error": "No model name provided"})
+
+        command = ["ollama", "run", model_name]
+        app.logger.info("Installing model via command: %s", " ".join(command))
+
+        async def frames():
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            pending = ''
             try:
-                if platform.system() == 'Windows':
-                    command = ['where', executable_name]
-                else:
-                    command = ['which', executable_name]
-                
-                result = subprocess.run(command, capture_output=True, text=True, timeout=10, check=False, shell=False)
-                
-                stdout_decoded = result.stdout.strip()
-                stderr_decoded = result.stderr.strip()
-
-                if result.returncode == 0 and stdout_decoded:
-                    # Команда 'where' может вернуть несколько путей, 'which' обычно один
-                    found_path = stdout_decoded.splitlines()[0] # Берем первый найденный путь
-                    return jsonify({'result': f'Исполняемый файл найден: {found_path}', 'path': found_path})
-                elif stderr_decoded:
-                    # Команда where в Windows возвращает код 1 и нет вывода в stdout, если не найдено
-                    # Команда which в Linux возвращает код 1 и нет вывода в stdout, если не найдено
-                    if result.returncode != 0 and not stdout_decoded : # Типично для 'не найдено'
-                         return jsonify({'result': f'Исполняемый файл "{executable_name}" не найден в системных путях.', 'found': False})
-                    return jsonify({'result': f'Ошибка при поиске исполняемого файла: {stderr_decoded}', 'error_details': stderr_decoded, 'found': False})
-                else:
-                    return jsonify({'result': f'Исполняемый файл "{executable_name}" не найден в системных путях (код возврата: {result.returncode}).', 'found': False})
-
-            except FileNotFoundError:
-                cmd_str = 'where' if platform.system() == 'Windows' else 'which'
-                return jsonify({'error': f'Команда "{cmd_str}" не найдена. Убедитесь, что она доступна в PATH.'}), 500
-            except subprocess.TimeoutExpired:
-                return jsonify({'error': f'Команда поиска исполняемого файла превысила лимит времени выполнения (10 сек)'}), 408
-            except Exception as e_find:
-                return jsonify({'error': f'Непредвиденная ошибка при поиске исполняемого файла: {str(e_find)}'}), 500
-        
-        else:
-            return jsonify({'error': f'Неизвестный инструмент: {tool_name}'}), 400
-            
-    except Exception as e:
-        return jsonify({'error': f'Ошибка выполнения инструмента: {str(e)}'}), 500
+                while True:
+                    chunk = await process.stdout.read(4096)
+                    pending += decoder.decode(chunk, final=not chunk)
+                    # Как text=True в синхронной версии: \r, \n и \r\n считаются концом строки
+                    *lines, pending = re.split(r'\r\n|\r|\n', pending)
+                    for line in lines:
+                        yield f"data: {line.strip()}\n\n".encode('utf-8')
+                    if not chunk:
+                        break
+                if pending:
+                    yield f"data: {pending.strip()}\n\n".encode('utf-8')
+                await process.wait()
+                yield b"data: DONE\n\n"
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+        return await self._send_sse(writer, frames())
+
+    async def _tool_batch(self, req, writer, reader=None):
+        """/api/tools/batch в event loop: ожидание результатов не занимает потоки WSGI"""
+        try:
+            data = json.loads(req.body or b'{}')
+        except ValueError as e:
+            return await self._send_simple(writer, 400, {"error": str(e)})
+        calls, error = parse_tool_batch(data)
+        if error is not None:
+            return await self._send_simple(writer, 400, {"error": error})
+        started = time.perf_counter()
+        if not data.get('stream'):
+            results = [item async for item in tool_executor.run_batch_async(calls)]
+            return await self._send_simple(writer, 200, {
+                'results': results, 'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+
+        async def frames():
+            async for item in tool_executor.run_batch_async(calls):
+                yield sse_event('result', item).encode('utf-8')
+            yield sse_event('end', {
+                'count': len(calls), 'duration_ms': round((time.perf_counter() - started) * 1000, 1)}).encode('utf-8')
+
+        return await self._send_sse(writer, frames())
+
+    async def _dispatch_wsgi(self, req, writer):
+        self._counters['wsgi_requests'] += 1
+        loop = self.loop
+        peer = req.peer
+        environ = {
+            'REQUEST_METHOD': req.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(req.path, 'latin-1'),
+            'QUERY_STRING': req.query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': req.version,
+            'REMOTE_ADDR': str(peer[0]),
+            'REMOTE_PORT': str(peer[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(req.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in req.headers.items():
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[key] = value
+            else:
+                environ[f'HTTP_{key}'] = value
+
+        started = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = status
+            started['headers'] = headers
+            return written.append
+
+        def call_app():
+            result = self.wsgi_app(environ, start_response)
+            return result, iter(result)
+
+        result, body_iter = await loop.run_in_executor(self._executor, call_app)
+        try:
+            first = await loop.run_in_executor(self._executor, next, body_iter, None)
+            headers = list(started['headers'])
+            header_names = {name.lower() for name, _ in headers}
+            chunked = 'content-length' not in header_names and req.method != 'HEAD'
+            keep_alive = req.keep_alive and (not chunked or req.version == 'HTTP/1.1')
+            if chunked and keep_alive:
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                chunked = False
+            headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+            head = f"HTTP/1.1 {started['status']}\r\n" + ''.join(f"{n}: {v}\r\n" for n, v in headers) + "\r\n"
+            writer.write(head.encode('latin-1'))
+
+            chunk = b''.join(written) + (first or b'')
+            while True:
+                if chunk and req.method != 'HEAD':
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                    await writer.drain()
+                if first is None:
+                    break
+                chunk = first = await loop.run_in_executor(self._executor, next, body_iter, None)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return keep_alive
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self._executor, result.close)
+
+
+async_server = None
 
 if __name__ == '__main__':
     print("🚀 Запуск сервера с поддержкой Ollama Tools...")
@@ -1424,4 +6364,26 @@ if __name__ == '__main__':
     print("🗂️  Может читать/изменять файлы, запускать программы, управлять процессами")
     print("🔒 Используйте только с доверенными AI моделями!")
     
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    # SIGTERM завершает процесс штатно, чтобы atexit успел записать отложенные чаты и чекпойнты
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Старые chats/<id>.json переносятся в базу, а индекс файлов запускается только при старте сервера,
+    # не при импорте модуля
+    chat_store.migrate_json_files(CHATS_DIR)
+    if settings.get("file_index_roots"):
+        file_index = FileIndex(
+            settings.get("file_index_path") or 'file_index.db',
+            settings.get("file_index_roots"),
+            rescan_interval=float(settings.get("file_index_rescan", 300)),
+            use_inotify=bool(settings.get("file_index_inotify", True)),
+            exclude=settings.get("file_index_exclude", FileSearch.SKIP_DIRS))
+        file_index.start()
+
+    if '--async' in sys.argv or settings.get("async_streaming"):
+        # Стриминговые маршруты в одном event loop, остальное - Flask через пул потоков
+        print("⚡ Асинхронный режим стриминга (asyncio)")
+        async_server = AsyncStreamingServer(app, host='0.0.0.0', port=5000,
+                                            wsgi_workers=int(settings.get("async_wsgi_workers", 16)))
+        async_server.serve_forever()
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)